@@ -11,6 +11,7 @@ from mcomix import portability
 from mcomix import i18n
 from mcomix import process
 from mcomix import callback
+from mcomix import tools
 from mcomix import archive
 
 class BaseArchive(object):
@@ -21,6 +22,23 @@ class BaseArchive(object):
     """ True if concurrent calls to extract is supported. """
     support_concurrent_extractions = False
 
+    """ True if members can be read to memory with read() and iter_read(). """
+    support_in_memory_extraction = False
+
+    """ Maximum number of concurrent calls to extract, or None if only
+    limited by the preferences. """
+    max_concurrent_extractions = None
+
+    """ True if extracting members in archive order is much faster than in
+    any other order (e.g. when random access means skipping over all the
+    previous members). """
+    prefer_archive_order = False
+
+    """ True if extracting a member is expensive even if the archive is not
+    solid (e.g. when it means rendering a page or spawning a process), so
+    that extracted members are worth storing in the page cache. """
+    expensive_extraction = False
+
     def __init__(self, archive):
         assert isinstance(archive, str), "File should be an Unicode string."
 
@@ -67,6 +85,40 @@ class BaseArchive(object):
             if 0 == len(wanted):
                 break
 
+    def read(self, filename):
+        """ Returns the content of the file specified by <filename> as a
+        byte string, without writing it to disk. This filename must be
+        obtained by calling list_contents(). Only available if
+        support_in_memory_extraction is True. """
+
+        raise NotImplementedError("Subclasses must override read.")
+
+    def iter_read(self, entries):
+        """ Generator to read <entries> from archive to memory, yielding
+        (filename, data) tuples. """
+        wanted = set(entries)
+        for filename in self.iter_contents():
+            if not filename in wanted:
+                continue
+            yield filename, self.read(filename)
+            wanted.remove(filename)
+            if 0 == len(wanted):
+                break
+
+    def read_cover(self):
+        """ Returns a (filename, data) tuple for the member that is the most
+        likely to be the cover of the archive, read to memory. Only member
+        names are listed, and a single member is read. Returns (None, None)
+        if the archive does not contain any image. Only available if
+        support_in_memory_extraction is True. """
+
+        # XXX: Deferred import to avoid circular dependency
+        from mcomix import archive_tools
+        cover = archive_tools.guess_cover(self.iter_contents())
+        if cover is None:
+            return None, None
+        return cover, self.read(cover)
+
     def close(self):
         """ Closes the archive and releases held resources. """
 
@@ -175,6 +227,12 @@ class ExternalExecutableArchive(NonUnicodeArchive):
     # concurrent calls are supported.
     support_concurrent_extractions = True
 
+    # But there is no point in running more processes than processors.
+    max_concurrent_extractions = tools.cpu_count()
+
+    # Each extraction spawns a process.
+    expensive_extraction = True
+
     def __init__(self, archive):
         super(ExternalExecutableArchive, self).__init__(archive)
         # Flag to determine if list_contents() has been called
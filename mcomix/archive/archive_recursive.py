@@ -21,8 +21,12 @@ class RecursiveArchive(archive_base.BaseArchive):
         self._archive_root = {}
         self._contents_listed = False
         self._contents = []
-        # Assume concurrent extractions are not supported.
+        # Assume concurrent and in-memory extractions are not supported.
         self.support_concurrent_extractions = False
+        self.support_in_memory_extraction = False
+        self.max_concurrent_extractions = archive.max_concurrent_extractions
+        self.prefer_archive_order = archive.prefer_archive_order
+        self.expensive_extraction = archive.expensive_extraction
 
     def _iter_contents(self, archive, root=None):
         self._archive_list.append(archive)
@@ -73,6 +77,24 @@ class RecursiveArchive(archive_base.BaseArchive):
                 supported = False
                 break
         self.support_concurrent_extractions = supported
+        # And the limits of all of them apply.
+        limits = [archive.max_concurrent_extractions for archive in self._archive_list
+                  if archive.max_concurrent_extractions is not None]
+        if limits:
+            self.max_concurrent_extractions = min(limits)
+        self.prefer_archive_order = any(archive.prefer_archive_order
+                                        for archive in self._archive_list)
+        self.expensive_extraction = any(archive.expensive_extraction
+                                        for archive in self._archive_list)
+
+    def _check_in_memory_extraction_support(self):
+        # We need all archives to support in-memory extractions.
+        supported = True
+        for archive in self._archive_list:
+            if not archive.support_in_memory_extraction:
+                supported = False
+                break
+        self.support_in_memory_extraction = supported
 
     def iter_contents(self):
         if self._contents_listed:
@@ -84,8 +106,10 @@ class RecursiveArchive(archive_base.BaseArchive):
             self._contents.append(f)
             yield f
         self._contents_listed = True
-        # We can now check if concurrent extractions are really supported.
+        # We can now check if concurrent and
+        # in-memory extractions are really supported.
         self._check_concurrent_extraction_support()
+        self._check_in_memory_extraction_support()
 
     def list_contents(self):
         if self._contents_listed:
@@ -131,6 +155,34 @@ class RecursiveArchive(archive_base.BaseArchive):
             if 0 == len(wanted):
                 break
 
+    def read(self, filename):
+        if not self._contents_listed:
+            self.list_contents()
+        archive, name = self._entry_mapping[filename]
+        log.debug('reading from %s: %s', archive.archive, filename)
+        return archive.read(name)
+
+    def iter_read(self, entries):
+        if not self._contents_listed:
+            self.list_contents()
+        # Same as iter_extract: solid archives must be read in one pass.
+        wanted = set(entries)
+        for archive in self._archive_list:
+            archive_wanted = {}
+            for name in wanted:
+                name_archive, name_archive_name = self._entry_mapping[name]
+                if name_archive == archive:
+                    archive_wanted[name_archive_name] = name
+            if 0 == len(archive_wanted):
+                continue
+            log.debug('reading from %s: %s',
+                      archive.archive, ' '.join(archive_wanted.keys()))
+            for f, data in archive.iter_read(archive_wanted.keys()):
+                yield archive_wanted[f], data
+            wanted -= set(archive_wanted.values())
+            if 0 == len(wanted):
+                break
+
     def is_solid(self):
         if not self._contents_listed:
             self.list_contents()
@@ -2,14 +2,24 @@
 
 """ PDF handler. """
 
+from mcomix import listing_cache
 from mcomix import log
 from mcomix import process
+from mcomix import tools
 from mcomix.archive import archive_base
 
 from distutils.version import LooseVersion
+import collections
 import math
+import multiprocessing
 import os
 import re
+import threading
+
+try:
+    import fitz
+except ImportError:
+    fitz = None
 
 # Default DPI for rendering.
 PDF_RENDER_DPI_DEF = 72 * 4
@@ -21,20 +31,110 @@ _mutool_exec = None
 _mudraw_exec = None
 _mudraw_trace_args = None
 
+_fill_image_regex = re.compile(r'^\s*<fill_image\b.*\bmatrix="(?P<matrix>[^"]+)".*\bwidth="(?P<width>\d+)".*\bheight="(?P<height>\d+)".*/>\s*$')
+
+def _get_render_dpi(images):
+    """ Return the resolution a page should be rendered at, so that its
+    biggest image is rendered at its original size. <images> is a sequence
+    of (width, height, matrix) tuples, one for each image drawn on the
+    page, with <matrix> the transformation applied to it. """
+    max_size = 0
+    max_dpi = PDF_RENDER_DPI_DEF
+    for width, height, matrix in images:
+        for size, coeff1, coeff2 in (
+            (width, matrix[0], matrix[1]),
+            (height, matrix[2], matrix[3]),
+        ):
+            if size < max_size:
+                continue
+            render_size = math.sqrt(coeff1 * coeff1 + coeff2 * coeff2)
+            if 0 == render_size:
+                continue
+            dpi = int(size * 72 / render_size)
+            if dpi > PDF_RENDER_DPI_MAX:
+                dpi = PDF_RENDER_DPI_MAX
+            max_size = size
+            max_dpi = dpi
+    return max_dpi
+
+def _render_page(document, page_num, dpi, path):
+    """ Render the page <page_num> of <document> to <path>, at <dpi>, or
+    at the resolution returned by _get_render_dpi() if <dpi> is None.
+    Return the resolution used. """
+    page = document[page_num - 1]
+    if dpi is None:
+        dpi = _get_render_dpi([(info['width'], info['height'], info['transform'])
+                               for info in page.get_image_info()])
+    zoom = dpi / 72.0
+    page.get_pixmap(matrix=fitz.Matrix(zoom, zoom)).save(path)
+    return dpi
+
+# Pool of render processes shared by all documents, see _get_pool().
+_pool = None
+_pool_lock = threading.Lock()
+
+# Number of documents kept open by each render process.
+_WORKER_MAX_DOCUMENTS = 4
+# Documents kept open by each render process: path > document.
+_worker_documents = collections.OrderedDict()
+
+def _get_pool():
+    """ Return the pool of render processes, one per processor. Processes
+    are spawned instead of forked: forking a multi-threaded GTK process
+    could deadlock. """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            context = multiprocessing.get_context('spawn')
+            _pool = context.Pool(tools.cpu_count())
+        return _pool
+
+def _worker_render(args):
+    """ Render a page in a render process, see _render_page(). The last
+    documents used are kept open. """
+    document_path, page_num, dpi, path = args
+    document = _worker_documents.pop(document_path, None)
+    if document is None:
+        document = fitz.open(document_path)
+        while len(_worker_documents) >= _WORKER_MAX_DOCUMENTS:
+            _worker_documents.popitem(last=False)[1].close()
+    _worker_documents[document_path] = document
+    return _render_page(document, page_num, dpi, path)
+
 class PdfArchive(archive_base.BaseArchive):
 
     """ Concurrent calls to extract welcome! """
     support_concurrent_extractions = True
 
-    _fill_image_regex = re.compile(r'^\s*<fill_image\b.*\bmatrix="(?P<matrix>[^"]+)".*\bwidth="(?P<width>\d+)".*\bheight="(?P<height>\d+)".*/>\s*$')
+    # Pages are rendered by a pool of one process per processor.
+    max_concurrent_extractions = tools.cpu_count()
+
+    # Rendering a page is much slower than reading it back from disk.
+    expensive_extraction = True
 
     def __init__(self, archive):
         super(PdfArchive, self).__init__(archive)
+        # Document opened to render single pages in-process, only with
+        # PyMuPDF (see _render).
+        self._document = None
+        self._document_lock = threading.Lock()
+        # Resolution each page should be rendered at, by page number.
+        self._dpi = None
+        self._dpi_changed = False
+        self._dpi_lock = threading.Lock()
+        self._stat = None
 
     def iter_contents(self):
+        if fitz is not None:
+            with fitz.open(self.archive) as document:
+                page_count = document.page_count
+            for page_num in range(1, page_count + 1):
+                yield '%u.png' % page_num
+            return
         proc = process.popen(_mutool_exec + ['show', '--', self.archive, 'pages'])
         try:
             for line in proc.stdout:
+                line = line.decode('utf-8', 'replace')
                 if line.startswith('page '):
                     yield line.split()[1] + '.png'
         finally:
@@ -43,39 +143,114 @@ class PdfArchive(archive_base.BaseArchive):
 
     def extract(self, filename, destination_dir):
         self._create_directory(destination_dir)
-        destination_path = os.path.join(destination_dir, filename)
         page_num = int(filename[0:-4])
-        # Try to find optimal DPI.
-        cmd = _mudraw_exec + _mudraw_trace_args + ['--', self.archive, str(page_num)]
-        log.debug('finding optimal DPI for %s: %s', filename, ' '.join(cmd))
+        list(self._render([page_num], destination_dir))
+
+    def iter_extract(self, entries, destination_dir):
+        """ Render pages in batches, instead of one by one. """
+        self._create_directory(destination_dir)
+        pages = sorted(int(filename[0:-4]) for filename in entries)
+        for page_num in self._render(pages, destination_dir):
+            yield '%u.png' % page_num
+
+    def close(self):
+        with self._document_lock:
+            if self._document is not None:
+                self._document.close()
+                self._document = None
+        with self._dpi_lock:
+            if self._dpi_changed:
+                listing_cache.get_listing_cache().put_render_dpi(
+                    self.archive, self._stat[0], self._stat[1], self._dpi)
+                self._dpi_changed = False
+
+    def _render(self, pages, destination_dir):
+        """ Render <pages> (a sorted list of page numbers) to
+        <destination_dir>, yielding each page number once rendered. """
+        dpi = self._get_dpi()
+        if fitz is not None:
+            tasks = [(self.archive, page_num, dpi.get(page_num),
+                      os.path.join(destination_dir, '%u.png' % page_num))
+                     for page_num in pages]
+            if 1 == len(tasks):
+                # Not worth the round trip to a render process
+                # (e.g. a cover for a thumbnail).
+                with self._document_lock:
+                    if self._document is None:
+                        self._document = fitz.open(self.archive)
+                    results = [_render_page(self._document, *tasks[0][1:])]
+            else:
+                results = _get_pool().imap(_worker_render, tasks)
+            for task, page_dpi in zip(tasks, results):
+                self._set_dpi({task[1]: page_dpi})
+                yield task[1]
+            return
+        missing = [page_num for page_num in pages if page_num not in dpi]
+        if len(missing) > 0:
+            dpi = self._set_dpi(self._probe_dpi(missing))
+        # One invocation per resolution, with the
+        # pages to render at this resolution.
+        batches = {}
+        for page_num in pages:
+            batches.setdefault(dpi[page_num], []).append(page_num)
+        output = os.path.join(destination_dir.replace('%', '%%'), '%d.png')
+        for page_dpi, batch in sorted(batches.items()):
+            cmd = _mudraw_exec + ['-r', str(page_dpi), '-o', output, '--',
+                                  self.archive, ','.join(map(str, batch))]
+            log.debug('rendering %s', ' '.join(cmd))
+            process.call(cmd)
+            for page_num in batch:
+                yield page_num
+
+    def _probe_dpi(self, pages):
+        """ Find the resolution <pages> should be rendered at with a single
+        mudraw trace invocation. Return a dictionary mapping page numbers
+        to resolutions. """
+        cmd = _mudraw_exec + _mudraw_trace_args + ['--', self.archive,
+                                                   ','.join(map(str, pages))]
+        log.debug('finding optimal DPI: %s', ' '.join(cmd))
+        images = dict((page_num, []) for page_num in pages)
         proc = process.popen(cmd)
         try:
-            max_size = 0
-            max_dpi = PDF_RENDER_DPI_DEF
+            # Pages are traced in the requested order.
+            current = None
+            remaining = iter(pages)
             for line in proc.stdout:
-                match = self._fill_image_regex.match(line)
-                if not match:
+                line = line.decode('utf-8', 'replace')
+                if line.lstrip().startswith('<page '):
+                    current = next(remaining, None)
+                    continue
+                match = _fill_image_regex.match(line)
+                if not match or current is None:
                     continue
                 matrix = [float(f) for f in match.group('matrix').split()]
-                for size, coeff1, coeff2 in (
-                    (int(match.group('width')), matrix[0], matrix[1]),
-                    (int(match.group('height')), matrix[2], matrix[3]),
-                ):
-                    if size < max_size:
-                        continue
-                    render_size = math.sqrt(coeff1 * coeff1 + coeff2 * coeff2)
-                    dpi = int(size * 72 / render_size)
-                    if dpi > PDF_RENDER_DPI_MAX:
-                        dpi = PDF_RENDER_DPI_MAX
-                    max_size = size
-                    max_dpi = dpi
+                images[current].append((int(match.group('width')),
+                                        int(match.group('height')),
+                                        matrix))
         finally:
             proc.stdout.close()
             proc.wait()
-        # Render...
-        cmd = _mudraw_exec + ['-r', str(max_dpi), '-o', destination_path, '--', self.archive, str(page_num)]
-        log.debug('rendering %s: %s', filename, ' '.join(cmd))
-        process.call(cmd)
+        return dict((page_num, _get_render_dpi(page_images))
+                    for page_num, page_images in images.items())
+
+    def _get_dpi(self):
+        """ Return the dictionary of known page resolutions, loaded from
+        the listing cache on first call. """
+        with self._dpi_lock:
+            if self._dpi is None:
+                stat = os.stat(self.archive)
+                self._stat = (stat.st_mtime, stat.st_size)
+                self._dpi = listing_cache.get_listing_cache().get_render_dpi(
+                    self.archive, *self._stat) or {}
+            return dict(self._dpi)
+
+    def _set_dpi(self, dpi):
+        """ Record the page resolutions in <dpi>, they will be saved to the
+        listing cache on close. Return the updated dictionary. """
+        with self._dpi_lock:
+            self._dpi.update(dpi)
+            self._dpi_changed = True
+            return dict(self._dpi)
 
     @staticmethod
     def is_available():
@@ -83,6 +258,11 @@ class PdfArchive(archive_base.BaseArchive):
         if _pdf_possible is not None:
             return _pdf_possible
         global _mutool_exec, _mudraw_exec, _mudraw_trace_args
+        if fitz is not None:
+            # Rendering is done with PyMuPDF, in long-lived processes.
+            log.info('Using PyMuPDF version: %s', fitz.VersionBind)
+            _pdf_possible = True
+            return _pdf_possible
         mutool = process.find_executable((u'mutool',))
         _pdf_possible = False
         version = None
@@ -97,7 +277,7 @@ class PdfArchive(archive_base.BaseArchive):
                                  stdout=process.NULL,
                                  stderr=process.PIPE)
             try:
-                output = proc.stderr.read()
+                output = proc.stderr.read().decode('utf-8', 'replace')
                 if output.startswith('mutool version '):
                     version = output[15:].rstrip()
             finally:
@@ -4,11 +4,14 @@
 resort to calling rar/unrar manually. """
 
 import sys, os
+import collections
+import threading
 import ctypes, ctypes.util
 
 from mcomix import constants
 from mcomix.archive import archive_base
 from mcomix import log
+from mcomix import tools
 
 if sys.platform == 'win32':
     UNRARCALLBACK = ctypes.WINFUNCTYPE(ctypes.c_int, ctypes.c_uint,
@@ -21,8 +24,16 @@ class RarArchive(archive_base.BaseArchive):
     """ Wrapper class for libunrar. All string values passed to this class must be unicode objects.
     In turn, all values returned are also unicode. """
 
-    # Nope! Not a good idea...
-    support_concurrent_extractions = False
+    # Only for non-solid archives: each extraction uses its own handle.
+    support_concurrent_extractions = True
+
+    # Also the number of idle handles kept open, see _release_handle().
+    max_concurrent_extractions = tools.cpu_count()
+
+    # Handles can only skip forward to the member to extract.
+    prefer_archive_order = True
+
+    support_in_memory_extraction = True
 
     class _OpenMode(object):
         """ Rar open mode """
@@ -32,6 +43,7 @@ class RarArchive(archive_base.BaseArchive):
     class _ProcessingMode(object):
         """ Rar file processing mode """
         RAR_SKIP       = 0
+        RAR_TEST       = 1
         RAR_EXTRACT    = 2
 
     class _ErrorCode(object):
@@ -100,12 +112,17 @@ class RarArchive(archive_base.BaseArchive):
         """ Initialize Unrar.dll. """
         super(RarArchive, self).__init__(archive)
         self._unrar = _get_unrar_dll()
-        self._handle = None
-        self._callback_function = None
         self._is_solid = False
-        # Information about the current file will be stored in this structure
-        self._headerdata = RarArchive._RARHeaderDataEx()
-        self._current_filename = None
+        # Sequential handle, used for listing and for solid archives.
+        self._handle = _RarHandle(self)
+        # Index of each entry in the archive, filled by iter_contents.
+        self._entries = {}
+        # Idle handles, used for random access to non-solid archives.
+        self._idle_handles = []
+        # Index of the last requested entries, to choose the handles to keep.
+        self._recent_indexes = collections.deque(
+            maxlen=self.max_concurrent_extractions)
+        self._handles_lock = threading.Lock()
 
         # Set up function prototypes.
         # Mandatory since pointers get truncated on x64 otherwise!
@@ -128,45 +145,153 @@ class RarArchive(archive_base.BaseArchive):
         return self._is_solid
 
     def iter_contents(self):
-        """ List archive contents. """
-        self._close()
-        self._open()
+        """ List archive contents. The index of each entry is recorded,
+        so it can later be reached directly, see _process_entry(). """
+        handle = self._handle
+        handle.close()
+        entries = {}
         try:
+            handle.open()
+            if handle.is_solid:
+                self._is_solid = True
             while True:
-                self._read_header()
-                if 0 != (0x10 & self._headerdata.Flags):
+                handle.read_header()
+                if 0 != (0x10 & handle.headerdata.Flags):
                     self._is_solid = True
-                filename = self._current_filename
+                filename = handle.current_filename
+                # Keep the first entry for duplicated names,
+                # like a sequential search would.
+                entries.setdefault(filename, handle.position - 1)
                 yield filename
                 # Skip to the next entry if we're still on the same name
                 # (extract may have been called by iter_extract).
-                if filename == self._current_filename:
-                    self._process()
+                if filename == handle.current_filename:
+                    handle.process()
         except UnrarException as exc:
             log.error('Error while listing contents: %s', str(exc))
         except EOFError:
             # End of archive reached.
             pass
         finally:
-            self._close()
+            handle.close()
+            # Even partial, the index is correct for the listed entries.
+            self._entries.update(entries)
 
     def extract(self, filename, destination_dir):
         """ Extract <filename> from the archive to <destination_dir>. """
-        if not self._handle:
-            self._open()
+        dest = ctypes.c_wchar_p(os.path.join(destination_dir, filename))
+        self._process_entry(filename, dest)
+
+    def read(self, filename):
+        """ Read <filename> from the archive to memory. The entry is
+        processed in test mode, and its data collected by the
+        UCM_PROCESSDATA callback. """
+        return self._process_entry(filename)
+
+    def _process_entry(self, filename, dest=None):
+        """ Extract the entry <filename> to <dest>, or read it to memory and
+        return its data if <dest> is None.
+
+        For non-solid archives already listed, a handle positioned before
+        the entry is taken from the pool (or a new one opened), and headers
+        are skipped up to the entry's index without being decompressed.
+        Each handle being independent, calls can be made concurrently.
+        Otherwise, the sequential handle is used. """
+        index = self._entries.get(filename)
+        if self._is_solid or index is None:
+            return self._find_and_process(self._handle, filename, dest)
+        handle = self._acquire_handle(index)
+        try:
+            while handle.position < index:
+                handle.read_header()
+                handle.process()
+            handle.read_header()
+            if handle.current_filename != filename:
+                raise UnrarException('Entry not found: %s' % filename)
+            data = self._process_current(handle, dest)
+        except:
+            handle.close()
+            raise
+        self._release_handle(handle)
+        return data
+
+    def _acquire_handle(self, index):
+        """ Return an idle handle positioned the closest before the entry at
+        <index>. If all the idle handles are past the entry, one of them is
+        rewound when the pool is full, otherwise a new handle is opened. """
+        with self._handles_lock:
+            self._recent_indexes.append(index)
+            best = None
+            for handle in self._idle_handles:
+                if handle.position > index:
+                    continue
+                if best is None or handle.position > best.position:
+                    best = handle
+            if best is not None:
+                self._idle_handles.remove(best)
+                return best
+            if len(self._idle_handles) < self.max_concurrent_extractions:
+                handle = _RarHandle(self)
+            else:
+                handle = self._get_least_useful_handle()
+                self._idle_handles.remove(handle)
+        # Opening an already open handle rewinds it to the first entry.
+        handle.open()
+        return handle
+
+    def _release_handle(self, handle):
+        """ Return <handle> to the pool of idle handles. If the pool is
+        full, the handle positioned the furthest from the recently requested
+        entries is closed. """
+        if not handle.is_open:
+            return
+        with self._handles_lock:
+            self._idle_handles.append(handle)
+            if len(self._idle_handles) <= self.max_concurrent_extractions:
+                return
+            handle = self._get_least_useful_handle()
+            self._idle_handles.remove(handle)
+        handle.close()
+
+    def _get_least_useful_handle(self):
+        """ Return the idle handle the furthest from the recently requested
+        entries. Must be called with the handles lock held. """
+        def get_distance(handle):
+            return min(abs(index - handle.position)
+                       for index in self._recent_indexes)
+        return max(self._idle_handles, key=get_distance)
+
+    def _process_current(self, handle, dest=None):
+        """ Extract the current entry of <handle> to <dest>, or read it to
+        memory and return its data if <dest> is None. """
+        if dest is not None:
+            handle.process(dest)
+            return None
+        handle.read_buffer = []
+        try:
+            handle.process(mode=RarArchive._ProcessingMode.RAR_TEST)
+            return b''.join(handle.read_buffer)
+        finally:
+            handle.read_buffer = None
+
+    def _find_and_process(self, handle, filename, dest=None):
+        """ Move <handle> to the entry <filename>, and extract it to <dest>,
+        or read it to memory and return its data if <dest> is None.
+        The handle is left open, pointing to the next entry, which speeds
+        up sequential reads; close() frees it. """
+        if not handle.is_open:
+            handle.open()
         looped = False
         while True:
             # Check if the current entry matches the requested file.
-            if self._current_filename is not None:
-                if (self._current_filename == filename):
+            if handle.current_filename is not None:
+                if (handle.current_filename == filename):
                     # It's the entry we're looking for, extract it.
-                    dest = ctypes.c_wchar_p(os.path.join(destination_dir, filename))
-                    self._process(dest)
-                    break
+                    return self._process_current(handle, dest)
                 # Not the right entry, skip it.
-                self._process()
+                handle.process()
             try:
-                self._read_header()
+                handle.read_header()
             except EOFError:
                 # Archive end was reached, this might be due to out-of-order
                 # extraction while the handle was still open.  Close the
@@ -176,19 +301,57 @@ class RarArchive(archive_base.BaseArchive):
                 # archive.
                 if looped:
                     break
-                self._open()
-        # After the method returns, the RAR handler is still open and pointing
-        # to the next archive file. This will improve extraction speed for sequential file reads.
-        # After all files have been extracted, close() should be called to free the handler resources.
+                looped = True
+                handle.open()
+        raise UnrarException('Entry not found: %s' % filename)
 
     def close(self):
-        """ Close the archive handle """
-        self._close()
+        """ Close the archive handles """
+        self._handle.close()
+        with self._handles_lock:
+            handles = self._idle_handles
+            self._idle_handles = []
+        for handle in handles:
+            handle.close()
+
+    def _password_callback(self, msg, userdata, buffer_address, buffer_size):
+        """ Called by the unrar library in case of missing password. """
+        self._get_password()
+        if len(self._password) == 0:
+            # Abort extraction
+            return -1
+        password = ctypes.create_string_buffer(self._password)
+        copy_size = min(buffer_size, len(password))
+        ctypes.memmove(buffer_address, password, copy_size)
+        return 0
+
+class _RarHandle(object):
+    """ An open libunrar handle, and the index of the next entry header it
+    will read. Handles are not thread safe, but several handles can be used
+    concurrently on the same archive. """
 
-    def _open(self):
+    def __init__(self, archive):
+        self._archive = archive
+        self._unrar = archive._unrar
+        self._handle = None
+        self._callback_function = None
+        # Information about the current file will be stored in this structure
+        self.headerdata = RarArchive._RARHeaderDataEx()
+        self.current_filename = None
+        self.position = 0
+        self.is_solid = False
+        # Chunks of the entry being read to memory, see _process_current().
+        self.read_buffer = None
+
+    @property
+    def is_open(self):
+        return self._handle is not None
+
+    def open(self):
         """ Open rar handle for extraction. """
-        self._callback_function = UNRARCALLBACK(self._password_callback)
-        archivedata = RarArchive._RAROpenArchiveDataEx(ArcNameW=self.archive,
+        self.close()
+        self._callback_function = UNRARCALLBACK(self._callback)
+        archivedata = RarArchive._RAROpenArchiveDataEx(ArcNameW=self._archive.archive,
                                                        OpenMode=RarArchive._OpenMode.RAR_OM_EXTRACT,
                                                        Callback=self._callback_function,
                                                        UserData=0)
@@ -199,12 +362,16 @@ class RarArchive(archive_base.BaseArchive):
             raise UnrarException("Couldn't open archive: %s" % errormessage)
         self._unrar.RARSetCallback(handle, self._callback_function, 0)
         self._handle = handle
+        self.current_filename = None
+        self.position = 0
+        # ROADF_SOLID
+        self.is_solid = 0 != (0x0008 & archivedata.Flags)
 
     def _check_errorcode(self, errorcode):
         if 0 == errorcode:
             # No error.
             return
-        self._close()
+        self.close()
         if RarArchive._ErrorCode.ERAR_END_ARCHIVE == errorcode:
             # End of archive reached.
             exc = EOFError()
@@ -213,43 +380,44 @@ class RarArchive(archive_base.BaseArchive):
             exc = UnrarException(errormessage)
         raise exc
 
-    def _read_header(self):
-        self._current_filename = None
-        errorcode = self._unrar.RARReadHeaderEx(self._handle, ctypes.byref(self._headerdata))
+    def read_header(self):
+        self.current_filename = None
+        errorcode = self._unrar.RARReadHeaderEx(self._handle, ctypes.byref(self.headerdata))
         self._check_errorcode(errorcode)
-        self._current_filename = self._headerdata.FileNameW
-
-    def _process(self, dest=None):
-        """ Process current entry: extract or skip it. """
-        if dest is None:
-            mode = RarArchive._ProcessingMode.RAR_SKIP
-        else:
-            mode = RarArchive._ProcessingMode.RAR_EXTRACT
+        self.current_filename = self.headerdata.FileNameW
+        self.position += 1
+
+    def process(self, dest=None, mode=None):
+        """ Process current entry: extract, test or skip it. """
+        if mode is None:
+            if dest is None:
+                mode = RarArchive._ProcessingMode.RAR_SKIP
+            else:
+                mode = RarArchive._ProcessingMode.RAR_EXTRACT
         errorcode = self._unrar.RARProcessFileW(self._handle, mode, None, dest)
-        self._current_filename = None
+        self.current_filename = None
         self._check_errorcode(errorcode)
 
-    def _close(self):
+    def close(self):
         """ Close the rar handle previously obtained by open. """
         if self._handle is None:
             return
         errorcode = self._unrar.RARCloseArchive(self._handle)
+        self._handle = None
+        self.current_filename = None
         if errorcode != 0:
             errormessage = UnrarException.get_error_message(errorcode)
             raise UnrarException("Couldn't close archive: %s" % errormessage)
-        self._handle = None
 
-    def _password_callback(self, msg, userdata, buffer_address, buffer_size):
-        """ Called by the unrar library in case of missing password. """
-        if msg == 2: # UCM_NEEDPASSWORD
-            self._get_password()
-            if len(self._password) == 0:
-                # Abort extraction
-                return -1
-            password = ctypes.create_string_buffer(self._password)
-            copy_size = min(buffer_size, len(password))
-            ctypes.memmove(buffer_address, password, copy_size)
-            return 0
+    def _callback(self, msg, userdata, buffer_address, buffer_size):
+        """ Called by the unrar library in case of missing password,
+        or with unpacked data when reading an entry to memory. """
+        if msg == 1 and self.read_buffer is not None: # UCM_PROCESSDATA
+            self.read_buffer.append(ctypes.string_at(buffer_address, buffer_size))
+            return 1
+        elif msg == 2: # UCM_NEEDPASSWORD
+            return self._archive._password_callback(msg, userdata,
+                                                    buffer_address, buffer_size)
         else:
             # Continue operation
             return 1
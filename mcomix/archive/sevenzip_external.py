@@ -17,6 +17,8 @@ class SevenZipArchive(archive_base.ExternalExecutableArchive):
 
     STATE_HEADER, STATE_LISTING, STATE_FOOTER = 1, 2, 3
 
+    support_in_memory_extraction = True
+
     class EncryptedHeader(Exception):
         pass
 
@@ -129,6 +131,20 @@ class SevenZipArchive(archive_base.ExternalExecutableArchive):
 
         self.filenames_initialized = True
 
+    def _create_list_file(self, filename):
+        """ Create a temporary file listing <filename>, for use with
+        the -i@ switch. The caller is responsible for removing it. """
+        tmplistfile = tempfile.NamedTemporaryFile(prefix='mcomix.7z.', delete=False)
+        try:
+            desired_filename = self._original_filename(filename)
+            if isinstance(desired_filename, unicode):
+                desired_filename = desired_filename.encode('utf-8')
+
+            tmplistfile.write(desired_filename + os.linesep)
+        finally:
+            tmplistfile.close()
+        return tmplistfile.name
+
     def extract(self, filename, destination_dir):
         """ Extract <filename> from the archive to <destination_dir>. """
         assert isinstance(filename, unicode) and \
@@ -140,25 +156,45 @@ class SevenZipArchive(archive_base.ExternalExecutableArchive):
         if not self.filenames_initialized:
             self.list_contents()
 
-        tmplistfile = tempfile.NamedTemporaryFile(prefix='mcomix.7z.', delete=False)
+        list_file = self._create_list_file(filename)
         try:
-            desired_filename = self._original_filename(filename)
-            if isinstance(desired_filename, unicode):
-                desired_filename = desired_filename.encode('utf-8')
-
-            tmplistfile.write(desired_filename + os.linesep)
-            tmplistfile.close()
-
             output = self._create_file(os.path.join(destination_dir, filename))
             try:
-                process.call(self._get_extract_arguments(list_file=tmplistfile.name),
+                process.call(self._get_extract_arguments(list_file=list_file),
                              stdout=output)
             finally:
                 output.close()
         finally:
-            os.unlink(tmplistfile.name)
+            os.unlink(list_file)
+
+    def read(self, filename):
+        """ Read <filename> from the archive to memory. """
+
+        if not self._get_executable():
+            return None
+
+        if not self.filenames_initialized:
+            self.list_contents()
+
+        list_file = self._create_list_file(filename)
+        try:
+            proc = process.popen(self._get_extract_arguments(list_file=list_file))
+            try:
+                return proc.stdout.read()
+            finally:
+                proc.stdout.close()
+                proc.wait()
+        finally:
+            os.unlink(list_file)
 
     def iter_extract(self, entries, destination_dir):
+        for unicode_name, data in self.iter_read(entries):
+            new = self._create_file(os.path.join(destination_dir, unicode_name))
+            new.write(data)
+            new.close()
+            yield unicode_name
+
+    def iter_read(self, entries):
 
         if not self._get_executable():
             return
@@ -178,10 +214,7 @@ class SevenZipArchive(archive_base.ExternalExecutableArchive):
                 unicode_name = wanted.get(filename, None)
                 if unicode_name is None:
                     continue
-                new = self._create_file(os.path.join(destination_dir, unicode_name))
-                new.write(data)
-                new.close()
-                yield unicode_name
+                yield unicode_name, data
                 del wanted[filename]
                 if 0 == len(wanted):
                     break
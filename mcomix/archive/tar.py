@@ -7,6 +7,9 @@ import tarfile
 from mcomix.archive import archive_base
 
 class TarArchive(archive_base.NonUnicodeArchive):
+
+    support_in_memory_extraction = True
+
     def __init__(self, archive):
         super(TarArchive, self).__init__(archive)
         # Track if archive contents have been listed at least one time: this
@@ -38,13 +41,19 @@ class TarArchive(archive_base.NonUnicodeArchive):
     def list_contents(self):
         return [f for f in self.iter_contents()]
 
-    def extract(self, filename, destination_dir):
+    def read(self, filename):
         if not self._contents_listed:
             self.list_contents()
-        new = self._create_file(os.path.join(destination_dir, filename))
         file_object = self.tar.extractfile(self._original_filename(filename))
-        new.write(file_object.read())
-        file_object.close()
+        try:
+            return file_object.read()
+        finally:
+            file_object.close()
+
+    def extract(self, filename, destination_dir):
+        content = self.read(filename)
+        new = self._create_file(os.path.join(destination_dir, filename))
+        new.write(content)
         new.close()
 
     def iter_extract(self, entries, destination_dir):
@@ -53,6 +62,12 @@ class TarArchive(archive_base.NonUnicodeArchive):
         for f in super(TarArchive, self).iter_extract(entries, destination_dir):
             yield f
 
+    def iter_read(self, entries):
+        if not self._contents_listed:
+            self.list_contents()
+        for f, data in super(TarArchive, self).iter_read(entries):
+            yield f, data
+
     def close(self):
         if self.tar is not None:
             self.tar.close()
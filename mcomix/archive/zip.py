@@ -16,6 +16,7 @@ import zipfile
 
 def is_py_supported_zipfile(path):
     """Check if a given zipfile has all internal files stored with Python supported compression
+    <path> can also be an open file object.
     """
     # Use contextlib's closing for 2.5 compatibility
     with closing(zipfile.ZipFile(path, 'r')) as zip_file:
@@ -25,6 +26,9 @@ def is_py_supported_zipfile(path):
     return True
 
 class ZipArchive(archive_base.NonUnicodeArchive):
+
+    support_in_memory_extraction = True
+
     def __init__(self, archive):
         super(ZipArchive, self).__init__(archive)
         self.zip = zipfile.ZipFile(archive, 'r')
@@ -41,11 +45,8 @@ class ZipArchive(archive_base.NonUnicodeArchive):
         for filename in self.zip.namelist():
             yield self._unicode_filename(filename)
 
-    def extract(self, filename, destination_dir):
-        new = self._create_file(os.path.join(destination_dir, filename))
+    def read(self, filename):
         content = self.zip.read(self._original_filename(filename))
-        new.write(content)
-        new.close()
 
         zipinfo = self.zip.getinfo(self._original_filename(filename))
         if len(content) != zipinfo.file_size:
@@ -55,7 +56,13 @@ class ZipArchive(archive_base.NonUnicodeArchive):
                 { 'filename' : filename, 'actual_size' : len(content),
                   'expected_size' : zipinfo.file_size })
 
+        return content
 
+    def extract(self, filename, destination_dir):
+        content = self.read(filename)
+        new = self._create_file(os.path.join(destination_dir, filename))
+        new.write(content)
+        new.close()
 
     def close(self):
         self.zip.close()
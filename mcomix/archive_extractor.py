@@ -1,13 +1,18 @@
 """archive_extractor.py - Archive extraction class."""
 from __future__ import with_statement
 
+import contextlib
+import errno
 import os
 import threading
 import traceback
 
 from mcomix import archive_tools
 from mcomix import callback
+from mcomix import listing_cache
 from mcomix import log
+from mcomix import page_cache
+from mcomix import tracing
 from mcomix.preferences import prefs
 from mcomix.worker_thread import WorkerThread
 
@@ -23,6 +28,23 @@ class Extractor(object):
     signal is sent on a condition after each extraction, so that it is possible
     for other threads to wait on specific files to be ready.
 
+    Files are extracted in the order they were set, or in archive order
+    if the archive format prefers it (see prefer_archive_order), except
+    for the files asked for with prioritize(), which are extracted first.
+
+    For formats that support it, files are extracted to memory instead of
+    the destination directory, as long as the total size of the extracted
+    data stays below the 'max extraction memory' preference. Use
+    get_data() to access those, and write_file() if a file is really
+    needed on disk.
+
+    Files that are expensive to extract again (from solid archives, or
+    formats with expensive_extraction set) are also stored in the
+    persistent page cache, if enabled, by a background thread once they are
+    reported as extracted. Files already in the cache are marked as
+    extracted as soon as the archive contents are listed, and are read from
+    the cache instead of the archive.
+
     Note: Support for gzip/bzip2 compressed tar archives is limited, see
     set_files() for more info.
     """
@@ -37,8 +59,36 @@ class Extractor(object):
         """
         self._src = src
         self._dst = dst
+        self._type = type
         self._files = []
         self._extracted = set()
+        #: Position of each file in the archive.
+        self._archive_order = {}
+        #: Extraction order of the files not asked for: name > position.
+        self._order = {}
+        #: Priority of the files asked for with prioritize(): name > priority.
+        self._wanted = {}
+        self._prioritize_count = 0
+        #: Files extracted to memory: name > data.
+        self._data = {}
+        self._data_size = 0
+        self._max_data_size = prefs['max extraction memory'] * 1024 * 1024
+        #: Persistent page cache, and key of the archive in it.
+        self._cache = page_cache.get_page_cache()
+        self._cache_key = None
+        if self._cache is not None:
+            self._cache_key = self._cache.get_archive_key(src)
+            if self._cache_key is None:
+                self._cache = None
+        #: Files available from the page cache.
+        self._cached = set()
+        if self._cache is not None:
+            self._cache_thread = WorkerThread(self._write_to_cache,
+                                              name='page cache',
+                                              unique_orders=True)
+        #: Serialises access to archives that do not support concurrent
+        #: extractions (see _lock_archive).
+        self._archive_lock = threading.Lock()
         self._archive = archive_tools.get_recursive_archive_handler(src, dst, type=type)
         if self._archive is None:
             msg = ('Non-supported archive format: %s') % os.path.basename(src)
@@ -88,9 +138,42 @@ class Extractor(object):
             if not self._files:
                 # Nothing to do!
                 return
+            if self._archive.prefer_archive_order:
+                self._order = self._archive_order
+            else:
+                self._order = dict((name, position) for position, name
+                                   in enumerate(self._files))
             if self._extract_started:
                 self.extract()
 
+    def prioritize(self, files):
+        """Ask for <files> to be extracted first, in this order (e.g. the
+        pages around the current page, by decreasing priority). Files
+        asked for by previous calls come next, before all other files.
+
+        Only the priority of <files> is updated, so the cost of a call
+        does not depend on the number of files in the archive.
+        """
+        with self._condition:
+            if not self._contents_listed:
+                return
+            self._prioritize_count += 1
+            reprioritize = self._extract_started and not self._archive.is_solid()
+            for rank, name in enumerate(files):
+                if name in self._extracted:
+                    continue
+                priority = (0, -self._prioritize_count, rank)
+                self._wanted[name] = priority
+                if reprioritize:
+                    self._extract_thread.reprioritize_order(name, priority)
+
+    def _get_priority(self, name):
+        """Return the extraction priority of <name> (lowest first)."""
+        priority = self._wanted.get(name)
+        if priority is None:
+            priority = (1, self._order.get(name, 0))
+        return priority
+
     def is_ready(self, name):
         """Return True if the file <name> in the extractor's file list
         (as set by set_files()) is fully extracted.
@@ -98,12 +181,55 @@ class Extractor(object):
         with self._condition:
             return name in self._extracted
 
+    def get_data(self, name):
+        """Return the content of the file <name> if it has been extracted
+        to memory, or None if it is not extracted (yet), or extracted to
+        disk.
+        """
+        with self._condition:
+            data = self._data.get(name)
+            if data is not None or name not in self._cached:
+                return data
+        data = self._cache.read(self._cache_key, name)
+        if data is None:
+            # Evicted since the archive was opened: read it again.
+            log.debug(u'Page cache miss, reading from "%s": "%s"', self._src, name)
+            if self._archive.support_in_memory_extraction:
+                with self._lock_archive():
+                    data = self._archive.read(name)
+            else:
+                with self._lock_archive():
+                    self._archive.extract(name, self._dst)
+                with self._condition:
+                    self._cached.discard(name)
+        return data
+
+    def write_file(self, name):
+        """Make sure the file <name>, if extracted to memory, is also
+        available on disk. Return the path to the file on disk.
+        """
+        with self._condition:
+            data = self._data.pop(name, None)
+            if data is not None:
+                self._write_data(name, data)
+                self._data_size -= len(data)
+            cached = name in self._cached
+        if cached:
+            data = self.get_data(name)
+            if data is not None:
+                self._write_data(name, data)
+            with self._condition:
+                self._cached.discard(name)
+        return os.path.join(self._dst, name)
+
     def stop(self):
         """Signal the extractor to stop extracting and kill the extracting
         thread. Blocks until the extracting thread has terminated.
         """
         if self._setupped:
             self._list_thread.stop()
+            if self._cache is not None:
+                self._cache_thread.stop()
             if self._extract_started:
                 self._extract_thread.stop()
                 self._extract_started = False
@@ -121,6 +247,9 @@ class Extractor(object):
                 if self._archive.support_concurrent_extractions \
                    and not self._archive.is_solid():
                     max_threads = prefs['max extract threads']
+                    if self._archive.max_concurrent_extractions is not None:
+                        max_threads = min(max_threads,
+                                          self._archive.max_concurrent_extractions)
                 else:
                     max_threads = 1
                 if self._archive.is_solid():
@@ -138,16 +267,19 @@ class Extractor(object):
                 # Sort files so we don't queue the same batch multiple times.
                 self._extract_thread.append_order(sorted(self._files))
             else:
-                self._extract_thread.extend_orders(self._files)
+                self._extract_thread.extend_orders(self._files,
+                                                   get_priority=self._get_priority)
 
     @callback.Callback
     def contents_listed(self, extractor, files):
         """ Called after the contents of the archive has been listed. """
         pass
 
-    @callback.Callback
-    def file_extracted(self, extractor, filename):
-        """ Called whenever a new file is extracted and ready. """
+    @callback.coalesced
+    def file_extracted(self, extractor, filenames):
+        """ Called whenever new files are extracted and ready, with the list
+        of their names. Files extracted while the main thread is busy are
+        reported in a single call. """
         pass
 
     def close(self):
@@ -157,14 +289,33 @@ class Extractor(object):
         self.stop()
         if self._archive:
             self._archive.close()
+        if self._setupped:
+            with self._condition:
+                self._data.clear()
+                self._data_size = 0
 
     def _extraction_finished(self, name):
         with self._condition:
             self._files.remove(name)
             self._extracted.add(name)
+            self._wanted.pop(name, None)
             self._condition.notifyAll()
-        self.file_extracted(self, name)
+        self.file_extracted(self, [name])
+        if self._cache is not None and (self._archive.is_solid() or
+                                        self._archive.expensive_extraction):
+            self._cache_thread.append_order(name)
 
+    def _write_to_cache(self, name):
+        """Store the extracted file <name> in the page cache."""
+        with self._condition:
+            data = self._data.get(name)
+        if data is not None:
+            self._cache.write(self._cache_key, name, data)
+        else:
+            self._cache.write_file(self._cache_key, name,
+                                   os.path.join(self._dst, name))
+
+    @tracing.traced('extract files', 'extract')
     def _extract_all_files(self, files):
 
         # With multiple extractions for each pass, some of the files might have
@@ -173,15 +324,23 @@ class Extractor(object):
             files = list(set(files) - self._extracted)
             files.sort()
 
-        ex = ""
         try:
-            log.debug(u'Extracting from "%s" to "%s": "%s"', self._src, self._dst, '", "'.join(files))
-            for f in self._archive.iter_extract(files, self._dst):
-                if self._extract_thread.must_stop():
+            with self._lock_archive():
+                if self._use_memory():
+                    log.debug(u'Reading from "%s": "%s"', self._src, '", "'.join(files))
+                    for f, data in self._archive.iter_read(files):
+                        if self._extract_thread.must_stop():
+                            return
+                        self._store_data(f, data)
+                        self._extraction_finished(f)
                     return
-                self._extraction_finished(f)
+                log.debug(u'Extracting from "%s" to "%s": "%s"', self._src, self._dst, '", "'.join(files))
+                for f in self._archive.iter_extract(files, self._dst):
+                    if self._extract_thread.must_stop():
+                        return
+                    self._extraction_finished(f)
 
-        except Exception(ex):
+        except Exception as ex:
             # Better to ignore any failed extractions (e.g. from a corrupt
             # archive) than to crash here and leave the main thread in a
             # possible infinite block. Damaged or missing files *should* be
@@ -189,18 +348,25 @@ class Extractor(object):
             log.error(('! Extraction error: %s'), ex)
             log.debug('Traceback:\n%s', traceback.format_exc())
 
+    @tracing.traced('extract file', 'extract')
     def _extract_file(self, name):
         """Extract the file named <name> to the destination directory,
         mark the file as "ready", then signal a notify() on the Condition
         returned by setup().
         """
 
-        ex = ""
         try:
-            log.debug(u'Extracting from "%s" to "%s": "%s"', self._src, self._dst, name)
-            self._archive.extract(name, self._dst)
+            if self._use_memory():
+                log.debug(u'Reading from "%s": "%s"', self._src, name)
+                with self._lock_archive():
+                    data = self._archive.read(name)
+                self._store_data(name, data)
+            else:
+                log.debug(u'Extracting from "%s" to "%s": "%s"', self._src, self._dst, name)
+                with self._lock_archive():
+                    self._archive.extract(name, self._dst)
 
-        except Exception(ex):
+        except Exception as ex:
             # Better to ignore any failed extractions (e.g. from a corrupt
             # archive) than to crash here and leave the main thread in a
             # possible infinite block. Damaged or missing files *should* be
@@ -212,16 +378,85 @@ class Extractor(object):
             return
         self._extraction_finished(name)
 
+    def _lock_archive(self):
+        """Return a context manager holding exclusive access to the archive
+        while reading from it, unless its format supports concurrent
+        extractions (get_data() may read from the archive while the
+        extraction thread does)."""
+        if self._archive.support_concurrent_extractions and \
+           not self._archive.is_solid():
+            return contextlib.nullcontext()
+        return self._archive_lock
+
+    def _use_memory(self):
+        """Return True if files should be extracted to memory."""
+        return self._archive.support_in_memory_extraction and \
+                self._max_data_size > 0
+
+    def _store_data(self, name, data):
+        """Keep the content of the file <name> in memory, or write it to
+        the destination directory if the memory budget is exhausted.
+        """
+        if data is None:
+            return
+        with self._condition:
+            if self._data_size + len(data) <= self._max_data_size:
+                self._data[name] = data
+                self._data_size += len(data)
+                return
+        self._write_data(name, data)
+
+    def _write_data(self, name, data):
+        """Write <data> to the file <name> in the destination directory."""
+        path = os.path.join(self._dst, name)
+        directory = os.path.dirname(path)
+        if not os.path.exists(directory):
+            try:
+                os.makedirs(directory)
+            except OSError as e:
+                # Can happen with concurrent calls.
+                if e.errno != errno.EEXIST:
+                    raise
+        with open(path, 'wb') as fp:
+            fp.write(data)
+
+    @tracing.traced('list contents', 'extract')
     def _list_contents(self, archive):
         files = []
         for f in archive.iter_contents():
             if self._list_thread.must_stop():
                 return
             files.append(f)
+        self._store_listing(archive, files)
+        if self._cache is not None:
+            cached = [f for f in files if self._cache.contains(self._cache_key, f)]
+        else:
+            cached = []
         with self._condition:
             self._files = files
+            self._archive_order = dict((name, position) for position, name
+                                       in enumerate(files))
+            self._extracted.update(cached)
+            self._cached.update(cached)
             self._contents_listed = True
         self.contents_listed(self, files)
+        if cached:
+            log.debug(u'Page cache: %u files of "%s" available', len(cached), self._src)
+            self.file_extracted(self, cached)
+
+    def _store_listing(self, archive, files):
+        """ Store the listing of the archive in the listing cache, for
+        archive_tools.get_archive_info(). """
+        if self._type is None:
+            return
+        try:
+            stat = os.stat(self._src)
+        except OSError:
+            return
+        listing_cache.get_listing_cache().put(os.path.abspath(self._src),
+                                              stat.st_mtime, stat.st_size,
+                                              self._type, files,
+                                              archive.is_solid())
 
 class ArchiveException(Exception):
     """ Indicate error during extraction operations. """
@@ -1,5 +1,6 @@
 """archive_tools.py - Archive tool functions."""
 
+import bz2
 import os
 import re
 import shutil
@@ -7,6 +8,7 @@ import zipfile
 import tarfile
 import tempfile
 import operator
+import zlib
 
 from mcomix import image_tools
 from mcomix import constants
@@ -118,8 +120,18 @@ def is_archive_file(path):
     """
     return _SUPPORTED_ARCHIVE_REGEX.search(path) is not None
 
+#: Number of bytes read from the start of a file to detect its format.
+_SNIFF_SIZE = 512
+
 def archive_mime_type(path):
-    """Return the archive type of <path> or None for non-archives."""
+    """Return the archive type of <path> or None for non-archives.
+
+    The format is detected from the file header, with a single read. For
+    ZIP archives, the central directory is also read (using the same file
+    object), to check whether all members use a compression supported by
+    the zipfile module. For gzip and bzip2 files, the start of the stream
+    is decompressed, to check that it is a tar archive.
+    """
     try:
 
         if os.path.isfile(path):
@@ -127,54 +139,132 @@ def archive_mime_type(path):
             if not os.access(path, os.R_OK):
                 return None
 
-            if zipfile.is_zipfile(path):
-                if zip.is_py_supported_zipfile(path):
-                    return constants.ZIP
-                else:
-                    return constants.ZIP_EXTERNAL
+            with open(path, 'rb') as fd:
+                header = fd.read(_SNIFF_SIZE)
+
+                type = _sniff_mime_type(header)
+                if type is None and zipfile.is_zipfile(fd):
+                    # E.g. self-extracting archive, with a prefix before the
+                    # first local file header.
+                    type = constants.ZIP
+                if type == constants.ZIP and not zip.is_py_supported_zipfile(fd):
+                    type = constants.ZIP_EXTERNAL
+                if type in (constants.BZIP2, constants.GZIP) and \
+                   not _is_compressed_tar(fd, type):
+                    type = None
+            return type
 
-            fd = open(path, 'rb')
-            magic = fd.read(5)
-            fd.close()
+    except Exception:
+        log.warning(('! Could not read %s'), path)
 
-            try:
-                istarfile = tarfile.is_tarfile(path)
-            except IOError:
-                # Tarfile raises an error when accessing certain network shares
-                istarfile = False
+    return None
 
-            if istarfile and os.path.getsize(path) > 0:
-                if magic.startswith('BZh'):
-                    return constants.BZIP2
-                elif magic.startswith('\037\213'):
-                    return constants.GZIP
-                else:
-                    return constants.TAR
+def _sniff_mime_type(header):
+    """Return the archive type for a file starting with <header>,
+    or None for non-archives.
+    """
+    if header[0:4] in (b'PK\x03\x04', b'PK\x05\x06', b'PK\x07\x08'):
+        return constants.ZIP
 
-            if magic[0:4] == 'Rar!':
-                return constants.RAR
+    if header.startswith(b'BZh'):
+        return constants.BZIP2
 
-            if magic[0:4] == '7z\xBC\xAF':
-                return constants.SEVENZIP
+    if header.startswith(b'\037\213'):
+        return constants.GZIP
 
-            # Headers for TAR-XZ and TAR-LZMA that aren't supported by tarfile
-            if magic[0:5] == '\xFD7zXZ' or magic[0:5] == ']\x00\x00\x80\x00':
-                return constants.XZ
+    if header[0:4] == b'Rar!':
+        return constants.RAR
 
-            if magic[2:4] == '-l':
-                return constants.LHA
+    if header[0:4] == b'7z\xBC\xAF':
+        return constants.SEVENZIP
 
-            if magic[0:4] == '%PDF':
-                return constants.PDF
+    # Headers for TAR-XZ and TAR-LZMA that aren't supported by tarfile
+    if header[0:5] == b'\xFD7zXZ' or header[0:5] == b']\x00\x00\x80\x00':
+        return constants.XZ
 
-    except Exception:
-        log.warning(('! Could not read %s'), path)
+    if header[2:4] == b'-l':
+        return constants.LHA
+
+    if header[0:4] == b'%PDF':
+        return constants.PDF
+
+    if _is_tar_header(header):
+        return constants.TAR
 
     return None
 
+def _is_tar_header(data):
+    """Return True if <data> starts with a valid tar header."""
+    if len(data) < tarfile.BLOCKSIZE:
+        return False
+    try:
+        # Validates the header checksum, like tarfile.is_tarfile().
+        tarfile.TarInfo.frombuf(data[:tarfile.BLOCKSIZE],
+                                tarfile.ENCODING, 'surrogateescape')
+        return True
+    except tarfile.TarError:
+        return False
+
+def _is_compressed_tar(fd, type):
+    """Return True if the file <fd>, compressed with <type> (BZIP2 or
+    GZIP), contains a tar archive. Only the first block of the stream is
+    decompressed (a whole bzip2 block may have to be read for that).
+    """
+    fd.seek(0)
+    data = b''
+    try:
+        if constants.BZIP2 == type:
+            decompressor = bz2.BZ2Decompressor()
+            while len(data) < tarfile.BLOCKSIZE and not decompressor.eof:
+                chunk = b''
+                if decompressor.needs_input:
+                    chunk = fd.read(_SNIFF_SIZE)
+                    if not chunk:
+                        break
+                data += decompressor.decompress(chunk,
+                                                tarfile.BLOCKSIZE - len(data))
+        else:
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            while len(data) < tarfile.BLOCKSIZE and not decompressor.eof:
+                chunk = decompressor.unconsumed_tail or fd.read(_SNIFF_SIZE)
+                if not chunk:
+                    break
+                data += decompressor.decompress(chunk,
+                                                tarfile.BLOCKSIZE - len(data))
+    except (EOFError, IOError, zlib.error):
+        return False
+    return _is_tar_header(data)
+
 def get_archive_info(path):
     """Return a tuple (mime, num_pages, size) with info about the archive
     at <path>, or None if <path> doesn't point to a supported
+    archive.
+
+    The listing of the archive is cached, so unchanged archives are not
+    opened again.
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    # XXX: Deferred import to avoid circular dependency
+    from mcomix import listing_cache
+    cache = listing_cache.get_listing_cache()
+    path = os.path.abspath(path)
+    listing = cache.get(path, stat.st_mtime, stat.st_size)
+    if listing is None:
+        listing = _list_archive(path)
+        if listing is None:
+            return None
+        cache.put(path, stat.st_mtime, stat.st_size, *listing)
+    mime, files, solid = listing
+    num_pages = len([f for f in files if image_tools.is_image_file(f)])
+    return (mime, num_pages, stat.st_size)
+
+def _list_archive(path):
+    """Return a (mime, contents, solid) tuple for the archive at <path>,
+    as stored by the listing cache, or None if <path> doesn't point to a
+    supported archive.
     """
     cleanup = []
     try:
@@ -188,14 +278,39 @@ def get_archive_info(path):
         cleanup.append(archive.close)
 
         files = archive.list_contents()
-        num_pages = len(filter(image_tools.is_image_file, files))
-        size = os.stat(path).st_size
-
-        return (mime, num_pages, size)
+        return (mime, files, archive.is_solid())
     finally:
         for fn in reversed(cleanup):
             fn()
 
+def guess_cover(files):
+    """Return the filename within <files> that is the most likely to be the
+    cover of an archive using some simple heuristics.
+    """
+    # Ignore MacOSX meta files.
+    files = [filename for filename in files
+             if u'__MACOSX' not in os.path.normpath(filename).split(os.sep)]
+    # Ignore credit files if possible.
+    files = [filename for filename in files
+             if u'credit' not in os.path.split(filename)[1].lower()]
+
+    images = [filename for filename in files
+              if image_tools.is_image_file(filename)]
+
+    tools.alphanumeric_sort(images)
+
+    front_re = re.compile('(cover|front)', re.I)
+    candidates = [c for c in images
+                  if front_re.search(c) and 'back' not in c.lower()]
+
+    if candidates:
+        return candidates[0]
+
+    if images:
+        return images[0]
+
+    return None
+
 def get_archive_handler(path, type=None):
     """ Returns a fitting extractor handler for the archive passed
     in <path> (with optional mime type <type>. Returns None if no matching
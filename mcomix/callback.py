@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 
+import collections
 import traceback
 import weakref
 import threading
@@ -9,14 +10,77 @@ from gi.repository import GObject
 
 from mcomix import log
 
+class _Dispatcher(object):
+    """ Deliver calls made from other threads to the main thread in batches:
+    calls are queued, and all the calls queued during a frame are run in
+    a single main loop callback. Consecutive calls to a coalesced callback
+    (see coalesced()) queued in the same batch are merged into one call,
+    unless another callback of the same object was called in between, so
+    that the order of the callbacks of an object is preserved.
+    """
+
+    #: Time between two batches, in milliseconds (about one frame).
+    FLUSH_INTERVAL = 16
+
+    def __init__(self):
+        # collections.deque append and popleft are thread-safe.
+        self._queue = collections.deque()
+        self._lock = threading.Lock()
+        self._scheduled = False
+
+    def post(self, callback_list, args, kwargs):
+        """ Queue a call of <callback_list> with <args> and <kwargs>. """
+        self._queue.append((callback_list, args, kwargs))
+        with self._lock:
+            if self._scheduled:
+                return
+            self._scheduled = True
+        GObject.timeout_add(_Dispatcher.FLUSH_INTERVAL, self.flush)
+
+    def _get_batch(self):
+        """ Return the list of queued calls, coalesced calls merged. """
+        batch = []
+        # Last batch entry of each object.
+        last_calls = {}
+        while self._queue:
+            callback_list, args, kwargs = call = self._queue.popleft()
+            owner = callback_list.get_object()
+            if owner is None:
+                owner = callback_list
+            owner = id(owner)
+            if callback_list.coalesce and not kwargs:
+                previous = last_calls.get(owner)
+                if previous is not None and previous[0] is callback_list and \
+                   previous[1][:-1] == args[:-1]:
+                    previous[1][-1].extend(args[-1])
+                    continue
+                # Copy the list of the first call, so it can be extended.
+                call = (callback_list, args[:-1] + (list(args[-1]),), kwargs)
+            last_calls[owner] = call
+            batch.append(call)
+        return batch
+
+    def flush(self):
+        """ Run the queued calls. Must be called from the main thread. """
+        with self._lock:
+            self._scheduled = False
+        for callback_list, args, kwargs in self._get_batch():
+            callback_list(*args, **kwargs)
+        # Remove this function from the main loop.
+        return 0
+
+_dispatcher = _Dispatcher()
+
 class CallbackList(object):
     """ Helper class for implementing callbacks within the main thread.
     Add listeners to method calls with method += callback_function. """
 
-    def __init__(self, obj, function):
+    def __init__(self, obj, function, coalesce=False):
         self.__callbacks = []
         self.__object = obj
         self.__function = function
+        #: Merge calls from other threads (see coalesced()).
+        self.coalesce = coalesce
 
     def __call__(self, *args, **kwargs):
         """ Runs the wrapped function. After the funtion has finished,
@@ -34,8 +98,12 @@ class CallbackList(object):
             self.__run_callbacks(*args, **kwargs)
             return result
         else:
-            # Call this method again in the main thread.
-            GObject.idle_add(self.__mainthread_call, (args, kwargs))
+            # Call this method again in the main thread, with the next batch.
+            _dispatcher.post(self, args, kwargs)
+
+    def get_object(self):
+        """ Return the object the callback is bound to, or None. """
+        return self.__object
 
     def __iadd__(self, function):
         """ Support for 'method += callback_function' syntax. """
@@ -55,16 +123,6 @@ class CallbackList(object):
 
         return self
 
-    def __mainthread_call(self, params):
-        """ Helper function to execute code in the main thread.
-        This will be called by gobject.idle_add, with <params> being a tuple
-        of (args, kwargs). """
-
-        result = self(*params[0], **params[1])
-
-        # Remove this function from the idle queue
-        return 0
-
     def __run_callbacks(self, *args, **kwargs):
         """ Executes callback functions. """
         for obj_ref, func in self.__callbacks:
@@ -82,10 +140,9 @@ class CallbackList(object):
                 callback = None
 
             if callback:
-                e = ""
                 try:
                     callback(*args, **kwargs)
-                except Exception(e):
+                except Exception as e:
                     log.error(('! Callback %(function)r failed: %(error)s'),
                               { 'function' : callback, 'error' : e })
                     log.debug('Traceback:\n%s', traceback.format_exc())
@@ -110,15 +167,23 @@ class CallbackList(object):
 class Callback(object):
     """ Decorator class for using the CallbackList helper. """
 
-    def __init__(self, function):
+    def __init__(self, function, coalesce=False):
         # This is the function the Callback is decorating.
         self.__function = function
+        self.__coalesce = coalesce
 
     def __get__(self, obj, cls):
         """ This method makes Callback implement the descriptor interface.
         Enables calling bound methods with the correct <self> reference.
         Do not ask me why or how this actually works, I simply do not know. """
 
-        return CallbackList(obj, self.__function)
+        return CallbackList(obj, self.__function, self.__coalesce)
+
+def coalesced(function):
+    """ Decorator for a Callback whose last argument is a list: the calls
+    made from other threads and delivered in the same batch with the same
+    other arguments are merged into a single call, with the concatenation
+    of their lists. """
+    return Callback(function, coalesce=True)
 
 # vim: expandtab:sw=4:ts=4
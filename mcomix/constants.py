@@ -13,12 +13,16 @@ VERSION = '1.3.dev0-GTK3+0.2'
 HOME_DIR = tools.get_home_directory()
 CONFIG_DIR = tools.get_config_directory()
 DATA_DIR = tools.get_data_directory()
+CACHE_DIR = tools.get_cache_directory()
 
 BASE_PATH = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
 THUMBNAIL_PATH = os.path.join(HOME_DIR, '.thumbnails/normal')
+THUMBNAIL_STORE_PATH = os.path.join(DATA_DIR, 'thumbnails.db')
 LIBRARY_DATABASE_PATH = os.path.join(DATA_DIR, 'library.db')
 LASTPAGE_DATABASE_PATH = os.path.join(DATA_DIR, 'lastreadpage.db')
 LIBRARY_COVERS_PATH = os.path.join(DATA_DIR, 'library_covers')
+PAGE_CACHE_PATH = os.path.join(CACHE_DIR, 'pages')
+LISTING_CACHE_PATH = os.path.join(CACHE_DIR, 'listings.db')
 PREFERENCE_PATH = os.path.join(CONFIG_DIR, 'preferences.conf')
 KEYBINDINGS_CONF_PATH = os.path.join(CONFIG_DIR, 'keybindings.conf')
 
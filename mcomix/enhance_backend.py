@@ -4,6 +4,10 @@ brightness etc.)
 
 from mcomix.preferences import prefs
 from mcomix import image_tools
+from mcomix import callback
+from mcomix import log
+from mcomix import tracing
+from mcomix.worker_thread import WorkerThread
 
 class ImageEnhancer(object):
 
@@ -19,23 +23,66 @@ class ImageEnhancer(object):
         self.saturation = prefs['saturation']
         self.sharpness = prefs['sharpness']
         self.autocontrast = prefs['auto contrast']
+        #: Enhance the displayed pages in the background.
+        self._thread = WorkerThread(self._enhance_displayed, name='enhance')
 
-    def enhance(self, pixbuf):
-        """Return an "enhanced" version of <pixbuf>."""
+    @tracing.traced('enhance', 'enhance')
+    def enhance(self, pixbuf, parameters=None, histogram=None):
+        """Return an "enhanced" version of <pixbuf>, using the enhancement
+        values <parameters> (as returned by get_parameters), or the current
+        values if None. See image_tools.enhance for <histogram>."""
 
-        if (self.brightness != 1.0 or self.contrast != 1.0 or
-          self.saturation != 1.0 or self.sharpness != 1.0 or
-          self.autocontrast):
+        if parameters is None:
+            parameters = self.get_parameters()
+        brightness, contrast, saturation, sharpness, autocontrast = parameters
 
-            return image_tools.enhance(pixbuf, self.brightness, self.contrast,
-                self.saturation, self.sharpness, self.autocontrast)
+        if (brightness != 1.0 or contrast != 1.0 or
+          saturation != 1.0 or sharpness != 1.0 or
+          autocontrast):
+
+            return image_tools.enhance(pixbuf, brightness, contrast,
+                saturation, sharpness, autocontrast, histogram=histogram)
 
         return pixbuf
 
+    def get_parameters(self):
+        """Return a tuple of the current enhancement values."""
+        return (self.brightness, self.contrast, self.saturation,
+                self.sharpness, self.autocontrast)
+
     def signal_update(self):
         """Signal to the main window that a change in the enhancement
         values has been made.
+
+        The displayed pages are enhanced in the background, and the main
+        window is redrawn once done. While the values keep changing (e.g.
+        a slider is dragged), only the latest values are processed.
         """
-        self._window.draw_image()
+        self._thread.clear_orders()
+        self._thread.append_order(self.get_parameters())
+
+    def stop(self):
+        """Stop enhancing pages in the background."""
+        self._thread.stop()
+
+    def _enhance_displayed(self, parameters):
+        """Enhance the currently displayed pages with <parameters>, and
+        store the results in the rendered pages cache."""
+        for page, key, pixbuf in self._window.get_displayed_renderings():
+            if parameters != self.get_parameters() or self._thread.must_stop():
+                # Superseded by newer values.
+                return
+            key += (parameters,)
+            if self._window.imagehandler.get_rendered_pixbuf(page, key) is not None:
+                continue
+            log.debug('Enhancing page %u', page)
+            self._window.imagehandler.add_rendered_pixbuf(
+                page, key, self.enhance(pixbuf, parameters))
+        self._enhanced(parameters)
+
+    @callback.Callback
+    def _enhanced(self, parameters):
+        if parameters == self.get_parameters():
+            self._window.draw_image()
 
 # vim: expandtab:sw=4:ts=4
@@ -82,6 +82,9 @@ class _BaseFileChooserDialog(Gtk.Dialog):
         preview_box.pack_start(self._sizelabel, False, False, 10)
         self.filechooser.set_use_preview_label(False)
         preview_box.show_all()
+        self._preview_thumbnailer = thumbnail_tools.Thumbnailer(size=(128, 128),
+                                                                archive_support=True)
+        self._preview_thumbnailer.thumbnail_finished += self._preview_thumbnail_finished
         self.filechooser.connect('update-preview', self._update_preview)
 
         self._all_files_filter = self.add_filter( ('All files'), [], ['*'])
@@ -258,6 +261,7 @@ class _BaseFileChooserDialog(Gtk.Dialog):
         else:
             self.files_chosen([])
 
+        self._preview_thumbnailer.cancel()
         self._destroyed = True
 
     def _update_preview(self, *args):
@@ -267,10 +271,9 @@ class _BaseFileChooserDialog(Gtk.Dialog):
             path = None
 
         if path and os.path.isfile(path):
-            thumbnailer = thumbnail_tools.Thumbnailer(size=(128, 128),
-                                                      archive_support=True)
-            thumbnailer.thumbnail_finished += self._preview_thumbnail_finished
-            thumbnailer.thumbnail(path)
+            # Don't keep creating the preview of a file no longer selected.
+            self._preview_thumbnailer.cancel()
+            self._preview_thumbnailer.thumbnail(path, mt=True)
         else:
             self._preview_image.clear()
             self._namelabel.set_text('')
@@ -409,8 +409,12 @@ class FileHandler(object):
         readable.
         """
         self._wait_on_comment(num)
+        path = self._comment_files[num - 1]
+        text = self.get_file_data(path)
+        if text is not None:
+            return text
         try:
-            fd = open(self._comment_files[num - 1], 'r')
+            fd = open(path, 'r')
             text = fd.read()
             fd.close()
         except Exception:
@@ -419,7 +423,7 @@ class FileHandler(object):
 
     def get_comment_name(self, num):
         """Return the filename of comment <num>."""
-        return self._comment_files[num - 1]
+        return self.ensure_file_on_disk(self._comment_files[num - 1])
 
     def update_comment_extensions(self):
         """Update the regular expression used to filter out comments in
@@ -565,6 +569,43 @@ class FileHandler(object):
         else:
             return False
 
+    def get_member_name(self, filepath):
+        """ Returns the name in the archive of the file specified by
+        "filepath", or "filepath" itself if not from an archive. """
+
+        return self._name_table.get(filepath, filepath)
+
+    def get_file_data(self, filepath):
+        """ Returns the content of the file specified by "filepath" if it
+        was extracted to memory, or None if it must be read from disk. """
+
+        if self.archive_type is None:
+            return None
+        name = self._name_table.get(filepath)
+        if name is None:
+            return None
+        return self._extractor.get_data(name)
+
+    def get_file_size(self, filepath):
+        """ Returns the size of the file specified by "filepath", whether
+        it was extracted to memory or to disk. Raises OSError if the file
+        is not available. """
+
+        data = self.get_file_data(filepath)
+        if data is not None:
+            return len(data)
+        return os.stat(filepath).st_size
+
+    def ensure_file_on_disk(self, filepath):
+        """ Makes sure the file specified by "filepath" can be read from
+        disk, even if it was extracted to memory, and returns "filepath".
+        Only needed when handing paths to code that reads them directly. """
+
+        if self.archive_type is not None and filepath in self._name_table \
+           and self.file_is_available(filepath):
+            self._extractor.write_file(self._name_table[filepath])
+        return filepath
+
     @callback.Callback
     def file_available(self, filepaths):
         """ Called every time a new file from the Filehandler's opened
@@ -572,14 +613,14 @@ class FileHandler(object):
         """
         pass
 
-    def _extracted_file(self, extractor, name):
-        """ Called when the extractor finishes extracting the file at
-        <name>. This name is relative to the temporary directory
+    def _extracted_file(self, extractor, names):
+        """ Called when the extractor finishes extracting the files at
+        <names>. These names are relative to the temporary directory
         the files were extracted to. """
         if not self.file_loaded:
             return
-        filepath = os.path.join(extractor.get_directory(), name)
-        self.file_available([filepath])
+        directory = extractor.get_directory()
+        self.file_available([os.path.join(directory, name) for name in names])
 
     def _wait_on_comment(self, num):
         """Block the running (main) thread until the file corresponding to
@@ -607,19 +648,14 @@ class FileHandler(object):
             return
 
     def _ask_for_files(self, files):
-        """Ask for <files> to be given priority for extraction.
+        """Ask for <files> to be given priority for extraction, by
+        decreasing priority.
         """
         if self.archive_type == None:
             return
 
         with self._condition:
-            extractor_files = self._extractor.get_files()
-            for path in reversed(files):
-                name = self._name_table[path]
-                if not self._extractor.is_ready(name):
-                    extractor_files.remove(name)
-                    extractor_files.insert(0, name)
-            self._extractor.set_files(extractor_files)
+            self._extractor.prioritize([self._name_table[path] for path in files])
 
     def thread_delete(self, path):
         """Start a threaded removal of the directory tree rooted at <path>.
@@ -0,0 +1,93 @@
+"""geometry_index.py - Geometry of the pages of a book, read from the
+image headers."""
+from __future__ import with_statement
+
+import os
+import threading
+
+from mcomix import image_tools
+from mcomix import listing_cache
+
+
+class GeometryIndex(object):
+
+    """ Geometry (see image_tools.ImageGeometry) of the pages of a book,
+    indexed by member name for archives, and by path otherwise. Pages are
+    added as they become available by parsing their image header only, so
+    that their size, orientation, format and animation flag are known
+    without decoding them.
+
+    The index of an archive is stored in the listing cache, and loaded the
+    next time the archive is opened (if unchanged): its pages are then
+    known before being extracted.
+
+    All methods are thread safe.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._geometries = {}
+        #: Key of the archive in the listing cache: (path, mtime, size).
+        self._archive = None
+        self._changed = False
+
+    def load(self, archive_path=None):
+        """ Clear the index, and load the index stored for the archive at
+        <archive_path> if not None. """
+        self.clear()
+        if archive_path is None:
+            return
+        try:
+            stat = os.stat(archive_path)
+        except OSError:
+            return
+        archive = (os.path.abspath(archive_path), stat.st_mtime, stat.st_size)
+        stored = listing_cache.get_listing_cache().get_geometry(*archive)
+        geometries = {}
+        for name, fields in (stored or {}).items():
+            try:
+                geometries[name] = image_tools.ImageGeometry(*fields)
+            except TypeError:
+                # Stored by an incompatible version.
+                return
+        with self._lock:
+            self._archive = archive
+            # Keep the pages already added.
+            geometries.update(self._geometries)
+            self._geometries = geometries
+
+    def save(self):
+        """ Store the index in the listing cache, if it is the index of an
+        archive and pages were added since it was loaded. """
+        with self._lock:
+            if self._archive is None or not self._changed:
+                return
+            geometries = dict((name, list(geometry)) for name, geometry
+                              in self._geometries.items())
+            self._changed = False
+            archive = self._archive
+        listing_cache.get_listing_cache().put_geometry(*(archive + (geometries,)))
+
+    def clear(self):
+        """ Remove all pages from the index. """
+        with self._lock:
+            self._geometries = {}
+            self._archive = None
+            self._changed = False
+
+    def add(self, key, geometry):
+        """ Add the <geometry> of the page <key>. """
+        with self._lock:
+            self._geometries[key] = geometry
+            self._changed = True
+
+    def get(self, key):
+        """ Return the geometry of the page <key>, or None if unknown. """
+        with self._lock:
+            return self._geometries.get(key)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._geometries
+
+# vim: expandtab:sw=4:ts=4
@@ -1,7 +1,9 @@
 """image_handler.py - Image handler that takes care of cacheing and giving out images."""
 
 import os
+import threading
 import traceback
+from collections import deque
 
 from mcomix.preferences import prefs
 from mcomix import i18n
@@ -11,6 +13,9 @@ from mcomix import thumbnail_tools
 from mcomix import constants
 from mcomix import callback
 from mcomix import log
+from mcomix import tracing
+from mcomix.geometry_index import GeometryIndex
+from mcomix.pixbuf_cache import PixbufCache
 from mcomix.worker_thread import WorkerThread
 
 class ImageHandler(object):
@@ -26,125 +31,387 @@ class ImageHandler(object):
     threaded.
     """
 
+    #: Number of page changes used to guess the reading direction.
+    DIRECTION_HISTORY = 4
+    #: Reduced decoding sizes are rounded up to a multiple of this.
+    DECODE_SIZE_STEP = 256
+    #: Share of the cache budget used for the rendered pages cache, the
+    #: rest being used for decoded pages.
+    RENDERED_CACHE_SHARE = 0.25
+
     def __init__(self, window):
 
         #: Reference to main window
         self._window = window
 
-        #: Caching thread
+        #: Caching threads, decoding neighbouring pages concurrently
         self._thread = WorkerThread(self._cache_pixbuf, name='image',
+                                    max_threads=tools.cpu_count(),
                                     sort_orders=True)
+        #: Lock protecting the map of pages being decoded
+        self._decoding_lock = threading.Lock()
+        #: Pages being decoded: page index > (event, [pixbuf])
+        self._decoding = {}
+        #: Last page changes (in pages), used to guess the reading direction
+        self._page_deltas = deque(maxlen=ImageHandler.DIRECTION_HISTORY)
 
         #: Archive path, if currently opened file is archive
         self._base_path = None
         #: List of image file names, either from extraction or directory
         self._image_files = None
+        #: Image path > page index, for _image_files (see _get_page_index).
+        self._page_index = {}
+        self._page_index_files = None
         #: Index of current page
         self._current_image_index = None
         #: Set of images reading for decoding (i.e. already extracted)
         self._available_images = set()
         #: List of pixbufs we want to cache
         self._wanted_pixbufs = []
-        #: Pixbuf map from page > Pixbuf
-        self._raw_pixbufs = {}
-        #: How many pages to keep in cache
+        #: Pixbuf cache from page index > Pixbuf
+        self._raw_pixbufs = PixbufCache()
+        #: Cache of pixbufs ready to be displayed (scaled, rotated, enhanced...)
+        #: from page index > Pixbuf, for a render key (see set_renderer)
+        self._rendered_pixbufs = PixbufCache()
+        self._update_cache_max_size()
+        #: Render settings and function used to pre-render wanted pages
+        self._render_settings = None
+        self._renderer = None
+        #: Automatic background colours: (page indexes, edge) > colour
+        self._auto_backgrounds = {}
+        #: Size pages are decoded at, or None for their full size
+        self._decode_size = None
+        #: Pages decoded at a reduced size: page index > (decode size, original size)
+        self._reduced_pixbufs = {}
+        #: How many pages to read ahead
         self._cache_pages = prefs['max pages to cache']
+        #: Number of pages displayed from the current page, or None
+        #: if it depends on the double page mode (see set_displayed_pages)
+        self._displayed_pages = None
+        #: Geometry of the pages, read from their header
+        self._geometry = GeometryIndex()
+        self._geometry_thread = WorkerThread(self._read_geometry,
+                                             name='geometry',
+                                             unique_orders=True)
 
         self._window.filehandler.file_available += self._file_available
+        self._window.filehandler.file_opened += self._file_opened
 
-    def _get_pixbuf(self, index):
+    @tracing.traced('get pixbuf', 'image')
+    def _get_pixbuf(self, index, full_resolution=False):
         """Return the pixbuf indexed by <index> from cache.
         Pixbufs not found in cache are fetched from disk first.
+
+        Unless <full_resolution> is True, the page may be decoded at a
+        reduced size (see _update_decode_size), in which case a cached
+        pixbuf is only returned if it is at least as big.
         """
-        pixbuf = image_tools.MISSING_IMAGE_ICON
+        decode_size = None if full_resolution else self._decode_size
+        key = (index, decode_size)
+        with self._decoding_lock:
+            pixbuf = self._raw_pixbufs.get(index)
+            if pixbuf is not None and self._is_big_enough(index, decode_size):
+                return pixbuf
+            decoding = self._decoding.get(key)
+            is_decoder = decoding is None
+            if is_decoder:
+                decoding = self._decoding[key] = (threading.Event(), [])
+        event, result = decoding
+
+        if not is_decoder:
+            # Another thread is already decoding this page:
+            # wait for its result instead of decoding it twice.
+            event.wait()
+            return result[0]
 
-        if index not in self._raw_pixbufs:
+        pixbuf = image_tools.MISSING_IMAGE_ICON
+        try:
             self._wait_on_page(index + 1)
-
-            e = ""
-            try:
-                pixbuf = image_tools.load_pixbuf(self._image_files[index])
-                self._raw_pixbufs[index] = pixbuf
-                tools.garbage_collect()
-            except Exception(e):
-                self._raw_pixbufs[index] = image_tools.MISSING_IMAGE_ICON
-                log.error('Could not load pixbuf for page %u: %r', index + 1, e)
-        else:
-            try:
-                pixbuf = self._raw_pixbufs[index]
-            except Exception:
-                pass
+            pixbuf, reduced = self._decode_pixbuf(index, decode_size)
+            with self._decoding_lock:
+                self._raw_pixbufs.add(index, pixbuf)
+                if reduced is None:
+                    self._reduced_pixbufs.pop(index, None)
+                else:
+                    self._reduced_pixbufs[index] = reduced
+        finally:
+            with self._decoding_lock:
+                del self._decoding[key]
+            result.append(pixbuf)
+            event.set()
 
         return pixbuf
 
-    def get_pixbufs(self, number_of_bufs):
+    @tracing.traced('decode', 'image')
+    def _decode_pixbuf(self, index, decode_size):
+        """Decode the page <index> at <decode_size> (or at full size if
+        None). Return a (pixbuf, reduced) tuple, where <reduced> is None
+        if the page was decoded at full size, and (decode size, original
+        size) otherwise."""
+        pixbuf = image_tools.MISSING_IMAGE_ICON
+        reduced = None
+        try:
+            path = self._image_files[index]
+            data = self._window.filehandler.get_file_data(path)
+            if decode_size is not None and not self._may_be_animation(index):
+                pixbuf, original_size = image_tools.load_pixbuf_reduced(
+                    path, decode_size[0], decode_size[1], imgdata=data)
+                if original_size != (pixbuf.get_width(), pixbuf.get_height()):
+                    reduced = (decode_size, original_size)
+            elif data is not None:
+                # Extracted to memory: decode without a disk round trip.
+                pixbuf = image_tools.load_pixbuf_data(data, allow_animation=True)
+            else:
+                pixbuf = image_tools.load_pixbuf(path)
+            tools.garbage_collect()
+        except Exception as e:
+            log.error('Could not load pixbuf for page %u: %r', index + 1, e)
+        return pixbuf, reduced
+
+    def _is_big_enough(self, index, decode_size):
+        """Return True if the cached pixbuf for <index> can be used
+        when decoding at <decode_size>."""
+        reduced = self._reduced_pixbufs.get(index)
+        if reduced is None:
+            # Full size.
+            return True
+        if decode_size is None:
+            return False
+        return all(tools.smaller_or_equal(decode_size, reduced[0]))
+
+    def _may_be_animation(self, index):
+        """Return True if the page <index> may be an animation,
+        which cannot be decoded at a reduced size."""
+        if prefs['animation mode'] == constants.ANIMATION_DISABLED:
+            return False
+        geometry = self._geometry.get(self._get_geometry_key(index))
+        if geometry is not None:
+            return geometry.animated
+        path = self._image_files[index]
+        return os.path.splitext(path)[1].lower() in ('.gif', '.webp')
+
+    def _update_decode_size(self):
+        """Update the size pages are decoded at. Must be called from the
+        main thread. Pages are only decoded at a reduced size when fitted
+        to the window, and at full size otherwise (manual zoom, fit to
+        width or height, etc.).
+        """
+        zoom = self._window.zoom
+        if self._displayed_pages is not None:
+            # Strip mode: pages are scaled to the width of the window,
+            # whatever their height.
+            self._decode_size = None
+            return
+        if not prefs['decode at display size'] or \
+           zoom.get_fit_mode() != constants.ZOOM_MODE_BEST or \
+           zoom.has_user_zoom():
+            self._decode_size = None
+            return
+        # Rotation is only known once decoded: use a square big enough
+        # for any orientation, rounded up so that resizing the window
+        # does not trigger a new decoding every time.
+        side = max(self._window.get_visible_area_size())
+        side = -(-side // ImageHandler.DECODE_SIZE_STEP) * ImageHandler.DECODE_SIZE_STEP
+        self._decode_size = (side, side)
+
+    def get_pixbufs(self, number_of_bufs, full_resolution=False):
         """Returns number_of_bufs pixbufs for the image(s) that should be
         currently displayed. This method might fetch images from disk, so make
-        sure that number_of_bufs is as small as possible.
+        sure that number_of_bufs is as small as possible. If <full_resolution>
+        is True, the images are not decoded at a reduced size.
         """
+        self._update_decode_size()
         result = []
         for i in range(number_of_bufs):
-            result.append(self._get_pixbuf(self._current_image_index + i))
+            result.append(self._get_pixbuf(self._current_image_index + i,
+                                           full_resolution=full_resolution))
         return result
 
+    def get_original_sizes(self, number_of_bufs):
+        """Returns the original (width, height) of the image(s) returned
+        by get_pixbufs() if they were decoded at a reduced size, or None
+        for images decoded at full size.
+        """
+        with self._decoding_lock:
+            reduced = [self._reduced_pixbufs.get(self._current_image_index + i)
+                       for i in range(number_of_bufs)]
+        return [None if r is None else r[1] for r in reduced]
+
+    @tracing.traced('smart background', 'image')
     def get_pixbuf_auto_background(self, number_of_bufs): # XXX limited to at most 2 pages
         """ Returns an automatically calculated background color
         for the current page(s). """
 
-        pixbufs = self.get_pixbufs(number_of_bufs)
+        indexes = [self._current_image_index + i for i in range(number_of_bufs)]
+        if len(indexes) == 2 and self._window.is_manga_mode:
+            indexes.reverse()
+        key = (tuple(indexes), image_tools.EDGE_COLOUR_WIDTH)
+        auto_bg = self._auto_backgrounds.get(key)
+        if auto_bg is not None:
+            return auto_bg
+
+        pixbufs = [self._get_pixbuf(index) for index in indexes]
 
         if len(pixbufs) == 1:
             auto_bg = image_tools.get_most_common_edge_colour(pixbufs[0])
         elif len(pixbufs) == 2:
-            left, right = pixbufs
-            if self._window.is_manga_mode:
-                left, right = right, left
-
-            auto_bg = image_tools.get_most_common_edge_colour((left, right))
+            auto_bg = image_tools.get_most_common_edge_colour(tuple(pixbufs))
         else:
             assert False, 'Unexpected pixbuf count'
 
+        if None not in pixbufs:
+            self._auto_backgrounds[key] = auto_bg
         return auto_bg
 
     def do_cacheing(self):
         """Make sure that the correct pixbufs are stored in cache. These
         are (in the current implementation) the current image(s), and
-        if cacheing is enabled, also the one or two pixbufs before and
-        after the current page. All other pixbufs are deleted and garbage
-        collected directly in order to save memory.
+        if cacheing is enabled, also the pixbufs before and after the
+        current page. Other pixbufs are kept as long as the cache memory
+        budget allows it, and are the first to be evicted.
         """
         if not self._window.filehandler.file_loaded:
             return
 
         # Flush caching orders.
         self._thread.clear_orders()
+        self._update_decode_size()
         # Get list of wanted pixbufs.
         wanted_pixbufs = self._ask_for_pages(self.get_current_page())
-        if -1 != self._cache_pages:
-            # We're not caching everything, remove old pixbufs.
-            for index in set(self._raw_pixbufs) - set(wanted_pixbufs):
-                del self._raw_pixbufs[index]
+        self._raw_pixbufs.set_wanted(wanted_pixbufs)
+        self._rendered_pixbufs.set_wanted(wanted_pixbufs)
         log.debug('Caching page(s) %s', ' '.join([str(index + 1) for index in wanted_pixbufs]))
         self._wanted_pixbufs = wanted_pixbufs
-        # Start caching available images not already in cache.
+        # Start caching available images not already in cache,
+        # and pre-rendering them if possible.
         wanted_pixbufs = [index for index in wanted_pixbufs
-                          if index in self._available_images and not index in self._raw_pixbufs]
+                          if index in self._available_images and
+                          (self._renderer is not None or not index in self._raw_pixbufs)]
         orders = [(priority, index) for priority, index in enumerate(wanted_pixbufs)]
         if len(orders) > 0:
             self._thread.extend_orders(orders)
 
+    @tracing.traced('cache pixbuf', 'image')
     def _cache_pixbuf(self, wanted):
         priority, index = wanted
         log.debug('Caching page %u', index + 1)
-        self._get_pixbuf(index)
+        pixbuf = self._get_pixbuf(index)
+        renderer = self._renderer
+        if renderer is None:
+            return
+        rendering = renderer(index + 1, pixbuf)
+        if rendering is None:
+            return
+        key, render = rendering
+        if self._rendered_pixbufs.get(index, key=key) is None:
+            log.debug('Pre-rendering page %u', index + 1)
+            self._rendered_pixbufs.add(index, render(), key=key)
+            self.pages_rendered([index + 1])
+
+    @callback.coalesced
+    def pages_rendered(self, pages):
+        """ Called when <pages> were pre-rendered in the background. """
+        pass
+
+    def set_renderer(self, settings, renderer):
+        """Set the function used to pre-render wanted pages in the
+        background. <renderer> is called from the caching threads with a
+        page number and its pixbuf, and returns a (key, render) tuple, where
+        <render> returns the rendered pixbuf, and <key> identifies the
+        rendering (see get_rendered_pixbuf), or None if the page should not
+        be pre-rendered. Pre-rendering is restarted when the
+        <settings> the renderer depends on change. If <renderer> is None,
+        pages are not pre-rendered.
+        """
+        if settings == self._render_settings and \
+           (renderer is None) == (self._renderer is None):
+            return
+        self._render_settings = settings
+        self._renderer = renderer
+        if renderer is not None:
+            self.do_cacheing()
+
+    def get_rendered_pixbuf(self, page, key):
+        """Return the pixbuf rendered for <page> with the render <key>,
+        or None if not in cache."""
+        return self._rendered_pixbufs.get(page - 1, key=key)
+
+    def add_rendered_pixbuf(self, page, key, pixbuf):
+        """Store the <pixbuf> rendered for <page> with the render <key>."""
+        self._rendered_pixbufs.add(page - 1, pixbuf, key=key)
+
+    def _update_cache_max_size(self):
+        """Split the cache budget from preferences between the decoded
+        and rendered pages caches."""
+        max_size = prefs['max cache size']
+        if max_size < 0:
+            self._raw_pixbufs.set_max_size(-1)
+            self._rendered_pixbufs.set_max_size(-1)
+            return
+        max_size *= 1024 * 1024
+        rendered_size = int(max_size * ImageHandler.RENDERED_CACHE_SHARE)
+        self._raw_pixbufs.set_max_size(max_size - rendered_size)
+        self._rendered_pixbufs.set_max_size(rendered_size)
+
+    def update_cache_size(self):
+        """Apply a change of the cache preferences."""
+        self._cache_pages = prefs['max pages to cache']
+        self._update_cache_max_size()
+        self.do_cacheing()
+
+    def get_cache_stats(self):
+        """Return a dictionary with the pixbuf cache statistics (number
+        of cached pages, size, hits, misses and evictions)."""
+        return self._raw_pixbufs.get_stats()
+
+    def get_thread_stats(self):
+        """Return a dictionary with the statistics of the caching threads
+        (see WorkerThread.get_stats)."""
+        return self._thread.get_stats()
+
+    def set_displayed_pages(self, count):
+        """Set the number of pages displayed from the current page (e.g.
+        in strip mode), which are given priority for extraction and
+        caching. If <count> is None, one or two pages are displayed,
+        depending on the double page mode.
+        """
+        if count == self._displayed_pages:
+            return
+        self._displayed_pages = count
+        self.do_cacheing()
+
+    def _get_page_width(self):
+        """Return the number of pages displayed from the current page."""
+        if self._displayed_pages is not None:
+            return self._displayed_pages
+        if prefs['default double page']:
+            return 2
+        return 1
 
     def set_page(self, page_num):
         """Set up filehandler to the page <page_num>.
         """
         assert 0 < page_num <= self.get_number_of_pages()
+        if self._current_image_index is not None:
+            self._page_deltas.append(page_num - 1 - self._current_image_index)
         self._current_image_index = page_num - 1
         self.do_cacheing()
 
+    def get_reading_direction(self):
+        """Return the direction the user is currently reading in: 1 when
+        moving towards the last page, -1 towards the first page. Only the
+        last few page changes are taken into account, ignoring jumps.
+
+        Note: page numbers do not depend on manga mode, which only mirrors
+        the display, so the direction is the same in both modes.
+        """
+        page_width = self._get_page_width()
+        steps = [delta for delta in self._page_deltas
+                 if 0 < abs(delta) <= page_width]
+        if sum(steps) < 0:
+            return -1
+        return 1
+
     def get_virtual_double_page(self, page=None):
         """Return True if the current state warrants use of virtual
         double page mode (i.e. if double page mode is on, the corresponding
@@ -166,12 +433,18 @@ class ImageHandler(object):
             return False
 
         for page in (page, page + 1):
-            if not self.page_is_available(page):
-                return False
-            pixbuf = self._get_pixbuf(page - 1)
-            width, height = pixbuf.get_width(), pixbuf.get_height()
-            if prefs['auto rotate from exif']:
+            geometry = self.get_page_geometry(page)
+            if geometry is not None:
+                # Known without decoding (or even extracting) the page.
+                width, height = geometry.width, geometry.height
+                rotation = geometry.rotation
+            else:
+                if not self.page_is_available(page):
+                    return False
+                pixbuf = self._get_pixbuf(page - 1)
+                width, height = pixbuf.get_width(), pixbuf.get_height()
                 rotation = image_tools.get_implied_rotation(pixbuf)
+            if prefs['auto rotate from exif']:
                 assert rotation in (0, 90, 180, 270)
                 if rotation in (90, 270):
                     width, height = height, width
@@ -196,13 +469,42 @@ class ImageHandler(object):
         self.last_wanted = 1
 
         self._thread.stop()
+        self._geometry_thread.stop()
+        self._geometry.save()
+        self._geometry.clear()
         self._base_path = None
         self._image_files = []
         self._current_image_index = None
         self._available_images.clear()
+        self._page_deltas.clear()
+        log.debug('Pixbuf cache statistics: %s', self._raw_pixbufs.get_stats())
         self._raw_pixbufs.clear()
+        self._rendered_pixbufs.clear()
+        self._render_settings = None
+        self._renderer = None
+        self._auto_backgrounds.clear()
+        self._reduced_pixbufs.clear()
+        self._update_cache_max_size()
         self._cache_pages = prefs['max pages to cache']
 
+    def set_image_files(self, image_files):
+        """Replace the list of image files (e.g. after the pages were
+        reordered or deleted). All the pages cached or rendered for the
+        previous list are dropped."""
+        available = set(self._image_files[index]
+                        for index in self._available_images)
+        self._thread.clear_orders()
+        with self._decoding_lock:
+            self._image_files = image_files
+            self._available_images = set(index for index, path
+                                         in enumerate(image_files)
+                                         if path in available)
+            self._raw_pixbufs.clear()
+            self._rendered_pixbufs.clear()
+            self._auto_backgrounds.clear()
+            self._reduced_pixbufs.clear()
+        self._update_cache_max_size()
+
     def page_is_available(self, page=None):
         """ Returns True if <page> is available and calls to get_pixbufs
         would not block. If <page> is None, the current page(s) are assumed. """
@@ -242,6 +544,54 @@ class ImageHandler(object):
             priority = self.get_number_of_pages()
         if priority is not None:
             self._thread.append_order((priority, index))
+        if self._get_geometry_key(index) not in self._geometry:
+            self._geometry_thread.append_order(index)
+
+    def _file_opened(self):
+        """ Called by the filehandler when a new file has been opened:
+        load the geometry index stored for it. """
+        if self._window.filehandler.archive_type is not None:
+            self._geometry.load(self._base_path)
+        else:
+            self._geometry.load()
+
+    def _get_geometry_key(self, index):
+        """ Return the key of the page <index> in the geometry index. """
+        return self._window.filehandler.get_member_name(self._image_files[index])
+
+    def _read_geometry(self, index):
+        """ Add the geometry of the page <index> to the geometry index,
+        parsing only the image header. """
+        try:
+            path = self._image_files[index]
+        except IndexError:
+            # Another file was opened in the meantime.
+            return
+        key = self._window.filehandler.get_member_name(path)
+        if key in self._geometry:
+            return
+        data = self._window.filehandler.get_file_data(path)
+        geometry = image_tools.get_image_geometry(path, imgdata=data)
+        if geometry is not None:
+            self._geometry.add(key, geometry)
+            self.geometry_available([index + 1])
+
+    @callback.coalesced
+    def geometry_available(self, pages):
+        """ Called when the geometry of <pages> was read (see
+        get_page_geometry). """
+        pass
+
+    def get_page_geometry(self, page=None):
+        """Return the geometry of <page> (see image_tools.ImageGeometry), or
+        of the current page if None, as read from its header. Return None if
+        it is not known yet (e.g. the page was not extracted yet).
+        """
+        if page is None:
+            page = self.get_current_page()
+        if page < 1 or page > self.get_number_of_pages():
+            return None
+        return self._geometry.get(self._get_geometry_key(page - 1))
 
     def _file_available(self, filepaths):
         """ Called by the filehandler when a new file becomes available. """
@@ -249,10 +599,20 @@ class ImageHandler(object):
         if not self._image_files:
             return
 
-        available = sorted(filepaths)
-        for i, imgpath in enumerate(self._image_files):
-            if tools.bin_search(available, imgpath) >= 0:
-                self.page_available(i + 1)
+        page_index = self._get_page_index()
+        pages = [page_index[path] + 1 for path in filepaths
+                 if path in page_index]
+        for page in sorted(pages):
+            self.page_available(page)
+
+    def _get_page_index(self):
+        """ Return a dictionary mapping each image path to its page index.
+        It is rebuilt if the image files list was replaced. """
+        if self._page_index_files is not self._image_files:
+            self._page_index = dict((path, index) for index, path
+                                    in enumerate(self._image_files))
+            self._page_index_files = self._image_files
+        return self._page_index
 
     def get_number_of_pages(self):
         """Return the number of pages in the current archive/directory."""
@@ -270,7 +630,17 @@ class ImageHandler(object):
 
     def get_path_to_page(self, page=None):
         """Return the full path to the image file for <page>, or the current
-        page if <page> is None.
+        page if <page> is None. If the page is available, the file is
+        guaranteed to exist on disk.
+        """
+        path = self._get_path_to_page(page)
+        if path is None:
+            return None
+        return self._window.filehandler.ensure_file_on_disk(path)
+
+    def _get_path_to_page(self, page=None):
+        """Same as get_path_to_page, but the page may only have been
+        extracted to memory.
         """
         if page is None:
             index = self._current_image_index
@@ -291,12 +661,12 @@ class ImageHandler(object):
         if page is None:
             page = self.get_current_page()
 
-        first_path = self.get_path_to_page(page)
+        first_path = self._get_path_to_page(page)
         if first_path == None:
             return None
 
         if double:
-            second_path = self.get_path_to_page(page + 1)
+            second_path = self._get_path_to_page(page + 1)
 
             if second_path != None:
                 first = os.path.basename(first_path)
@@ -320,19 +690,20 @@ class ImageHandler(object):
         if page is None:
             page = self.get_current_page()
 
-        first_path = self.get_path_to_page(page)
+        first_path = self._get_path_to_page(page)
         if first_path == None:
             return
 
+        get_file_size = self._window.filehandler.get_file_size
         if double:
-            second_path = self.get_path_to_page(page + 1)
+            second_path = self._get_path_to_page(page + 1)
             if second_path != None:
                 try:
-                    first = tools.format_byte_size(os.stat(first_path).st_size)
+                    first = tools.format_byte_size(get_file_size(first_path))
                 except OSError:
                     first = u''
                 try:
-                    second = tools.format_byte_size(os.stat(second_path).st_size)
+                    second = tools.format_byte_size(get_file_size(second_path))
                 except OSError:
                     second = u''
             else:
@@ -340,7 +711,7 @@ class ImageHandler(object):
             return first, second
 
         try:
-            size = tools.format_byte_size(os.stat(first_path).st_size)
+            size = tools.format_byte_size(get_file_size(first_path))
         except OSError:
             size = u''
 
@@ -367,6 +738,10 @@ class ImageHandler(object):
         """Return a tuple (width, height) with the size of <page>. If <page>
         is None, return the size of the current page.
         """
+        geometry = self.get_page_geometry(page)
+        if geometry is not None:
+            return (geometry.width, geometry.height)
+
         self._wait_on_page(page)
 
         page_path = self.get_path_to_page(page)
@@ -380,6 +755,10 @@ class ImageHandler(object):
         """Return a string with the name of the mime type of <page>. If
         <page> is None, return the mime type name of the current page.
         """
+        geometry = self.get_page_geometry(page)
+        if geometry is not None:
+            return geometry.format
+
         self._wait_on_page(page)
 
         page_path = self.get_path_to_page(page)
@@ -403,11 +782,23 @@ class ImageHandler(object):
         if not self._wait_on_page(page, check_only=nowait):
             # Page is not available!
             return None
-        path = self.get_path_to_page(page)
+        path = self._get_path_to_page(page)
 
         if path == None:
             return None
 
+        data = self._window.filehandler.get_file_data(path)
+        if data is not None and not create:
+            # Extracted to memory, and no need to store the
+            # thumbnail on disk: scale it down directly.
+            try:
+                return image_tools.load_pixbuf_size_data(data, width, height)
+            except Exception:
+                log.debug("Failed to create thumbnail for image `%s':\n%s",
+                          path, traceback.format_exc())
+                return image_tools.MISSING_IMAGE_ICON
+
+        path = self._window.filehandler.ensure_file_on_disk(path)
         try:
             thumbnailer = thumbnail_tools.Thumbnailer(store_on_disk=create,
                                                       size=(width, height))
@@ -435,7 +826,7 @@ class ImageHandler(object):
             return False
 
         log.debug('Waiting for page %u', page)
-        path = self.get_path_to_page(page)
+        path = self._get_path_to_page(page)
         self._window.filehandler._wait_on_file(path)
         return True
 
@@ -443,10 +834,7 @@ class ImageHandler(object):
         """Ask for pages around <page> to be given priority extraction.
         """
         files = []
-        if prefs['default double page']:
-            page_width = 2
-        else:
-            page_width = 1
+        page_width = self._get_page_width()
         if 0 == self._cache_pages:
             # Only ask for current page.
             num_pages = page_width
@@ -455,13 +843,26 @@ class ImageHandler(object):
             num_pages = min(10, self.get_number_of_pages())
         else:
             num_pages = self._cache_pages
-
-        page_list = [page - 1 - page_width + n for n in range(num_pages)]
+        num_pages = max(num_pages, page_width)
+
+        # Read ahead more pages in the reading direction than behind:
+        # only keep a quarter of the window (and at least the
+        # previous page(s)) behind the current page.
+        direction = self.get_reading_direction()
+        num_behind = max(min(page_width, num_pages - page_width),
+                         (num_pages - page_width) // 4)
+        num_ahead = num_pages - page_width - num_behind
+        current_pages = [page - 1 + n for n in range(page_width)]
+        if direction > 0:
+            first_ahead, first_behind = current_pages[-1] + 1, current_pages[0] - 1
+        else:
+            first_ahead, first_behind = current_pages[0] - 1, current_pages[-1] + 1
+        ahead_pages = [first_ahead + direction * n for n in range(num_ahead)]
+        behind_pages = [first_behind - direction * n for n in range(num_behind)]
 
         # Current and next page first, followed by previous page.
-        previous_page = page_list[0:page_width]
-        del page_list[0:page_width]
-        page_list[2*page_width:2*page_width] = previous_page
+        page_list = current_pages + ahead_pages[:page_width] + \
+                behind_pages + ahead_pages[page_width:]
         page_list = [index for index in page_list
                      if index >= 0 and index < len(self._image_files)]
 
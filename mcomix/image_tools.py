@@ -2,7 +2,6 @@
 
 from ast import ExtSlice
 from asyncio import ensure_future, exceptions
-from audioop import error
 from base64 import encode
 from collections import defaultdict, namedtuple
 import binascii
@@ -16,11 +15,15 @@ gi.require_version("Gtk", "3.0")
 from gi.repository import Gtk, Gdk, GdkPixbuf, GLib
 from PIL import Image
 from PIL import ImageEnhance
-from PIL import ImageOps
 from PIL.JpegImagePlugin import _getexif
 from PIL import __version__
 PIL_VERSION = ('Pillow', __version__)
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 
 from mcomix.preferences import prefs
 from mcomix import constants
@@ -82,13 +85,17 @@ def get_fitting_size(source_size, target_size,
                 width = int(max(src_width * height / src_height, 1))
     return (width, height)
 
-def fit_pixbuf_to_rectangle(src, rect, rotation):
+def fit_pixbuf_to_rectangle(src, rect, rotation, scaling_quality=None,
+                            checkered_bg=None):
     return fit_in_rectangle(src, rect[0], rect[1],
                             rotation=rotation,
                             keep_ratio=False,
-                            scale_up=True)
+                            scale_up=True,
+                            scaling_quality=scaling_quality,
+                            checkered_bg=checkered_bg)
 
-def fit_in_rectangle(src, width, height, keep_ratio=True, scale_up=False, rotation=0, scaling_quality=None):
+def fit_in_rectangle(src, width, height, keep_ratio=True, scale_up=False, rotation=0, scaling_quality=None,
+                     checkered_bg=None):
     """Scale (and return) a pixbuf so that it fits in a rectangle with
     dimensions <width> x <height>. A negative <width> or <height>
     means an unbounded dimension - both cannot be negative.
@@ -102,7 +109,9 @@ def fit_in_rectangle(src, width, height, keep_ratio=True, scale_up=False, rotati
     If <keep_ratio> is True, the image ratio is kept, and the result
     dimensions may be smaller than the target dimensions.
 
-    If <src> has an alpha channel it gets a checkboard background.
+    If <src> has an alpha channel it gets a checkboard background, or a
+    white one if <checkered_bg> is False. <scaling_quality> and
+    <checkered_bg> default to the preferences.
     """
     # "Unbounded" really means "bounded to 10000 px" - for simplicity.
     # MComix would probably choke on larger images anyway.
@@ -131,10 +140,7 @@ def fit_in_rectangle(src, width, height, keep_ratio=True, scale_up=False, rotati
                                      scale_up=scale_up)
 
     if src.get_has_alpha():
-        if prefs['checkered bg for transparent images']:
-            check_size, color1, color2 = 8, 0x777777, 0x999999
-        else:
-            check_size, color1, color2 = 1024, 0xFFFFFF, 0xFFFFFF
+        check_size, color1, color2 = _get_checkerboard(checkered_bg)
         if width == src_width and height == src_height:
             # Using anything other than INTERP_NEAREST will result in a
             # modified image even if it's opaque and no resizing takes place.
@@ -148,6 +154,62 @@ def fit_in_rectangle(src, width, height, keep_ratio=True, scale_up=False, rotati
 
     return src
 
+def fit_pixbuf_region(src, rect, rotation, region, scaling_quality=None,
+                      checkered_bg=None):
+    """Return the <region> (a (x, y, width, height) tuple) of the pixbuf
+    fit_pixbuf_to_rectangle(<src>, <rect>, <rotation>, <scaling_quality>,
+    <checkered_bg>) would return. Only
+    that region is scaled: this is used to display very large pages (or
+    pages zoomed in a lot) tile by tile.
+    """
+    width, height = max(rect[0], 1), max(rect[1], 1)
+    x, y, w, h = region
+    rotation %= 360
+    if rotation not in (0, 90, 180, 270):
+        raise ValueError("unsupported rotation: %s" % rotation)
+    # Map the region to the scaled pixbuf, before rotation.
+    if rotation in (90, 270):
+        width, height = height, width
+    if 90 == rotation:
+        x, y, w, h = y, height - x - w, h, w
+    elif 180 == rotation:
+        x, y = width - x - w, height - y - h
+    elif 270 == rotation:
+        x, y, w, h = width - y - h, x, h, w
+
+    if scaling_quality is None:
+        scaling_quality = prefs['scaling quality']
+
+    src_width = src.get_width()
+    src_height = src.get_height()
+    scale_x = float(width) / src_width
+    scale_y = float(height) / src_height
+    if width == src_width and height == src_height:
+        scaling_quality = GdkPixbuf.InterpType.NEAREST
+
+    if src.get_has_alpha():
+        check_size, color1, color2 = _get_checkerboard(checkered_bg)
+        tile = GdkPixbuf.Pixbuf.new(GdkPixbuf.Colorspace.RGB, True, 8, w, h)
+        # Offset the checkerboard so that it is continuous across tiles.
+        src.composite_color(tile, 0, 0, w, h, -x, -y, scale_x, scale_y,
+                            scaling_quality, 255, x, y,
+                            check_size, color1, color2)
+    else:
+        tile = GdkPixbuf.Pixbuf.new(GdkPixbuf.Colorspace.RGB, False, 8, w, h)
+        src.scale(tile, 0, 0, w, h, -x, -y, scale_x, scale_y, scaling_quality)
+
+    return rotate_pixbuf(tile, rotation)
+
+def _get_checkerboard(checkered_bg=None):
+    """Return the (check size, color 1, color 2) of the background of
+    transparent images, checkered unless <checkered_bg> is False (defaults
+    to the preferences)."""
+    if checkered_bg is None:
+        checkered_bg = prefs['checkered bg for transparent images']
+    if checkered_bg:
+        return 8, 0x777777, 0x999999
+    return 1024, 0xFFFFFF, 0xFFFFFF
+
 
 def add_border(pixbuf, thickness, colour=0x000000FF):
     """Return a pixbuf from <pixbuf> with a <thickness> px border of
@@ -162,7 +224,10 @@ def add_border(pixbuf, thickness, colour=0x000000FF):
     return canvas
 
 
-def get_most_common_edge_colour(pixbufs, edge=2):
+#: Width in pixels of the edges used to compute the automatic background.
+EDGE_COLOUR_WIDTH = 2
+
+def get_most_common_edge_colour(pixbufs, edge=EDGE_COLOUR_WIDTH):
     """Return the most commonly occurring pixel value along the four edges
     of <pixbuf>. The return value is a sequence, (r, g, b), with 16 bit
     values. If <pixbuf> is a tuple, the edges will be computed from
@@ -170,6 +235,9 @@ def get_most_common_edge_colour(pixbufs, edge=2):
 
     Note: This could be done more cleanly with subpixbuf(), but that
     doesn't work as expected together with get_pixels().
+
+    If NumPy is available, the edges are histogrammed directly from the
+    pixel data, without intermediate pixbufs or PIL images.
     """
 
     def group_colors(colors, steps=10):
@@ -238,7 +306,7 @@ def get_most_common_edge_colour(pixbufs, edge=2):
         height = pixbuf.get_height()
         edge = min(edge, width, height)
 
-        subpix = GdkPixbuf.Pixbuf(GdkPixbuf.Colorspace.RGB,
+        subpix = GdkPixbuf.Pixbuf.new(GdkPixbuf.Colorspace.RGB,
                 pixbuf.get_has_alpha(), 8, edge, height)
         if side == 'left':
             pixbuf.copy_area(0, 0, edge, height, subpix, 0, 0)
@@ -256,6 +324,14 @@ def get_most_common_edge_colour(pixbufs, edge=2):
     if not pixbufs:
         return (0, 0, 0)
 
+    if numpy is not None:
+        if not isinstance(pixbufs, (tuple, list)):
+            left, right = pixbufs, pixbufs
+        else:
+            assert len(pixbufs) == 2, 'Expected two pages in list'
+            left, right = pixbufs
+        return _get_most_common_edge_colour_numpy(left, right, edge)
+
     if not isinstance(pixbufs, (tuple, list)):
         left_edge = get_edge_pixbuf(pixbufs, 'left', edge)
         right_edge = get_edge_pixbuf(pixbufs, 'right', edge)
@@ -275,6 +351,54 @@ def get_most_common_edge_colour(pixbufs, edge=2):
     most_used = group_colors(ungrouped_colors)
     return [color * 257 for color in most_used]
 
+def pixbuf_to_array(pixbuf):
+    """Return a (height, width, channels) NumPy array of the pixels of
+    <pixbuf>. The pixel data is copied (once): only convert the part of a
+    page that is needed, see _get_most_common_edge_colour_numpy().
+    """
+    pixbuf = static_image(pixbuf)
+    channels = pixbuf.get_n_channels()
+    return numpy.ndarray((pixbuf.get_height(), pixbuf.get_width(), channels),
+                         dtype=numpy.uint8,
+                         buffer=pixbuf.read_pixel_bytes().get_data(),
+                         strides=(pixbuf.get_rowstride(), channels, 1))
+
+def _get_most_common_edge_colour_numpy(left, right, edge):
+    """NumPy version of get_most_common_edge_colour(): return the most
+    common colour along the left edge of <left> and the right edge of
+    <right>, as 16 bit (r, g, b) values.
+
+    Colours are rounded to the nearest multiple of 10 and histogrammed,
+    to compensate for dirty scans. The most common exact colour of the
+    most common group is returned.
+    """
+    strips = []
+    for pixbuf, side in ((left, 'left'), (right, 'right')):
+        pixbuf = static_image(pixbuf)
+        height = pixbuf.get_height()
+        width = min(edge, pixbuf.get_width(), height)
+        x = 0 if side == 'left' else pixbuf.get_width() - width
+        # Copy the edge first, so that only its pixels are converted (a
+        # sub-pixbuf would share the rowstride of the whole page).
+        strip = GdkPixbuf.Pixbuf.new(GdkPixbuf.Colorspace.RGB,
+                                     pixbuf.get_has_alpha(), 8, width, height)
+        pixbuf.copy_area(x, 0, width, height, strip, 0, 0)
+        strips.append(pixbuf_to_array(strip)[:, :, :3].reshape(-1, 3))
+    colors = numpy.concatenate(strips).astype(numpy.int32)
+    if not len(colors):
+        return (0, 0, 0)
+
+    # 26 steps of 10, and 255 rounded to 260 and clamped.
+    groups = (colors + 5) // 10
+    group_keys = (groups[:, 0] * 27 + groups[:, 1]) * 27 + groups[:, 2]
+    prominent = numpy.argmax(numpy.bincount(group_keys, minlength=27 ** 3))
+
+    in_group = colors[group_keys == prominent]
+    color_keys = (in_group[:, 0] << 16) | (in_group[:, 1] << 8) | in_group[:, 2]
+    keys, counts = numpy.unique(color_keys, return_counts=True)
+    most_used = int(keys[numpy.argmax(counts)])
+    return [((most_used >> shift) & 0xff) * 257 for shift in (16, 8, 0)]
+
 def pil_to_pixbuf(im, keep_orientation=False):
     """Return a pixbuf created from the PIL <im>."""
     if im.mode.startswith('RGB'):
@@ -438,8 +562,10 @@ def load_pixbuf_size(path, width, height):
         raise last_error
     return fit_in_rectangle(pixbuf, width, height, scaling_quality=GdkPixbuf.InterpType.BILINEAR)
 
-def load_pixbuf_data(imgdata):
-    """ Loads a pixbuf from the data passed in <imgdata>. """
+def load_pixbuf_data(imgdata, allow_animation=False):
+    """ Loads a pixbuf from the data passed in <imgdata>. If
+    <allow_animation> is True, animations are loaded as such,
+    depending on the animation mode preference. """
     # TODO similar to load_pixbuf, should be merged using callbacks etc.
     pixbuf = None
     last_error = None
@@ -450,14 +576,20 @@ def load_pixbuf_data(imgdata):
                 loader = GdkPixbuf.PixbufLoader()
                 loader.write(imgdata)
                 loader.close()
-                pixbuf = loader.get_pixbuf()
+                if allow_animation and \
+                   prefs['animation mode'] != constants.ANIMATION_DISABLED:
+                    pixbuf = loader.get_animation()
+                    if pixbuf.is_static_image():
+                        pixbuf = pixbuf.get_static_image()
+                else:
+                    pixbuf = loader.get_pixbuf()
             elif provider == constants.IMAGEIO_PIL:
-                pixbuf = pil_to_pixbuf(Image.open(io.StringIO(imgdata)), keep_orientation=True)
+                pixbuf = pil_to_pixbuf(Image.open(io.BytesIO(imgdata)), keep_orientation=True)
             else:
                 raise TypeError()
-        except:
+        except Exception as e:
             # current provider could not load image
-            last_error = error
+            last_error = e
         if pixbuf is not None:
             # stop loop on success
             log.debug("provider %s succeeded in decoding %s bytes", provider, len(imgdata))
@@ -468,33 +600,203 @@ def load_pixbuf_data(imgdata):
         raise last_error
     return pixbuf
 
+def load_pixbuf_size_data(imgdata, width, height):
+    """ Loads a pixbuf from the data passed in <imgdata> and scale it
+    to fit inside (width, height). """
+    # TODO similar to load_pixbuf_size, should be merged using callbacks etc.
+    def size_prepared(loader, image_width, image_height):
+        # Don't upscale if smaller than target dimensions!
+        loader.set_size(*get_fitting_size((image_width, image_height),
+                                          (width, height)))
+    pixbuf = None
+    last_error = None
+    for provider in (constants.IMAGEIO_GDKPIXBUF, constants.IMAGEIO_PIL):
+        try:
+            # TODO use dynamic dispatch instead of "if" chain
+            if provider == constants.IMAGEIO_GDKPIXBUF:
+                loader = GdkPixbuf.PixbufLoader()
+                loader.connect('size-prepared', size_prepared)
+                loader.write(imgdata)
+                loader.close()
+                pixbuf = loader.get_pixbuf()
+            elif provider == constants.IMAGEIO_PIL:
+                im = Image.open(io.BytesIO(imgdata))
+                im.draft(None, (width, height))
+                pixbuf = pil_to_pixbuf(im, keep_orientation=True)
+            else:
+                raise TypeError()
+        except Exception as e:
+            # current provider could not load image
+            last_error = e
+        if pixbuf is not None:
+            # stop loop on success
+            log.debug("provider %s succeeded in decoding %s bytes at size %s",
+                      provider, len(imgdata), (width, height))
+            break
+        log.debug("provider %s failed to decode %s bytes at size %s",
+                  provider, len(imgdata), (width, height))
+    if pixbuf is None:
+        # raising necessary because caller expects pixbuf to be not None
+        raise last_error
+    return fit_in_rectangle(pixbuf, width, height, scaling_quality=GdkPixbuf.InterpType.BILINEAR)
+
+def _get_autocontrast_lut(histogram, cutoff):
+    """Return the lookup table used by ImageOps.autocontrast for a band
+    with the given <histogram>, removing <cutoff> percent of the lightest
+    and darkest pixels."""
+    histogram = list(histogram)
+    cut = sum(histogram) * cutoff // 100
+    for lo in range(256):
+        if cut > histogram[lo]:
+            cut -= histogram[lo]
+            histogram[lo] = 0
+        else:
+            histogram[lo] -= cut
+            cut = 0
+        if cut <= 0:
+            break
+    cut = sum(histogram) * cutoff // 100
+    for hi in range(255, -1, -1):
+        if cut > histogram[hi]:
+            cut -= histogram[hi]
+            histogram[hi] = 0
+        else:
+            histogram[hi] -= cut
+            cut = 0
+        if cut <= 0:
+            break
+    for lo in range(256):
+        if histogram[lo]:
+            break
+    for hi in range(255, -1, -1):
+        if histogram[hi]:
+            break
+    if hi <= lo:
+        return list(range(256))
+    scale = 255.0 / (hi - lo)
+    offset = -lo * scale
+    return [min(max(int(v * scale + offset), 0), 255) for v in range(256)]
+
 def enhance(pixbuf, brightness=1.0, contrast=1.0, saturation=1.0,
-  sharpness=1.0, autocontrast=False):
+  sharpness=1.0, autocontrast=False, histogram=None):
     """Return a modified pixbuf from <pixbuf> where the enhancement operations
     corresponding to each argument has been performed. A value of 1.0 means
     no change. If <autocontrast> is True it overrides the <contrast> value,
     but only if the image mode is supported by ImageOps.autocontrast (i.e.
     it is L or RGB.)
+
+    Brightness, contrast and autocontrast are per channel mappings: they
+    are combined in a single lookup table, computed from the histogram of
+    the image, and applied in one pass. Saturation and sharpness are only
+    applied when not neutral.
+
+    If not None, <histogram> is used instead of the histogram of <pixbuf>
+    (e.g. the histogram of the whole page <pixbuf> is a tile of).
     """
     im = pixbuf_to_pil(pixbuf)
-    if brightness != 1.0:
-        im = ImageEnhance.Brightness(im).enhance(brightness)
-    if autocontrast and im.mode in ('L', 'RGB'):
-        im = ImageOps.autocontrast(im, cutoff=0.1)
-    elif contrast != 1.0:
-        im = ImageEnhance.Contrast(im).enhance(contrast)
+    bands = len(im.getbands())
+    color_bands = min(bands, 3)
+    autocontrast = autocontrast and im.mode in ('L', 'RGB')
+    if brightness != 1.0 or contrast != 1.0 or autocontrast:
+        if histogram is None:
+            histogram = im.histogram()
+        luts = []
+        for band in range(color_bands):
+            lut = [min(max(int(v * brightness), 0), 255) for v in range(256)]
+            # Histogram of the band after the brightness change.
+            band_histogram = [0] * 256
+            for v, count in enumerate(histogram[band * 256:(band + 1) * 256]):
+                band_histogram[lut[v]] += count
+            luts.append((lut, band_histogram))
+        if autocontrast:
+            luts = [[autocontrast_lut[v] for v in lut]
+                    for lut, autocontrast_lut in
+                    ((lut, _get_autocontrast_lut(band_histogram, 0.1))
+                     for lut, band_histogram in luts)]
+        elif contrast != 1.0:
+            # Same as ImageEnhance.Contrast: blend with the mean
+            # luminance of the (brightness adjusted) image.
+            if 3 == color_bands:
+                weights = (0.299, 0.587, 0.114)
+            else:
+                weights = (1.0,)
+            total = float(max(sum(histogram[:256]), 1))
+            mean = sum(weight * sum(v * count for v, count in enumerate(band_histogram))
+                       for weight, (lut, band_histogram) in zip(weights, luts)) / total
+            mean = int(mean + 0.5)
+            luts = [[min(max(int(mean + (lut[v] - mean) * contrast), 0), 255)
+                     for v in range(256)]
+                    for lut, band_histogram in luts]
+        else:
+            luts = [lut for lut, band_histogram in luts]
+        # Alpha is left untouched.
+        for band in range(color_bands, bands):
+            luts.append(list(range(256)))
+        im = im.point([v for lut in luts for v in lut])
     if saturation != 1.0:
         im = ImageEnhance.Color(im).enhance(saturation)
     if sharpness != 1.0:
         im = ImageEnhance.Sharpness(im).enhance(sharpness)
     return pil_to_pixbuf(im)
 
+def load_pixbuf_reduced(path, width, height, imgdata=None):
+    """ Loads a static pixbuf from a given image file (or from <imgdata>,
+    if not None), reduced to fit inside (width, height), but never scaled
+    up. Unlike load_pixbuf_size(), the image is reduced while being decoded
+    when the format supports it (JPEG DCT scaling), instead of being
+    decoded at full size first, and its pixels and metadata are not
+    altered otherwise. Returns a (pixbuf, (original width, original
+    height)) tuple. """
+    original_size = []
+    def size_prepared(loader, image_width, image_height):
+        original_size[:] = image_width, image_height
+        loader.set_size(*get_fitting_size((image_width, image_height),
+                                          (width, height)))
+    if imgdata is None:
+        with open(path, 'rb') as fp:
+            imgdata = fp.read()
+    pixbuf = None
+    last_error = None
+    for provider in (constants.IMAGEIO_GDKPIXBUF, constants.IMAGEIO_PIL):
+        try:
+            # TODO use dynamic dispatch instead of "if" chain
+            if provider == constants.IMAGEIO_GDKPIXBUF:
+                loader = GdkPixbuf.PixbufLoader()
+                loader.connect('size-prepared', size_prepared)
+                loader.write(imgdata)
+                loader.close()
+                pixbuf = loader.get_pixbuf()
+            elif provider == constants.IMAGEIO_PIL:
+                im = Image.open(io.BytesIO(imgdata))
+                original_size[:] = im.size
+                im.draft(None, (width, height))
+                fitting_size = get_fitting_size(im.size, (width, height))
+                if fitting_size != im.size:
+                    im = im.resize(fitting_size, Image.BILINEAR)
+                pixbuf = pil_to_pixbuf(im, keep_orientation=True)
+            else:
+                raise TypeError()
+        except Exception as e:
+            # current provider could not load image
+            last_error = e
+        if pixbuf is not None:
+            # stop loop on success
+            log.debug("provider %s succeeded in decoding %s at size %s",
+                      provider, path, (pixbuf.get_width(), pixbuf.get_height()))
+            break
+        log.debug("provider %s failed to decode %s at size %s",
+                  provider, path, (width, height))
+    if pixbuf is None:
+        # raising necessary because caller expects pixbuf to be not None
+        raise last_error
+    return pixbuf, tuple(original_size)
+
 def _get_png_implied_rotation(pixbuf_or_image):
     """Same as <get_implied_rotation> for PNG files.
 
     Lookup for Exif data in the tEXt chunk.
     """
-    if isinstance(pixbuf_or_image, GdkPixbuf.Pixbuf()):
+    if isinstance(pixbuf_or_image, GdkPixbuf.Pixbuf):
         exif = pixbuf_or_image.get_option('tEXt::Raw profile type exif')
     elif isinstance(pixbuf_or_image, Image.Image):
         exif = pixbuf_or_image.info.get('Raw profile type exif')
@@ -537,6 +839,10 @@ def get_implied_rotation(pixbuf):
     if orientation is None:
         # Maybe it's a PNG? Try alternative method.
         orientation = _get_png_implied_rotation(pixbuf)
+    return _get_orientation_rotation(orientation)
+
+def _get_orientation_rotation(orientation):
+    """Return the rotation in degrees implied by the Exif <orientation>."""
     if orientation == '3':
         return 180
     elif orientation == '6':
@@ -633,6 +939,52 @@ def get_image_info(path):
         image_dimensions = (0, 0)
     return (image_format, image_dimensions, providers)
 
+#: Geometry of an image, as read from its header by get_image_geometry():
+#: its size, the rotation implied by its Exif orientation (see
+#: get_implied_rotation), its format, and whether it is an animation.
+ImageGeometry = namedtuple('ImageGeometry', 'width height rotation format animated')
+
+def get_image_geometry(path, imgdata=None):
+    """Return the ImageGeometry of the image at C{path}, or of the image
+    file contents C{imgdata} if not None, or None if the image cannot be
+    identified. Only the image header is parsed: no pixel data is decoded.
+    """
+    try:
+        if imgdata is None:
+            im = Image.open(path)
+        else:
+            im = Image.open(io.BytesIO(imgdata))
+    except Exception:
+        return None
+    try:
+        orientation = None
+        if im.info.get('exif') is not None:
+            orientation = (_getexif(im) or {}).get(274, None)
+        if orientation is not None:
+            orientation = str(orientation)
+        elif 'PNG' == im.format:
+            orientation = _get_png_implied_rotation(im)
+        animated = bool(getattr(im, 'is_animated', False))
+        return ImageGeometry(im.size[0], im.size[1],
+                             _get_orientation_rotation(orientation),
+                             im.format, animated)
+    except Exception as e:
+        log.debug('Could not read geometry of "%s": %s', path, e)
+        return None
+    finally:
+        im.close()
+
+def get_image_info_data(imgdata):
+    """Same as get_image_info(), but for the image file contents
+    C{imgdata}, e.g. as read from an archive without extraction.
+    """
+    try:
+        im = Image.open(io.BytesIO(imgdata))
+        return (im.format, im.size,
+                (constants.IMAGEIO_PIL, constants.IMAGEIO_GDKPIXBUF))
+    except IOError:
+        return (('Unknown filetype'), (0, 0), ())
+
 def get_supported_formats():
     global _SUPPORTED_IMAGE_FORMATS
     if _SUPPORTED_IMAGE_FORMATS is None:
@@ -97,6 +97,7 @@ BINDING_INFO = {
     'rotate_270_height' : { 'title': ('Rotate 90 degrees CCW'), 'group': ('Autorotate by height') },
 
     'double_page' : { 'title': ('Double page mode'), 'group': ('View mode') },
+    'strip_mode' : { 'title': ('Strip mode'), 'group': ('View mode') },
     'manga_mode' : { 'title': ('Manga mode'), 'group': ('View mode') },
     'invert_scroll' : { 'title': ('Invert smart scroll'), 'group': ('View mode') },
 
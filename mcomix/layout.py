@@ -1,5 +1,7 @@
 """ Layout. """
 
+import bisect
+
 from mcomix import constants
 from mcomix import scrolling
 from mcomix import tools
@@ -200,4 +202,67 @@ class FiniteLayout(object): # 2D only
         return (temp_wb_list, temp_wb_list[0])
 
 
+
+class StripLayout(object): # vertical only
+
+    def __init__(self, content_sizes, width, spacing):
+        """ Lays out any number of Boxes one below the other, centered
+        horizontally, e.g. all the pages of a book in strip mode. Finding
+        the Boxes visible in a viewport does not depend on their number.
+        @param content_sizes: The sizes of the Boxes to lay out.
+        @param width: The minimum width of the layout (e.g. the width of
+        the viewport).
+        @param spacing: Number of additional pixels between Boxes. """
+        self._sizes = [tuple(size) for size in content_sizes]
+        self._offsets = []
+        offset = 0
+        for size in self._sizes:
+            self._offsets.append(offset)
+            offset += size[1] + spacing
+        height = max(1, offset - spacing)
+        self._width = max([width] + [size[0] for size in self._sizes])
+        self.union_box = box.Box((self._width, height))
+
+
+    @staticmethod
+    def scale_to_width(size, width, scale_up):
+        """ Returns <size> scaled to <width>, keeping its aspect ratio.
+        Sizes narrower than <width> are left unchanged, unless <scale_up>
+        is True.
+        @return: The scaled size. """
+        if size[0] <= 0 or (size[0] <= width and not scale_up):
+            return tuple(size)
+        scale = float(width) / size[0]
+        return (width, max(1, int(round(size[1] * scale))))
+
+
+    def get_union_box(self):
+        """ Returns the union Box for this layout.
+        @return: The union Box for this layout. """
+        return self.union_box
+
+
+    def get_content_box(self, index):
+        """ Returns the Box at <index> as arranged in this layout.
+        @return: The Box at <index>. """
+        size = self._sizes[index]
+        return box.Box(size, ((self._width - size[0]) // 2, self._offsets[index]))
+
+
+    def get_index_at(self, y):
+        """ Returns the index of the Box at the vertical position <y>, or
+        of the closest Box if there is none (e.g. <y> falls in the spacing).
+        @return: The index of the Box at <y>, or -1 if there are no Boxes. """
+        if not self._offsets:
+            return -1
+        index = bisect.bisect_right(self._offsets, y) - 1
+        return min(max(index, 0), len(self._offsets) - 1)
+
+
+    def get_index_range(self, top, bottom):
+        """ Returns the first and last indexes of the Boxes intersecting
+        the vertical range from <top> to <bottom>.
+        @return: A (first, last) tuple. """
+        return self.get_index_at(top), self.get_index_at(bottom)
+
 # vim: expandtab:sw=4:ts=4
@@ -128,7 +128,8 @@ class MagnifyingLens(object):
             prefs['lens size'], prefs['lens size'])
         canvas.fill(image_tools.convert_rgb16list_to_rgba8int(self._window.get_bg_colour()))
         cb = self._window.layout.get_content_boxes()
-        source_pixbufs = self._window.imagehandler.get_pixbufs(len(cb))
+        source_pixbufs = self._window.imagehandler.get_pixbufs(
+            len(cb), full_resolution=True)
         for i in range(len(cb)):
             if image_tools.is_animation(source_pixbufs[i]):
                 continue
@@ -17,7 +17,8 @@ class _AddLibraryProgressDialog(Gtk.Dialog):
 
     def __init__(self, library, window, paths, collection):
         """Adds the books at <paths> to the library, and also to the
-        <collection>, unless it is None.
+        <collection>, unless it is None. Books still queued by an
+        interrupted import are added too.
         """
         super(_AddLibraryProgressDialog, self).__init__(('Adding books'), library,
             Gtk.DialogFlags.MODAL, (Gtk.STOCK_STOP, Gtk.ResponseType.CLOSE))
@@ -56,24 +57,31 @@ class _AddLibraryProgressDialog(Gtk.Dialog):
         main_box.pack_start(added_label, False, False)
         self.show_all()
 
-        total_paths_int = len(paths)
-        total_paths_float = float(len(paths))
+        # Books left over by an interrupted import are imported as well.
+        total_paths_int = library.backend.queue_books(paths, collection)
+        total_paths_float = float(total_paths_int)
+        total_processed = 0
         total_added = 0
 
-        for path in paths:
+        for result in library.backend.import_books():
 
-            if library.backend.add_book(path, collection):
-                total_added += 1
+            if result is not None:
+                path, added = result
+                total_processed += 1
+                if added:
+                    total_added += 1
 
-                number_label.set_text('%d / %d' % (total_added, total_paths_int))
+                    number_label.set_text('%d / %d' % (total_added, total_paths_int))
 
-            added_label.set_text(("Adding '%s'...") % path)
-            bar.set_fraction(total_added / total_paths_float)
+                added_label.set_text(("Adding '%s'...") % path)
+                bar.set_fraction(total_processed / total_paths_float)
 
             while Gtk.events_pending():
                 Gtk.main_iteration_do(False)
 
             if self._destroy:
+                # Stopped by the user: do not resume the import later.
+                library.backend.clear_import_queue()
                 return
 
         self._response()
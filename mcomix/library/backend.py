@@ -2,7 +2,9 @@
 
 import os
 import datetime
+import multiprocessing.pool
 
+from mcomix.preferences import prefs
 from mcomix import archive_tools
 from mcomix import constants
 from mcomix import thumbnail_tools
@@ -34,60 +36,90 @@ class _LibraryBackend(object):
 
     #: Current version of the library database structure.
     # See method _upgrade_database() for changes between versions.
-    DB_VERSION = 6
+    DB_VERSION = 9
 
-    def __init__(self):
+    #: Number of books written to the database per transaction when importing.
+    IMPORT_BATCH_SIZE = 100
 
-        def row_factory(cursor, row):
-            """Return rows as sequences only when they have more than
-            one element.
-            """
-            if len(row) == 1:
-                return row[0]
-            return row
+    def __init__(self):
 
         if dbapi2 is not None:
             self._con = dbapi2.connect(constants.LIBRARY_DATABASE_PATH,
                 check_same_thread=False, isolation_level=None)
-            self._con.row_factory = row_factory
+            self._con.row_factory = _row_factory
             self.enabled = True
 
             self.watchlist = backend_types._WatchList(self)
 
             version = self._library_version()
             self._upgrade_database(version, _LibraryBackend.DB_VERSION)
+            self._fts_enabled = self._con.execute('''select count(*)
+                from sqlite_master where name = 'book_fts' ''').fetchone() > 0
         else:
             self._con = None
             self.watchlist = None
             self.enabled = False
+            self._fts_enabled = False
 
     def get_books_in_collection(self, collection=None, filter_string=None):
         """Return a sequence with all the books in <collection>, or *ALL*
         books if <collection> is None. If <filter_string> is not None, we
         only return books where the <filter_string> occurs in the path.
         """
-        if collection is None:
-            if filter_string is None:
-                cur = self._con.execute('''select id from Book''')
-            else:
-                cur = self._con.execute('''select id from Book
-                    where path like ?''', ("%%%s%%" % filter_string, ))
+        sql, args = self._books_query('book.id', collection,
+                                      filter_string, 'path')
+        return self._con.execute(sql, args).fetchall()
+
+    def iter_books(self, collection=None, filter_string=None):
+        """Return an iterator over the L{backend_types._Book} instances in
+        <collection> and its subcollections, or over *ALL* books if
+        <collection> is None. If <filter_string> is not None, we only return
+        books where the <filter_string> occurs in the name. Books are read
+        from the database, and instantiated, as the iterator is consumed.
+        """
+        sql, args = self._books_query('''book.id, book.name, book.path,
+            book.pages, book.format, book.size, book.added''',
+            collection, filter_string, 'name')
+        cursor = self._con.execute(sql, args)
+        try:
+            for row in cursor:
+                yield backend_types._Book(*row)
+        finally:
+            cursor.close()
 
-            return cur.fetchall()
-        else:
-            books = []
-            subcollections = self.get_all_collections_in_collection(collection)
-            for coll in [ collection ] + subcollections:
-                if filter_string is None:
-                    cur = self._con.execute('''select id from Book
-                        where id in (select book from Contain where collection = ?)
-                        ''', (coll,))
-                else:
-                    cur = self._con.execute('''select id from Book
-                        where id in (select book from Contain where collection = ?)
-                        and path like ?''', (coll, "%%%s%%" % filter_string))
-                books.extend(cur.fetchall())
-            return books
+    def _books_query(self, columns, collection, filter_string, filter_column):
+        """Return a (sql, args) tuple for a single query selecting
+        <columns> of the books in <collection> and all its subcollections
+        (or all books if <collection> is None), optionally keeping only the
+        ones with <filter_string> in the field <filter_column>.
+        """
+        sql = 'select %s from book' % columns
+        conditions = []
+        args = []
+        if collection is not None:
+            sql = '''with recursive subcollection(id) as (
+                    select ?
+                    union
+                    select collection.id from collection
+                    join subcollection on collection.supercollection = subcollection.id)
+                ''' + sql
+            conditions.append('''book.id in (select book from contain
+                where collection in (select id from subcollection))''')
+            args.append(collection)
+        if filter_string:
+            # The trigram tokenizer only indexes substrings of at least
+            # three characters, shorter ones need a full table scan.
+            if self._fts_enabled and len(filter_string) >= 3:
+                conditions.append('''book.id in (select rowid from book_fts
+                    where book_fts match ?)''')
+                args.append('%s : "%s"' % (filter_column,
+                                           filter_string.replace('"', '""')))
+            else:
+                conditions.append("book.%s like '%%' || ? || '%%'" % filter_column)
+                args.append(filter_string)
+        if conditions:
+            sql += ' where ' + ' and '.join(conditions)
+        return sql, args
 
     def get_book_by_path(self, path):
         """ Retrieves a book from the library, specified by C{path}.
@@ -153,18 +185,26 @@ class _LibraryBackend(object):
         """ Returns a pixbuf with a thumbnail of the cover of the book at <path>,
         or None, if no thumbnail could be generated. """
 
-        # Use the maximum image size allowed by the library, so that thumbnails
-        # might be downscaled, but never need to be upscaled (and look ugly).
-        thumbnailer = thumbnail_tools.Thumbnailer(dst_dir=constants.LIBRARY_COVERS_PATH,
-                                                  store_on_disk=True,
-                                                  archive_support=True,
-                                                  size=(constants.MAX_LIBRARY_COVER_SIZE,
-                                                        constants.MAX_LIBRARY_COVER_SIZE))
-        thumb = thumbnailer.thumbnail(path)
+        thumb = self._get_cover_thumbnailer().thumbnail(path)
 
         if thumb is None: log.warning( _('! Could not get cover for book "%s"'), path )
         return thumb
 
+    def get_stored_book_thumbnails(self, paths):
+        """ Returns a dictionary mapping each of the books at <paths> with
+        an up to date stored cover thumbnail to its pixbuf, with a single
+        lookup for all books. Missing thumbnails are not created. """
+        return self._get_cover_thumbnailer().get_stored_thumbnails(paths)
+
+    def _get_cover_thumbnailer(self):
+        # Use the maximum image size allowed by the library, so that thumbnails
+        # might be downscaled, but never need to be upscaled (and look ugly).
+        return thumbnail_tools.Thumbnailer(dst_dir=constants.LIBRARY_COVERS_PATH,
+                                           store_on_disk=True,
+                                           archive_support=True,
+                                           size=(constants.MAX_LIBRARY_COVER_SIZE,
+                                                 constants.MAX_LIBRARY_COVER_SIZE))
+
     def get_book_name(self, book):
         """Return the name of <book>, or None if <book> isn't in the
         library.
@@ -222,16 +262,14 @@ class _LibraryBackend(object):
 
         if collection is None: raise ValueError("Collection must not be <None>")
 
-        to_search = [ collection ]
-        collections = [ ]
         # This assumes that the library is built like a tree, so no circular references.
-        while len(to_search) > 0:
-            collection = to_search.pop()
-            subcollections = self.get_collections_in_collection(collection)
-            collections.extend(subcollections)
-            to_search.extend(subcollections)
-
-        return collections
+        cur = self._con.execute('''with recursive subcollection(id) as (
+                select id from collection where supercollection = ?
+                union all
+                select collection.id from collection
+                join subcollection on collection.supercollection = subcollection.id)
+            select id from subcollection''', (collection,))
+        return cur.fetchall()
 
     def get_all_collections(self):
         """Return a sequence with all collections (flattened hierarchy).
@@ -305,14 +343,22 @@ class _LibraryBackend(object):
         added).
         """
         path = os.path.abspath(path)
-        name = os.path.basename(path)
         info = archive_tools.get_archive_info(path)
         if info is None:
             return False
+        return self._store_book(path, info, collection)
+
+    def _store_book(self, path, info, collection):
+        """Add or update the book at <path> with the archive <info> (as
+        returned by archive_tools.get_archive_info()), and put it into
+        <collection> unless it is None. Return True on success.
+        """
+        name = os.path.basename(path)
         format, pages, size = info
 
-        # Thumbnail for the newly added book will be generated once it
-        # is actually needed with get_book_thumbnail().
+        # Unless created by import_books(), the thumbnail for the newly
+        # added book will be generated once it is actually needed with
+        # get_book_thumbnail().
         old = self._con.execute('''select id from Book
             where path = ?''', (path,)).fetchone()
         try:
@@ -343,6 +389,83 @@ class _LibraryBackend(object):
             log.error( _('! Could not add book "%s" to the library'), path )
             return False
 
+    def queue_books(self, paths, collection=None):
+        """Queue the archives at <paths> for import by import_books(),
+        putting them into <collection> unless it is None. The queue is
+        stored in the database, so an interrupted import can be resumed
+        later. Return the number of queued books.
+        """
+        self.begin_transaction()
+        try:
+            for path in paths:
+                self._con.execute('''insert or replace into import_queue
+                    (path, collection) values (?, ?)''',
+                    (os.path.abspath(path), collection))
+        finally:
+            self.end_transaction()
+        return self.get_import_queue_size()
+
+    def get_import_queue_size(self):
+        """Return the number of books waiting to be imported."""
+        return self._con.execute('''select count(*) from import_queue''').fetchone()
+
+    def clear_import_queue(self):
+        """Cancel the import of all queued books."""
+        self._con.execute('''delete from import_queue''')
+
+    def import_books(self, create_covers=True):
+        """Import all the books queued by queue_books(), including the ones
+        left over by an interrupted import. This is a generator: it yields a
+        (path, success) tuple after each processed book, or None when no
+        book is ready yet, so that the caller can keep its user interface
+        responsive.
+
+        Archives are probed (and their cover thumbnail created, if
+        <create_covers> is True) by a pool of worker threads, while the
+        results are written by the calling thread, IMPORT_BATCH_SIZE books
+        per transaction. Books are removed from the queue in the same
+        transaction, so that an interrupted import never needs to process
+        them again.
+        """
+        queue = dict(self._con.execute('''select path, collection
+            from import_queue order by rowid''').fetchall())
+        if not queue:
+            return
+
+        def probe(path):
+            info = archive_tools.get_archive_info(path)
+            if info is not None and create_covers:
+                self.get_book_thumbnail(path)
+            return path, info
+
+        pool = multiprocessing.pool.ThreadPool(prefs['max threads'])
+        results = pool.imap_unordered(probe, queue.keys())
+        pending = 0
+        self.begin_transaction()
+        try:
+            for _unused in range(len(queue)):
+                while True:
+                    try:
+                        path, info = results.next(timeout=0.1)
+                        break
+                    except multiprocessing.TimeoutError:
+                        yield None
+                if info is None:
+                    success = False
+                else:
+                    success = self._store_book(path, info, queue[path])
+                self._con.execute('''delete from import_queue
+                    where path = ?''', (path,))
+                pending += 1
+                if pending >= _LibraryBackend.IMPORT_BATCH_SIZE:
+                    self.end_transaction()
+                    self.begin_transaction()
+                    pending = 0
+                yield path, success
+        finally:
+            self.end_transaction()
+            pool.terminate()
+
     @callback.Callback
     def book_added(self, book):
         """ Event that triggers when a new book is successfully added to the
@@ -484,6 +607,35 @@ class _LibraryBackend(object):
         connection. """
         return self._con.execute(*args)
 
+    def move_book(self, old_path, new_path):
+        """Update the path of the book at <old_path> that was moved (or
+        renamed) to <new_path>, keeping its collections and reading state.
+        Return True if the book was found and updated.
+        """
+        old_path = os.path.abspath(old_path)
+        new_path = os.path.abspath(new_path)
+        try:
+            cursor = self._con.execute('''update Book set
+                name = ?, path = ? where path = ?''',
+                (os.path.basename(new_path), new_path, old_path))
+        except dbapi2.Error: # E.g. new path already in the library.
+            log.error( _('! Could not move book "%(old)s" to "%(new)s"'),
+                {"old" : old_path, "new" : new_path} )
+            return False
+        if cursor.rowcount < 1:
+            return False
+        thumbnailer = thumbnail_tools.Thumbnailer(dst_dir=constants.LIBRARY_COVERS_PATH)
+        thumbnailer.delete(old_path)
+        return True
+
+    def open_connection(self):
+        """ Opens a new connection to the library database, for worker
+        threads that need their own transactions. The caller is responsible
+        for closing it. """
+        con = dbapi2.connect(constants.LIBRARY_DATABASE_PATH)
+        con.row_factory = _row_factory
+        return con
+
     def begin_transaction(self):
         """ Normally, the connection is in auto-commit mode. Calling
         this method will switch to transactional mode, automatically
@@ -548,6 +700,11 @@ class _LibraryBackend(object):
         self._create_table_info()
         self._create_table_watchlist()
         self._create_table_recent()
+        self._create_table_import_queue()
+        self._create_indexes()
+        self._create_table_book_fts()
+        self._create_table_watchdir()
+        self._create_table_watchfile()
 
     def _upgrade_database(self, from_version, to_version):
         """ Performs sequential upgrades to the database, bringing
@@ -616,6 +773,20 @@ class _LibraryBackend(object):
                     select id, name, supercollection from collection_old''')
                 self._con.execute('''drop table collection_old''')
 
+            if 6 in upgrades:
+                # Added table 'import_queue' to resume interrupted imports
+                self._create_table_import_queue()
+
+            if 7 in upgrades:
+                # Added indexes and the 'book_fts' full text index
+                self._create_indexes()
+                self._create_table_book_fts()
+
+            if 8 in upgrades:
+                # Added tables 'watchdir' and 'watchfile' for incremental scans
+                self._create_table_watchdir()
+                self._create_table_watchfile()
+
             self._con.execute('''update info set value = ? where key = 'version' ''',
                               (str(_LibraryBackend.DB_VERSION),))
 
@@ -655,6 +826,27 @@ class _LibraryBackend(object):
             collection integer references collection (id) on delete set null,
             recursive boolean not null)''')
 
+    def _create_table_watchdir(self):
+        # Snapshot of the watched directories, used to skip the ones
+        # left unchanged since the previous scan.
+        self._con.execute('''create table if not exists watchdir (
+            path text primary key,
+            parent text,
+            mtime integer not null,
+            inode integer not null)''')
+        self._con.execute('''create index if not exists watchdir_parent
+            on watchdir (parent)''')
+
+    def _create_table_watchfile(self):
+        # Archives found in the watched directories by the previous scan.
+        self._con.execute('''create table if not exists watchfile (
+            path text primary key,
+            directory text not null,
+            inode integer not null,
+            size integer not null)''')
+        self._con.execute('''create index if not exists watchfile_directory
+            on watchfile (directory)''')
+
     def _create_table_recent(self):
         self._con.execute('''create table if not exists recent (
             book integer primary key,
@@ -663,6 +855,60 @@ class _LibraryBackend(object):
         self._con.execute('''insert or ignore into collection (id, name)
             values (?, ?)''', (COLLECTION_RECENT, _('Recent')))
 
+    def _create_table_import_queue(self):
+        self._con.execute('''create table if not exists import_queue (
+            path text primary key,
+            collection integer)''')
+
+    def _create_indexes(self):
+        # Book(path) and Contain(collection, book) are already indexed
+        # through their unique and primary key constraints.
+        self._con.execute('''create index if not exists contain_book
+            on contain (book)''')
+        self._con.execute('''create index if not exists collection_supercollection
+            on collection (supercollection)''')
+
+    def _create_table_book_fts(self):
+        """ Creates the full text index over book names and paths, kept
+        up to date by triggers. This requires the FTS5 extension with the
+        trigram tokenizer (sqlite 3.34), filtering falls back to full table
+        scans if it is not available. """
+        try:
+            self._con.execute('''create virtual table if not exists book_fts
+                using fts5(name, path, content='book', content_rowid='id',
+                           tokenize='trigram')''')
+        except dbapi2.OperationalError:
+            log.warning(_('! Full text search is not supported by sqlite, '
+                          'library filtering will be slower.'))
+            return
+        self._con.execute('''create trigger if not exists book_fts_insert
+            after insert on book begin
+                insert into book_fts (rowid, name, path)
+                values (new.id, new.name, new.path);
+            end''')
+        self._con.execute('''create trigger if not exists book_fts_delete
+            after delete on book begin
+                insert into book_fts (book_fts, rowid, name, path)
+                values ('delete', old.id, old.name, old.path);
+            end''')
+        self._con.execute('''create trigger if not exists book_fts_update
+            after update of name, path on book begin
+                insert into book_fts (book_fts, rowid, name, path)
+                values ('delete', old.id, old.name, old.path);
+                insert into book_fts (rowid, name, path)
+                values (new.id, new.name, new.path);
+            end''')
+        self._con.execute('''insert into book_fts (book_fts) values ('rebuild')''')
+
+
+def _row_factory(cursor, row):
+    """Return rows as sequences only when they have more than
+    one element.
+    """
+    if len(row) == 1:
+        return row[0]
+    return row
+
 
 _backend = None
 
@@ -6,6 +6,12 @@ import datetime
 
 from mcomix import callback
 from mcomix import archive_tools
+from mcomix import log
+
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
 
 
 class _BackendObject(object):
@@ -131,28 +137,12 @@ class _Collection(_BackendObject):
     def get_books(self, filter_string=None):
         """ Returns all books that are part of this collection,
         including subcollections. """
+        return list(self.iter_books(filter_string))
 
-        books = []
-        for collection in [ self ] + self.get_all_collections():
-            sql = '''SELECT book.id, book.name, book.path, book.pages, book.format,
-                            book.size, book.added
-                     FROM book
-                     JOIN contain ON contain.book = book.id
-                                     AND contain.collection = ?
-                  '''
-
-            sql_args = [collection.id]
-            if filter_string:
-                sql += ''' WHERE book.name LIKE '%' || ? || '%' '''
-                sql_args.append(filter_string)
-
-            cursor = self.get_backend().execute(sql, sql_args)
-            rows = cursor.fetchall()
-            cursor.close()
-
-            books.extend([ _Book(*cols) for cols in rows ])
-
-        return books
+    def iter_books(self, filter_string=None):
+        """ Same as get_books(), but returns an iterator reading the books
+        from the database as it is consumed. """
+        return self.get_backend().iter_books(self.id, filter_string)
 
     def get_collections(self):
         """ Returns a list of all direct subcollections of this instance. """
@@ -202,21 +192,12 @@ class _DefaultCollection(_Collection):
 
     def get_books(self, filter_string=None):
         """ Returns all books in the library """
-        sql = '''SELECT book.id, book.name, book.path, book.pages, book.format,
-                        book.size, book.added
-                 FROM book
-              '''
+        return list(self.iter_books(filter_string))
 
-        sql_args = []
-        if filter_string:
-            sql += ''' WHERE book.name LIKE '%' || ? || '%' '''
-            sql_args.append(filter_string)
-
-        cursor = self.get_backend().execute(sql, sql_args)
-        rows = cursor.fetchall()
-        cursor.close()
-
-        return [ _Book(*cols) for cols in rows ]
+    def iter_books(self, filter_string=None):
+        """ Same as get_books(), but returns an iterator reading the books
+        from the database as it is consumed. """
+        return self.get_backend().iter_books(None, filter_string)
 
     def add_collection(self, subcollection):
         """ Removes C{subcollection} from any supercollections and moves
@@ -250,8 +231,16 @@ class _WatchList(object):
     been added. This object is part of the library backend, i.e.
     C{library.backend.watchlist}. """
 
+    #: Delay in seconds between a change in a watched directory
+    #: and the following scan, so that bulk copies trigger a single scan.
+    MONITOR_DELAY = 2.0
+
     def __init__(self, backend):
         self.backend = backend
+        self._scan_lock = threading.Lock()
+        self._monitor_lock = threading.Lock()
+        self._notifier = None
+        self._timer = None
 
     def add_directory(self, path, collection=DefaultCollection, recursive=False):
         """ Adds a new watched directory. """
@@ -308,12 +297,89 @@ class _WatchList(object):
 
     def _scan_for_new_files_thread(self):
         """ Executes the actual scanning operation in a new thread. """
-        existing_books = [book.path for book in DefaultCollection.get_books()
-                          # Also add book if it was only found in Recent collection
-                          if book.get_collections() != [-2]]
+        with self._scan_lock:
+            con = self.backend.open_connection()
+            try:
+                for entry in self.get_watchlist():
+                    self._scan_entry(con, entry)
+            finally:
+                con.close()
+
+    def _scan_entry(self, con, entry):
+        """ Scans the watched directory <entry>, using the connection
+        <con>, and reports new, removed and moved books. """
+        files, removed = entry.scan(con)
+        con.commit()
+        library = entry.get_library_paths(con)
+
+        new_files = [path for path in files if path not in library]
+        removed = dict((path, key) for path, key in removed.items()
+                       if path in library)
+
+        # A book removed and a new file with the same inode and size is
+        # considered to have been moved (or renamed).
+        candidates = dict((files[path], path) for path in new_files
+                          if files[path][0])
+        moved = []
+        for path, key in removed.items():
+            if key in candidates:
+                moved.append((path, candidates.pop(key)))
+        moved_from = frozenset(old for old, new in moved)
+        moved_to = frozenset(new for old, new in moved)
+
+        self.new_files_found([path for path in new_files if path not in moved_to],
+                             entry,
+                             removed=[path for path in removed if path not in moved_from],
+                             moved=moved)
+
+    def start_monitoring(self):
+        """ Monitors the watched directories for changes using inotify,
+        scanning them shortly after a change, until stop_monitoring() is
+        called. Calling it again takes watch list changes into account.
+        Does nothing if pyinotify is not available. """
+        if pyinotify is None:
+            return
+
+        self.stop_monitoring()
+        mask = (pyinotify.IN_CREATE | pyinotify.IN_CLOSE_WRITE |
+                pyinotify.IN_DELETE | pyinotify.IN_MOVED_FROM |
+                pyinotify.IN_MOVED_TO)
+        manager = pyinotify.WatchManager()
+        notifier = pyinotify.ThreadedNotifier(manager, self._directory_changed)
+        notifier.daemon = True
+        notifier.start()
         for entry in self.get_watchlist():
-            new_files = entry.get_new_files(existing_books)
-            self.new_files_found(new_files, entry)
+            if entry.is_valid():
+                manager.add_watch(entry.directory, mask,
+                                  rec=entry.recursive, auto_add=entry.recursive)
+        with self._monitor_lock:
+            self._notifier = notifier
+
+    def stop_monitoring(self):
+        """ Stops monitoring the watched directories. """
+        with self._monitor_lock:
+            notifier, self._notifier = self._notifier, None
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+        if notifier is not None:
+            notifier.stop()
+
+    def _directory_changed(self, event):
+        """ Called by the inotify thread for each change in a watched
+        directory. Schedules a scan, restarting the delay if one is
+        already pending. """
+        if not event.dir and not archive_tools.is_archive_file(event.name):
+            return
+        with self._monitor_lock:
+            if self._notifier is None:
+                return
+            if self._timer is not None:
+                self._timer.cancel()
+            self._timer = threading.Timer(_WatchList.MONITOR_DELAY,
+                                          self.scan_for_new_files)
+            self._timer.daemon = True
+            self._timer.start()
 
     def _result_row_to_watchlist_entry(self, row):
         """ Converts the result of a SELECT statement to a WatchListEntry. """
@@ -327,11 +393,15 @@ class _WatchList(object):
 
 
     @callback.Callback
-    def new_files_found(self, paths, watchentry):
+    def new_files_found(self, paths, watchentry, removed=(), moved=()):
         """ Called after scan_for_new_files finishes.
         @param paths: List of filenames for newly added files. This list
                       may be empty if no new files were found during the scan.
         @param watchentry: Watchentry for files/directory.
+        @param removed: List of filenames of books in the library that were
+                        removed from the directory since the previous scan.
+        @param moved: List of (old, new) filenames of books in the library
+                      that were moved or renamed since the previous scan.
         """
         pass
 
@@ -344,29 +414,129 @@ class _WatchListEntry(_BackendObject):
         self.recursive = bool(recursive)
         self.collection = collection
 
-    def get_new_files(self, filelist):
-        """ Returns a list of files that are present in the watched directory,
-        but not in the list of files passed in C{filelist}. """
-
-        if not self.is_valid():
-            return []
+    def scan(self, con):
+        """ Lists the archives in the watched directory, using and updating
+        the snapshot stored by the previous scan with the database
+        connection C{con}. Directories whose modification time and inode
+        are unchanged since the previous scan are not listed again.
 
-        old_files = frozenset([os.path.abspath(path) for path in filelist])
-
-        if not self.recursive:
-            available_files = frozenset([os.path.join(self.directory, filename)
-                for filename in os.listdir(self.directory)
-                if archive_tools.is_archive_file(filename)])
-        else:
-            available_files = []
-            for dirpath, dirnames, filenames in os.walk(self.directory):
-                for filename in filter(archive_tools.is_archive_file, filenames):
-                    path = os.path.join(dirpath, filename)
-                    available_files.append(path)
+        @return: Tuple (files, removed) of dictionaries, mapping the paths
+        of the archives present in the directory, and of the ones removed
+        since the previous scan, to their (inode, size). """
 
-            available_files = frozenset(available_files)
-
-        return list(available_files.difference(old_files))
+        if not self.is_valid():
+            return {}, {}
+
+        low, high = self._get_path_range()
+        old_dirs = {}
+        children = {}
+        for path, parent, mtime, inode in con.execute(
+                '''select path, parent, mtime, inode from watchdir
+                   where path = ? or (path > ? and path < ?)''',
+                (self.directory, low, high)):
+            old_dirs[path] = (mtime, inode)
+            children.setdefault(parent, []).append(path)
+        old_files = {}
+        for path, directory, inode, size in con.execute(
+                '''select path, directory, inode, size from watchfile
+                   where directory = ? or (directory > ? and directory < ?)''',
+                (self.directory, low, high)):
+            old_files.setdefault(directory, {})[path] = (inode, size)
+
+        files = {}
+        removed = {}
+        seen = set()
+        to_scan = [self.directory]
+        while to_scan:
+            directory = to_scan.pop()
+            try:
+                stat = os.stat(directory)
+            except OSError:
+                continue
+            seen.add(directory)
+            state = (stat.st_mtime_ns, stat.st_ino)
+
+            if old_dirs.get(directory) == state:
+                # Unchanged since the previous scan.
+                files.update(old_files.get(directory, {}))
+                subdirs = children.get(directory, [])
+            else:
+                dir_files, subdirs = self._list_directory(directory)
+                files.update(dir_files)
+                for path, key in old_files.get(directory, {}).items():
+                    if path not in dir_files:
+                        removed[path] = key
+                con.execute('''insert or replace into watchdir
+                    (path, parent, mtime, inode) values (?, ?, ?, ?)''',
+                    (directory, os.path.dirname(directory)) + state)
+                # Subdirectories are recorded even when not recursive,
+                # but are listed when first visited.
+                con.executemany('''insert or ignore into watchdir
+                    (path, parent, mtime, inode) values (?, ?, -1, -1)''',
+                    [(path, directory) for path in subdirs])
+                con.execute('''delete from watchfile where directory = ?''',
+                    (directory,))
+                con.executemany('''insert into watchfile
+                    (path, directory, inode, size) values (?, ?, ?, ?)''',
+                    [(path, directory) + key for path, key in dir_files.items()])
+
+            if self.recursive:
+                to_scan.extend(subdirs)
+
+        if self.recursive:
+            # Forget about directories that do not exist anymore.
+            for directory in old_dirs:
+                if directory in seen:
+                    continue
+                removed.update(old_files.get(directory, {}))
+                con.execute('''delete from watchdir where path = ?''', (directory,))
+                con.execute('''delete from watchfile where directory = ?''',
+                    (directory,))
+
+        return files, removed
+
+    def get_library_paths(self, con):
+        """ Returns the set of paths of the library books within the watched
+        directory, using the database connection C{con}. Books that only
+        belong to the Recent collection are not included. """
+        low, high = self._get_path_range()
+        cursor = con.execute('''select path from book
+            where path > ? and path < ? and (
+                not exists (select 1 from contain
+                            where book = book.id and collection = -2)
+                or exists (select 1 from contain
+                           where book = book.id and collection != -2))''',
+            (low, high))
+        return frozenset(cursor.fetchall())
+
+    def _get_path_range(self):
+        """ Returns a (low, high) tuple of strings, so that all the paths
+        within the watched directory, and only them, are strictly between
+        low and high. """
+        prefix = os.path.join(self.directory, u'')
+        return prefix, prefix[:-1] + chr(ord(os.sep) + 1)
+
+    @staticmethod
+    def _list_directory(directory):
+        """ Returns a (files, subdirs) tuple for <directory>, with files
+        a dictionary mapping the archives' paths to their (inode, size). """
+        files = {}
+        subdirs = []
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            subdirs.append(entry.path)
+                        elif (archive_tools.is_archive_file(entry.name) and
+                              entry.is_file()):
+                            files[entry.path] = (entry.inode(), entry.stat().st_size)
+                    except OSError:
+                        # E.g. removed since listed.
+                        continue
+        except OSError as e:
+            log.warning('! Could not list directory "%s": %s', directory, e)
+        return files, subdirs
 
     def is_valid(self):
         """ Check if the watched directory is a valid directory and exists. """
@@ -379,6 +549,15 @@ class _WatchListEntry(_BackendObject):
         cursor = self.get_backend().execute(sql, (self.directory,))
         cursor.close()
 
+        # Forget about the directory snapshot.
+        low, high = self._get_path_range()
+        self.get_backend().execute("""DELETE FROM watchdir
+            WHERE path = ? OR (path > ? AND path < ?)""",
+            (self.directory, low, high))
+        self.get_backend().execute("""DELETE FROM watchfile
+            WHERE directory = ? OR (directory > ? AND directory < ?)""",
+            (self.directory, low, high))
+
         self.directory = u""
         self.collection = None
 
@@ -66,6 +66,7 @@ class _BookArea(Gtk.ScrolledWindow):
             5, # status
         )
         self._iconview.generate_thumbnail = self._get_pixbuf
+        self._iconview.get_stored_thumbnails = self._get_stored_pixbufs
         self._iconview.connect('item_activated', self._book_activated)
         self._iconview.connect('selection_changed', self._selection_changed)
         self._iconview.connect_after('drag_begin', self._drag_begin)
@@ -229,7 +230,7 @@ class _BookArea(Gtk.ScrolledWindow):
         self._liststore.clear()
 
         collection = self._library.backend.get_collection_by_id(collection_id)
-        books = collection.get_books(self._library.filter_string)
+        books = collection.iter_books(self._library.filter_string)
         self.add_books(books)
 
         # Re-attach model here
@@ -241,7 +242,7 @@ class _BookArea(Gtk.ScrolledWindow):
 
     def add_books(self, books):
         """ Adds new book covers to the icon view.
-        @param books: List of L{_Book} instances. """
+        @param books: Iterable of L{_Book} instances. """
         filler = self._get_empty_thumbnail()
 
         for book in books:
@@ -434,12 +435,42 @@ class _BookArea(Gtk.ScrolledWindow):
         if self._cache.exists(book.path):
             pixbuf = self._cache.get(book.path)
         else:
-            width, height = self._pixbuf_size(border_size=0)
             pixbuf = self._library.backend.get_book_thumbnail(book.path) or image_tools.MISSING_IMAGE_ICON
-            pixbuf = image_tools.fit_in_rectangle(pixbuf, width, height, scale_up=True)
-            pixbuf = image_tools.add_border(pixbuf, 1, 0xFFFFFFFF)
-            self._cache.add(book.path, pixbuf)
+            pixbuf = self._add_to_cache(book, pixbuf)
+        return self._add_read_indicator(book, pixbuf)
+
+    def _get_stored_pixbufs(self, uids):
+        """ Return a dictionary mapping each of the books <uids> with an
+        already stored (or cached) thumbnail to its pixbuf, using a single
+        thumbnail store lookup for all of them. """
+        books = {}
+        pixbufs = {}
+        for uid in uids:
+            book = self._library.backend.get_book_by_id(uid)
+            if book is None:
+                continue
+            if self._cache.exists(book.path):
+                pixbufs[uid] = self._add_read_indicator(book, self._cache.get(book.path))
+            else:
+                books[book.path] = (uid, book)
+        stored = self._library.backend.get_stored_book_thumbnails(list(books.keys()))
+        for path, pixbuf in stored.items():
+            uid, book = books[path]
+            pixbufs[uid] = self._add_read_indicator(book, self._add_to_cache(book, pixbuf))
+        return pixbufs
+
+    def _add_to_cache(self, book, pixbuf):
+        """ Scale the cover thumbnail <pixbuf> of <book> for display,
+        and cache the result. """
+        width, height = self._pixbuf_size(border_size=0)
+        pixbuf = image_tools.fit_in_rectangle(pixbuf, width, height, scale_up=True)
+        pixbuf = image_tools.add_border(pixbuf, 1, 0xFFFFFFFF)
+        self._cache.add(book.path, pixbuf)
+        return pixbuf
 
+    def _add_read_indicator(self, book, pixbuf):
+        """ Return <pixbuf>, with an indicator if <book> was read until
+        the end. """
         # Display indicator of having finished reading the book.
         # This information isn't cached in the pixbuf cache, as it changes frequently.
 
@@ -47,6 +47,7 @@ class _LibraryDialog(Gtk.Window):
         self.collection_area = library_collection_area._CollectionArea(self)
 
         self.backend.watchlist.new_files_found += self._new_files_found
+        self.backend.watchlist.start_monitoring()
 
         table = Gtk.Table(2, 2, False)
         table.attach(self.collection_area, 0, 1, 0, 1, Gtk.AttachOptions.FILL,
@@ -81,13 +82,26 @@ class _LibraryDialog(Gtk.Window):
     def scan_for_new_files(self):
         """ Start scanning for new files from the watch list. """
 
+        # Restart monitoring, in case the watch list changed.
+        self.backend.watchlist.start_monitoring()
+
         if len(self.backend.watchlist.get_watchlist()) > 0:
             self.set_status_message(("Scanning for new books..."))
             self.backend.watchlist.scan_for_new_files()
 
-    def _new_files_found(self, filelist, watchentry):
+    def _new_files_found(self, filelist, watchentry, removed=(), moved=()):
         """ Called after the scan for new files finished. """
 
+        if len(moved) > 0:
+            for old_path, new_path in moved:
+                self.backend.move_book(old_path, new_path)
+            self.book_area.display_covers(
+                self.collection_area.get_current_collection())
+
+        if len(removed) > 0:
+            log.info('%d books were removed from directory "%s"',
+                     len(removed), watchentry.directory)
+
         if len(filelist) > 0:
             if watchentry.collection.id is not None:
                 collection_name = watchentry.collection.name
@@ -105,6 +119,14 @@ class _LibraryDialog(Gtk.Window):
 
             self.set_status_message(message % {'directory': watchentry.directory,
                 'count': len(filelist), 'bookname': os.path.basename(filelist[0])})
+        elif len(moved) > 0:
+            self.set_status_message(("Updated %(count)d moved books "
+                "in directory '%(directory)s'.") % {'count': len(moved),
+                'directory': watchentry.directory})
+        elif len(removed) > 0:
+            self.set_status_message(("%(count)d books were removed "
+                "from directory '%(directory)s'.") % {'count': len(removed),
+                'directory': watchentry.directory})
         else:
             self.set_status_message(
                 ("No new books found in directory '%s'.") % watchentry.directory)
@@ -125,6 +147,7 @@ class _LibraryDialog(Gtk.Window):
         """Close the library and do required cleanup tasks."""
         prefs['lib window width'], prefs['lib window height'] = self.get_size()
         self.backend.watchlist.new_files_found -= self._new_files_found
+        self.backend.watchlist.stop_monitoring()
         self.book_area.stop_update()
         self.book_area.close()
         file_chooser_library_dialog.close_library_filechooser_dialog()
@@ -175,6 +198,11 @@ def open_dialog(action, window):
         else:
             _dialog = _LibraryDialog(window, window.filehandler)
 
+            if _dialog.backend.get_import_queue_size() > 0:
+                # Resume an interrupted import.
+                library_add_progress_dialog._AddLibraryProgressDialog(
+                    _dialog, window, [], None)
+
     else:
         _dialog.present()
 
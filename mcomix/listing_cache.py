@@ -0,0 +1,166 @@
+"""listing_cache.py - Persistent cache of archive listings using sqlite."""
+from __future__ import with_statement
+
+import os
+import json
+import threading
+
+from mcomix import constants
+from mcomix import log
+
+try:
+    from sqlite3 import dbapi2
+except ImportError:
+    log.warning( ('! Could neither find sqlite3.') )
+    dbapi2 = None
+
+
+class ListingCache(object):
+
+    """ Store the listing of archives (format, member names and solid flag)
+    in a sqlite database, so that unchanged archives do not need to be
+    opened again, e.g. when the library is scanned. The resolution PDF
+    pages should be rendered at is stored too, as finding it requires
+    interpreting each page, and so is the geometry of the pages (see
+    geometry_index), as finding it requires extracting them.
+
+    Listings are indexed by archive path, and are only returned if the
+    modification time and size of the archive still match.
+
+    All methods are thread safe.
+    """
+
+    def __init__(self, path):
+        """ Open (and create if necessary) the listing database at <path>. """
+        self._lock = threading.Lock()
+        self._con = None
+        if dbapi2 is None:
+            return
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._con = dbapi2.connect(path, check_same_thread=False,
+                                   isolation_level=None)
+        self._con.execute('''create table if not exists Listing (
+            path text primary key,
+            mtime integer not null,
+            size integer not null,
+            type integer not null,
+            solid integer not null,
+            contents text not null)''')
+        self._con.execute('''create table if not exists RenderDpi (
+            path text primary key,
+            mtime integer not null,
+            size integer not null,
+            dpi text not null)''')
+        self._con.execute('''create table if not exists Geometry (
+            path text primary key,
+            mtime integer not null,
+            size integer not null,
+            geometry text not null)''')
+
+    @property
+    def enabled(self):
+        return self._con is not None
+
+    def get(self, path, mtime, size):
+        """ Return a (type, contents, solid) tuple for the archive at <path>,
+        with <type> its archive format, <contents> the list of its members
+        names, and <solid> True if it is a solid archive. Return None if
+        not stored, or stored for a different <mtime> or <size>. """
+        if not self.enabled:
+            return None
+        with self._lock:
+            row = self._con.execute('''select mtime, size, type, solid, contents
+                from Listing where path = ?''', (path,)).fetchone()
+        if row is None or (row[0], row[1]) != (int(mtime), size):
+            return None
+        return row[2], json.loads(row[4]), bool(row[3])
+
+    def put(self, path, mtime, size, type, contents, solid):
+        """ Store the listing of the archive at <path>, replacing any
+        existing one. """
+        if not self.enabled:
+            return
+        with self._lock:
+            self._con.execute('''insert or replace into Listing
+                (path, mtime, size, type, solid, contents)
+                values (?, ?, ?, ?, ?, ?)''',
+                (path, int(mtime), size, type, bool(solid), json.dumps(contents)))
+
+    def get_render_dpi(self, path, mtime, size):
+        """ Return a dictionary mapping page numbers of the document at
+        <path> to the resolution they should be rendered at, or None if not
+        stored, or stored for a different <mtime> or <size>. """
+        if not self.enabled:
+            return None
+        with self._lock:
+            row = self._con.execute('''select mtime, size, dpi
+                from RenderDpi where path = ?''', (path,)).fetchone()
+        if row is None or (row[0], row[1]) != (int(mtime), size):
+            return None
+        return dict((int(page), dpi) for page, dpi in json.loads(row[2]).items())
+
+    def put_render_dpi(self, path, mtime, size, dpi):
+        """ Store the <dpi> dictionary (see get_render_dpi()) for the
+        document at <path>, replacing any existing one. """
+        if not self.enabled:
+            return
+        with self._lock:
+            self._con.execute('''insert or replace into RenderDpi
+                (path, mtime, size, dpi) values (?, ?, ?, ?)''',
+                (path, int(mtime), size, json.dumps(dpi)))
+
+    def get_geometry(self, path, mtime, size):
+        """ Return a dictionary mapping member names of the archive at
+        <path> to the list of fields of their page geometry, or None if not
+        stored, or stored for a different <mtime> or <size>. """
+        if not self.enabled:
+            return None
+        with self._lock:
+            row = self._con.execute('''select mtime, size, geometry
+                from Geometry where path = ?''', (path,)).fetchone()
+        if row is None or (row[0], row[1]) != (int(mtime), size):
+            return None
+        return json.loads(row[2])
+
+    def put_geometry(self, path, mtime, size, geometry):
+        """ Store the <geometry> dictionary (see get_geometry()) for the
+        archive at <path>, replacing any existing one. """
+        if not self.enabled:
+            return
+        with self._lock:
+            self._con.execute('''insert or replace into Geometry
+                (path, mtime, size, geometry) values (?, ?, ?, ?)''',
+                (path, int(mtime), size, json.dumps(geometry)))
+
+    def delete(self, path):
+        """ Delete the listing, render resolutions and page geometry
+        stored for <path>. """
+        if not self.enabled:
+            return
+        with self._lock:
+            self._con.execute('delete from Listing where path = ?', (path,))
+            self._con.execute('delete from RenderDpi where path = ?', (path,))
+            self._con.execute('delete from Geometry where path = ?', (path,))
+
+    def close(self):
+        """ Close the database. """
+        with self._lock:
+            if self._con is not None:
+                self._con.close()
+                self._con = None
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+def get_listing_cache(path=constants.LISTING_CACHE_PATH):
+    """ Return the shared ListingCache instance for the database at <path>. """
+    with _caches_lock:
+        cache = _caches.get(path)
+        if cache is None:
+            cache = _caches[path] = ListingCache(path)
+        return cache
+
+# vim: expandtab:sw=4:ts=4
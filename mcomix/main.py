@@ -23,7 +23,9 @@ from mcomix.preferences import prefs
 from mcomix import ui
 from mcomix import slideshow
 from mcomix import status
+from mcomix import strip_view
 from mcomix import thumbbar
+from mcomix import tiled_image
 from mcomix import clipboard
 from mcomix import pageselect
 from mcomix import osd
@@ -34,6 +36,7 @@ from mcomix import message_dialog
 from mcomix import callback
 from mcomix.library import backend, main_dialog
 from mcomix import tools
+from mcomix import tracing
 from mcomix import layout
 from mcomix import log
 import math
@@ -66,6 +69,12 @@ class MainWindow(Gtk.Window):
         self.layout = _dummy_layout()
         self._spacing = 2
         self._waiting_for_redraw = False
+        #: Displayed pages: [page, transform key, pixbuf, size, rotation,
+        #: transform settings, transformed pixbuf]
+        self._displayed_renderings = []
+        #: Protects the transformed pixbufs of the displayed pages, set
+        #: lazily by get_displayed_renderings.
+        self._renderings_lock = threading.Lock()
 
         self._image_box = Gtk.HBox(False, 2) # XXX transitional(kept for osd.py)
         self._main_layout = Gtk.Layout()
@@ -97,6 +106,10 @@ class MainWindow(Gtk.Window):
         self.actiongroup = self.uimanager.get_action_groups()[0]
 
         self.images = [Gtk.Image(), Gtk.Image()] # XXX limited to at most 2 pages
+        #: Pages too large to be scaled at once are displayed tile by tile.
+        self.tiled_images = [tiled_image.TiledImage(self) for image in self.images]
+        #: Pages displayed in strip mode
+        self.strip = strip_view.StripView(self)
 
         # ----------------------------------------------------------------
         # Setup
@@ -144,6 +157,9 @@ class MainWindow(Gtk.Window):
         if prefs['default double page'] or double_page:
             self.actiongroup.get_action('double_page').activate()
 
+        if prefs['strip mode']:
+            self.actiongroup.get_action('strip_mode').activate()
+
         if prefs['default manga mode'] or manga_mode:
             self.actiongroup.get_action('manga_mode').activate()
 
@@ -350,6 +366,7 @@ class MainWindow(Gtk.Window):
                 if should_be_visible != widget.get_visible():
                     (widget.show if should_be_visible else widget.hide)()
 
+    @tracing.traced('draw image', 'draw')
     def _draw_image(self, scroll_to):
 
         self._update_toggles_visibility()
@@ -359,6 +376,16 @@ class MainWindow(Gtk.Window):
             self._waiting_for_redraw = False
             return False
 
+        if prefs['strip mode']:
+            self._displayed_renderings = []
+            for image in self.images:
+                image.hide()
+            for tiled in self.tiled_images:
+                tiled.clear()
+            self.strip.draw(scroll_to)
+            self._waiting_for_redraw = False
+            return False
+
         if self.imagehandler.page_is_available():
             distribution_axis = constants.DISTRIBUTION_AXIS
             alignment_axis = constants.ALIGNMENT_AXIS
@@ -367,6 +394,10 @@ class MainWindow(Gtk.Window):
             do_not_transform = [image_tools.is_animation(x) for x in pixbuf_list]
             size_list = [[pixbuf.get_width(), pixbuf.get_height()]
                          for pixbuf in pixbuf_list]
+            # Pages may have been decoded at a reduced size.
+            original_size_list = [list(original or size) for original, size in
+                                  zip(self.imagehandler.get_original_sizes(pixbuf_count),
+                                      size_list)]
 
             if self.is_manga_mode:
                 orientation = constants.MANGA_ORIENTATION
@@ -386,6 +417,7 @@ class MainWindow(Gtk.Window):
             for i in range(pixbuf_count):
                 if rotation_list[i] in (90, 270):
                     size_list[i].reverse()
+                    original_size_list[i].reverse()
                 size = size_list[i]
                 virtual_size[distribution_axis] += size[distribution_axis]
                 virtual_size[alignment_axis] = max(virtual_size[alignment_axis],
@@ -400,6 +432,7 @@ class MainWindow(Gtk.Window):
                     if do_not_transform[i]:
                         continue
                     size_list[i].reverse()
+                    original_size_list[i].reverse()
             if rotation in (180, 270):
                 orientation = tools.vector_opposite(orientation)
             for i in range(pixbuf_count):
@@ -442,28 +475,57 @@ class MainWindow(Gtk.Window):
                     expand_area = True
                     viewport_size = () # start anew
 
-            for i in range(pixbuf_count):
-                if do_not_transform[i]:
-                    continue
-                pixbuf_list[i] = image_tools.fit_pixbuf_to_rectangle(
-                    pixbuf_list[i], scaled_sizes[i], rotation_list[i])
+            # Only the visible part of very large pages is scaled.
+            tiled = [not do_not_transform[i] and
+                     tiled_image.should_tile(scaled_sizes[i], viewport_size)
+                     for i in range(pixbuf_count)]
 
+            transform = self._get_transform_settings()
+            parameters = self.enhancer.get_parameters()
+            current_page = self.imagehandler.get_current_page()
+            displayed_renderings = []
             for i in range(pixbuf_count):
-                if do_not_transform[i]:
+                if do_not_transform[i] or tiled[i]:
                     continue
-                if prefs['horizontal flip']:
-                    pixbuf_list[i] = pixbuf_list[i].flip(horizontal=True)
-                if prefs['vertical flip']:
-                    pixbuf_list[i] = pixbuf_list[i].flip(horizontal=False)
-                pixbuf_list[i] = self.enhancer.enhance(pixbuf_list[i])
+                page = current_page + i
+                transform_key = self._get_transform_key(pixbuf_list[i], scaled_sizes[i],
+                                                        rotation_list[i], transform)
+                key = transform_key + (parameters,)
+                # Keep the transformed (but not enhanced) page around,
+                # so changes to the enhancement values can be applied
+                # in the background without scaling it again.
+                rendering = [page, transform_key, pixbuf_list[i], scaled_sizes[i],
+                             rotation_list[i], transform, None]
+                with self._renderings_lock:
+                    for previous in self._displayed_renderings:
+                        if previous[:2] == rendering[:2]:
+                            rendering[6] = previous[6]
+                            break
+                rendered = self.imagehandler.get_rendered_pixbuf(page, key)
+                if rendered is None:
+                    if rendering[6] is None:
+                        rendering[6] = self._transform_pixbuf(*rendering[2:6])
+                    rendered = self.enhancer.enhance(rendering[6], parameters)
+                    self.imagehandler.add_rendered_pixbuf(page, key, rendered)
+                displayed_renderings.append(rendering)
+                pixbuf_list[i] = rendered
+            self._displayed_renderings = displayed_renderings
+
+            self._update_renderer(pixbuf_count, viewport_size, prefer_same_size)
 
             for i in range(pixbuf_count):
-                image_tools.set_from_pixbuf(self.images[i], pixbuf_list[i])
+                if tiled[i]:
+                    # Keep the size of the page for scrolling.
+                    self.images[i].clear()
+                    self.images[i].set_size_request(*scaled_sizes[i])
+                else:
+                    image_tools.set_from_pixbuf(self.images[i], pixbuf_list[i])
+                    self.images[i].set_size_request(-1, -1)
 
             scales = tuple(map(lambda x, y: math.sqrt(tools.div(
-                tools.volume(x), tools.volume(y))), scaled_sizes, size_list))
+                tools.volume(x), tools.volume(y))), scaled_sizes, original_size_list))
 
-            resolutions = tuple(map(lambda x, y: x + [y,], size_list, scales))
+            resolutions = tuple(map(lambda x, y: x + [y,], original_size_list, scales))
             if self.is_manga_mode:
                 resolutions = tuple(reversed(resolutions))
             self.statusbar.set_resolution(resolutions)
@@ -488,8 +550,19 @@ class MainWindow(Gtk.Window):
 
             for i in range(pixbuf_count):
                 self.images[i].show()
+                if tiled[i]:
+                    self.tiled_images[i].set_page(
+                        pixbuf_list[i], scaled_sizes[i], rotation_list[i],
+                        transform, parameters,
+                        self._get_render_key(pixbuf_list[i], scaled_sizes[i],
+                                             rotation_list[i], transform,
+                                             parameters),
+                        content_boxes[i].get_position())
+                else:
+                    self.tiled_images[i].clear()
             for i in range(pixbuf_count, len(self.images)):
                 self.images[i].hide()
+                self.tiled_images[i].clear()
 
             # Reset orientation so scrolling behaviour is sane.
             if self.is_manga_mode:
@@ -514,14 +587,133 @@ class MainWindow(Gtk.Window):
             # If the pixbuf for the current page(s) isn't available,
             # hide all images to clear any old pixbufs.
             # XXX How about calling self._clear_main_area?
+            self._displayed_renderings = []
             for i in range(len(self.images)):
                 self.images[i].hide()
+                self.tiled_images[i].clear()
             self._show_scrollbars([False] * len(self._scroll))
 
         self._waiting_for_redraw = False
 
         return False
 
+    def _get_transform_settings(self):
+        """ Return the (horizontal flip, vertical flip, scaling quality,
+        checkered background) preferences _transform_pixbuf() depends on.
+        Read on the main thread, and passed along to the other threads, so
+        that a rendering always matches its key. """
+        return (prefs['horizontal flip'], prefs['vertical flip'],
+                prefs['scaling quality'],
+                prefs['checkered bg for transparent images'])
+
+    def _get_transform_key(self, pixbuf, size, rotation, transform):
+        """ Return a key identifying the transformation of <pixbuf> by
+        _transform_pixbuf() at <size> and <rotation>, with the transform
+        settings <transform>. """
+        return (pixbuf.get_width(), pixbuf.get_height(), tuple(size),
+                rotation) + transform
+
+    def _get_render_key(self, pixbuf, size, rotation, transform, parameters):
+        """ Return a key identifying the rendering of <pixbuf> by
+        _render_pixbuf() at <size> and <rotation>, with the transform
+        settings <transform> and enhancement values <parameters>. """
+        return self._get_transform_key(pixbuf, size, rotation, transform) + \
+                (parameters,)
+
+    @tracing.traced('scale', 'draw')
+    def _transform_pixbuf(self, pixbuf, size, rotation, transform):
+        """ Return <pixbuf> scaled to <size>, rotated by <rotation>
+        and flipped, with the transform settings <transform> (see
+        _get_transform_settings). """
+        hflip, vflip, scaling_quality, checkered_bg = transform
+        pixbuf = image_tools.fit_pixbuf_to_rectangle(pixbuf, size, rotation,
+                                                     scaling_quality,
+                                                     checkered_bg)
+        if hflip:
+            pixbuf = pixbuf.flip(horizontal=True)
+        if vflip:
+            pixbuf = pixbuf.flip(horizontal=False)
+        return pixbuf
+
+    def _render_pixbuf(self, pixbuf, size, rotation, transform, parameters):
+        """ Return <pixbuf> scaled to <size>, rotated by <rotation>,
+        flipped and enhanced with the transform settings <transform> and
+        enhancement values <parameters>, ready to be displayed. """
+        return self.enhancer.enhance(self._transform_pixbuf(pixbuf, size,
+                                                            rotation, transform),
+                                     parameters)
+
+    def get_displayed_renderings(self):
+        """ Return a list of (page, transform key, pixbuf) tuples for the
+        displayed pages, where <pixbuf> is the page transformed for
+        display, before enhancement. Can be called from any thread: pages
+        are transformed if necessary (without holding the lock, from the
+        settings recorded by _draw_image), and kept for the next calls. """
+        renderings = []
+        with self._renderings_lock:
+            displayed_renderings = self._displayed_renderings
+        for rendering in displayed_renderings:
+            with self._renderings_lock:
+                transformed = rendering[6]
+            if transformed is None:
+                transformed = self._transform_pixbuf(*rendering[2:6])
+                with self._renderings_lock:
+                    rendering[6] = transformed
+            renderings.append((rendering[0], rendering[1], transformed))
+        return renderings
+
+    def _update_renderer(self, pixbuf_count, viewport_size, prefer_same_size):
+        """ Let the image handler pre-render the neighbouring pages in the
+        background, as they would be displayed in the current viewport.
+        Only done when displaying a single page: in double page mode, the
+        layout of a page depends on the page it is displayed with. """
+        if pixbuf_count != 1:
+            self.imagehandler.set_renderer(None, None)
+            return
+        # Everything the renderer depends on is read here, on the main
+        # thread: it is called from the caching threads.
+        zoom = self.zoom.snapshot()
+        auto_rotate_exif = prefs['auto rotate from exif']
+        manual_rotation = prefs['rotation']
+        auto_rotate_size = prefs['auto rotate depending on size']
+        transform = self._get_transform_settings()
+        parameters = self.enhancer.get_parameters()
+        settings = (viewport_size, prefer_same_size,
+                    auto_rotate_exif, manual_rotation, auto_rotate_size,
+                    zoom.get_fit_mode(), zoom.get_scale_up(),
+                    zoom.get_user_zoom_log(),
+                    prefs['fit to size mode'], prefs['fit to size px'],
+                    transform, parameters)
+        def renderer(page, pixbuf):
+            # Same as _draw_image, for a single page.
+            if image_tools.is_animation(pixbuf):
+                return None
+            size = [pixbuf.get_width(), pixbuf.get_height()]
+            if auto_rotate_exif:
+                rotation = image_tools.get_implied_rotation(pixbuf)
+            else:
+                rotation = 0
+            if rotation in (90, 270):
+                size.reverse()
+            page_rotation = (self._get_size_rotation(*size,
+                                                     auto_rotate=auto_rotate_size) +
+                             manual_rotation) % 360
+            axis = constants.DISTRIBUTION_AXIS
+            if page_rotation in (90, 270):
+                axis = constants.ALIGNMENT_AXIS
+                size.reverse()
+            rotation = (rotation + page_rotation) % 360
+            scaled_size = zoom.get_zoomed_size([size], list(viewport_size),
+                                               axis, [False], prefer_same_size)[0]
+            if tiled_image.should_tile(scaled_size, viewport_size):
+                # Displayed tile by tile.
+                return None
+            key = self._get_render_key(pixbuf, scaled_size, rotation,
+                                       transform, parameters)
+            return key, lambda: self._render_pixbuf(pixbuf, scaled_size, rotation,
+                                                    transform, parameters)
+        self.imagehandler.set_renderer(settings, renderer)
+
     def _update_page_information(self):
         """ Updates the window with information that can be gathered
         even when the page pixbuf(s) aren't ready yet. """
@@ -551,25 +743,29 @@ class MainWindow(Gtk.Window):
         self.statusbar.update()
         self.update_title()
 
-    def _get_size_rotation(self, width, height):
-        """ Determines the rotation to be applied.
-        Returns the degree of rotation (0, 90, 180, 270). """
+    def _get_size_rotation(self, width, height, auto_rotate=None):
+        """ Determines the rotation to be applied, with the 'auto rotate
+        depending on size' setting <auto_rotate> (defaults to the
+        preferences). Returns the degree of rotation (0, 90, 180, 270). """
+
+        if auto_rotate is None:
+            auto_rotate = prefs['auto rotate depending on size']
 
         size_rotation = 0
 
         if (height > width and
-            prefs['auto rotate depending on size'] in
+            auto_rotate in
                 (constants.AUTOROTATE_HEIGHT_90, constants.AUTOROTATE_HEIGHT_270)):
 
-            if prefs['auto rotate depending on size'] == constants.AUTOROTATE_HEIGHT_90:
+            if auto_rotate == constants.AUTOROTATE_HEIGHT_90:
                 size_rotation = 90
             else:
                 size_rotation = 270
         elif (width > height and
-              prefs['auto rotate depending on size'] in
+              auto_rotate in
                 (constants.AUTOROTATE_WIDTH_90, constants.AUTOROTATE_WIDTH_270)):
 
-            if prefs['auto rotate depending on size'] == constants.AUTOROTATE_WIDTH_90:
+            if auto_rotate == constants.AUTOROTATE_WIDTH_90:
                 size_rotation = 90
             else:
                 size_rotation = 270
@@ -582,7 +778,9 @@ class MainWindow(Gtk.Window):
         current_page = self.imagehandler.get_current_page()
         nb_pages = 2 if self.displayed_double() else 1
         if current_page <= page < (current_page + nb_pages):
-            self.draw_image(scroll_to=self._last_scroll_destination)
+            if not prefs['strip mode']:
+                # Strip mode displays pages as they are rendered.
+                self.draw_image(scroll_to=self._last_scroll_destination)
             self._update_page_information()
 
         # Use first page as application icon when opening archives.
@@ -632,7 +830,10 @@ class MainWindow(Gtk.Window):
             return
         self.imagehandler.set_page(num)
         self.page_changed()
-        self.new_page(at_bottom=at_bottom)
+        if prefs['strip mode']:
+            self.strip.scroll_to_page(num, at_bottom=at_bottom)
+        else:
+            self.new_page(at_bottom=at_bottom)
         self.slideshow.update_delay()
 
     def next_book(self):
@@ -737,6 +938,13 @@ class MainWindow(Gtk.Window):
         self._update_page_information()
         self.draw_image()
 
+    def change_strip_mode(self, toggleaction):
+        prefs['strip mode'] = toggleaction.get_active()
+        if not prefs['strip mode']:
+            self.strip.clear()
+        self._update_page_information()
+        self.draw_image(scroll_to=constants.SCROLL_TO_START)
+
     def change_manga_mode(self, toggleaction):
         prefs['default manga mode'] = toggleaction.get_active()
         self.is_manga_mode = toggleaction.get_active()
@@ -901,10 +1109,14 @@ class MainWindow(Gtk.Window):
         self.draw_image()
 
     def _clear_main_area(self):
+        self.strip.clear()
+        self._displayed_renderings = []
         for i in self.images:
             i.hide()
         for i in self.images:
             i.clear()
+        for i in self.tiled_images:
+            i.clear()
         self._show_scrollbars([False] * len(self._scroll))
         self.layout = _dummy_layout()
         self._main_layout.set_size(*self.layout.get_union_box().get_size())
@@ -914,6 +1126,7 @@ class MainWindow(Gtk.Window):
         """Return True if two pages are currently displayed."""
         return (self.imagehandler.get_current_page() and
                 prefs['default double page'] and
+                not prefs['strip mode'] and
                 not self.imagehandler.get_virtual_double_page() and
                 self.imagehandler.get_current_page() != self.imagehandler.get_number_of_pages())
 
@@ -1141,6 +1354,9 @@ class MainWindow(Gtk.Window):
         self.write_config_files()
 
         self.filehandler.close_file()
+        self.enhancer.stop()
+        for tiled in self.tiled_images:
+            tiled.stop()
         if main_dialog._dialog is not None:
             main_dialog._dialog.close()
         backend.LibraryBackend().close()
@@ -0,0 +1,279 @@
+"""page_cache.py - Persistent cache of files extracted from archives."""
+from __future__ import with_statement
+
+import errno
+import os
+import threading
+import hashlib
+import tempfile
+
+from mcomix.preferences import prefs
+from mcomix import constants
+from mcomix import log
+
+
+class PageCache(object):
+
+    """ Size limited disk cache of files extracted from archives, shared
+    across sessions, so that re-opening a book (or switching back and forth
+    between books) does not extract its pages again.
+
+    Entries are keyed by the archive's path, modification time and size,
+    and the name of the file in the archive, so modified archives are never
+    served stale data. Each entry is stored in its own file, named after a
+    hash of its key. Files are written to a temporary file first, and then
+    renamed, so that a crash never leaves a partially written entry behind.
+    When the cache exceeds its maximum size, least recently used entries
+    are evicted.
+
+    All methods are thread safe.
+    """
+
+    #: Prefix of temporary files, removed when the cache is opened.
+    TMP_PREFIX = '.tmp-'
+
+    def __init__(self, directory, max_size):
+        """ Use <directory> for storage, limiting the cache to <max_size>
+        bytes. """
+        self._directory = directory
+        self._max_size = max_size
+        self._lock = threading.Lock()
+        #: Index of cached files: key > [last use, size]. Loaded lazily.
+        self._entries = None
+        self._size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def get_archive_key(path):
+        """ Return the key identifying the current version of the archive at
+        <path>, to be passed to the other methods, or None if it cannot be
+        accessed. """
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        return u'%s\0%u\0%u' % (os.path.abspath(path),
+                                int(stat.st_mtime), stat.st_size)
+
+    def get_path(self, archive_key, name):
+        """ Return the path to the cached file <name> from the archive
+        identified by <archive_key>, or None if it is not in the cache. """
+        key = self._get_key(archive_key, name)
+        with self._lock:
+            self._load()
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            entry[0] = self._tick()
+        path = self._get_path(key)
+        try:
+            # Persist the last use, for the next sessions.
+            os.utime(path, None)
+        except OSError:
+            # Removed behind our back.
+            with self._lock:
+                self._forget(key)
+            return None
+        return path
+
+    def contains(self, archive_key, name):
+        """ Return True if file <name> from the archive identified by
+        <archive_key> is in the cache. """
+        key = self._get_key(archive_key, name)
+        with self._lock:
+            self._load()
+            return key in self._entries
+
+    def read(self, archive_key, name):
+        """ Return the content of the cached file <name> from the archive
+        identified by <archive_key>, or None if it is not in the cache. """
+        path = self.get_path(archive_key, name)
+        if path is None:
+            return None
+        try:
+            with open(path, 'rb') as fp:
+                return fp.read()
+        except (IOError, OSError):
+            return None
+
+    def write(self, archive_key, name, data):
+        """ Store <data> as the content of file <name> from the archive
+        identified by <archive_key>. """
+        if self._max_size <= 0 or len(data) > self._max_size:
+            return
+        key = self._get_key(archive_key, name)
+        path = self._get_path(key)
+        directory = os.path.dirname(path)
+        try:
+            if not os.path.isdir(directory):
+                try:
+                    os.makedirs(directory, 0o700)
+                except OSError as e:
+                    # Can happen with concurrent calls.
+                    if e.errno != errno.EEXIST:
+                        raise
+            fd, tmppath = tempfile.mkstemp(prefix=PageCache.TMP_PREFIX,
+                                           dir=directory)
+            try:
+                with os.fdopen(fd, 'wb') as fp:
+                    fp.write(data)
+                os.rename(tmppath, path)
+            except Exception:
+                os.unlink(tmppath)
+                raise
+        except (IOError, OSError) as e:
+            log.warning('! Could not write to page cache "%s": %s', path, e)
+            return
+        with self._lock:
+            self._load()
+            self._forget(key)
+            self._entries[key] = [self._tick(), len(data)]
+            self._size += len(data)
+            self._evict()
+
+    def write_file(self, archive_key, name, path):
+        """ Same as write(), with the content read from the file <path>. """
+        if self._max_size <= 0:
+            return
+        try:
+            if os.stat(path).st_size > self._max_size:
+                return
+            with open(path, 'rb') as fp:
+                data = fp.read()
+        except (IOError, OSError):
+            return
+        self.write(archive_key, name, data)
+
+    def set_max_size(self, max_size):
+        """ Change the maximum size of the cache to <max_size> bytes,
+        evicting entries if necessary. """
+        with self._lock:
+            self._max_size = max_size
+            if self._entries is not None:
+                self._evict()
+
+    def get_size(self):
+        """ Return the total size of the cached files. """
+        with self._lock:
+            self._load()
+            return self._size
+
+    def get_stats(self):
+        """ Return a dictionary of cache statistics. """
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'count': len(self._entries or ()),
+                'size': self._size,
+                'max size': self._max_size,
+            }
+
+    def clear(self):
+        """ Remove all cached files. """
+        with self._lock:
+            self._load()
+            for key in list(self._entries.keys()):
+                self._remove(key)
+
+    def _get_key(self, archive_key, name):
+        return hashlib.sha1((archive_key + u'\0' + name).encode('utf-8')).hexdigest()
+
+    def _get_path(self, key):
+        # Spread entries over 256 sub-directories.
+        return os.path.join(self._directory, key[:2], key[2:])
+
+    def _tick(self):
+        """ Return a monotonic counter, used to order entries by last use
+        within a session (file times might have a coarse resolution). """
+        self._clock += 1
+        return self._clock
+
+    def _load(self):
+        """ Build the index from the cache directory, if not done yet.
+        Must be called with the lock held. """
+        if self._entries is not None:
+            return
+        self._entries = {}
+        self._size = 0
+        self._clock = 0
+        if not os.path.isdir(self._directory):
+            return
+        found = []
+        for subdir in os.listdir(self._directory):
+            subdir_path = os.path.join(self._directory, subdir)
+            if len(subdir) != 2 or not os.path.isdir(subdir_path):
+                continue
+            for entry in os.scandir(subdir_path):
+                if entry.name.startswith(PageCache.TMP_PREFIX):
+                    # Left over by a crash.
+                    try:
+                        os.unlink(entry.path)
+                    except OSError:
+                        pass
+                    continue
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                found.append((stat.st_mtime, subdir + entry.name, stat.st_size))
+        # Previous sessions' last uses come first, oldest first.
+        found.sort()
+        for mtime, key, size in found:
+            self._entries[key] = [self._tick(), size]
+            self._size += size
+        log.debug('Page cache: %u files, %u bytes', len(self._entries), self._size)
+        self._evict()
+
+    def _evict(self):
+        """ Remove least recently used entries until the cache fits in its
+        maximum size. Must be called with the lock held. """
+        if self._size <= self._max_size:
+            return
+        entries = sorted(self._entries.items(), key=lambda item: item[1][0])
+        for key, (last_use, size) in entries:
+            if self._size <= self._max_size:
+                break
+            self._remove(key)
+            self.evictions += 1
+
+    def _remove(self, key):
+        """ Remove the entry <key>. Must be called with the lock held. """
+        self._forget(key)
+        try:
+            os.unlink(self._get_path(key))
+        except OSError:
+            pass
+
+    def _forget(self, key):
+        """ Remove <key> from the index. Must be called with the lock
+        held. """
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._size -= entry[1]
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+def get_page_cache():
+    """ Return the shared PageCache instance, as configured by the
+    preferences, or None if the cache is disabled. """
+    global _cache
+    max_size = prefs['page cache size'] * 1024 * 1024
+    if max_size <= 0:
+        return None
+    with _cache_lock:
+        directory = prefs['page cache path'] or constants.PAGE_CACHE_PATH
+        if _cache is None or _cache._directory != directory:
+            _cache = PageCache(directory, max_size)
+        else:
+            _cache.set_max_size(max_size)
+        return _cache
+
+# vim: expandtab:sw=4:ts=4
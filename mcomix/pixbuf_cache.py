@@ -0,0 +1,190 @@
+""" pixbuf_cache.py - Memory-budgeted LRU cache for decoded page pixbufs. """
+from __future__ import with_statement
+
+import threading
+from collections import OrderedDict
+
+from mcomix import log
+
+
+def get_pixbuf_byte_size(pixbuf):
+    """ Return the number of bytes used by the pixel data of <pixbuf>.
+    For animations, the size of the static image is returned. Objects that
+    are not pixbufs (e.g. the missing image icon) are accounted as 0 bytes. """
+    if hasattr(pixbuf, 'get_static_image'):
+        pixbuf = pixbuf.get_static_image()
+    try:
+        return pixbuf.get_rowstride() * pixbuf.get_height()
+    except AttributeError:
+        return 0
+
+
+class PixbufCache(object):
+
+    """ Cache of decoded pixbufs, indexed by page index.
+
+    The cache is bounded by the total size of the cached pixel data
+    instead of a number of pages. When the cache grows over its budget,
+    entries are evicted in the following order:
+
+    - entries that are not wanted (see set_wanted), least recently used first
+    - wanted entries, lowest priority first
+
+    An entry is never evicted in favor of an entry with a lower priority:
+    in that case, the new entry is simply not cached.
+
+    Entries can optionally be stored with a key (e.g. the parameters used
+    to render the pixbuf), in which case they are only returned for the
+    same key.
+
+    All methods are thread safe.
+    """
+
+    def __init__(self, max_size=-1):
+        """ Create a new cache holding at most <max_size> bytes of pixel
+        data. A negative <max_size> means an unbounded cache. """
+        self._max_size = max_size
+        #: Map page index > (pixbuf, size, key), in LRU order (oldest first).
+        self._entries = OrderedDict()
+        #: Map page index > priority (0 is the highest priority).
+        self._priorities = {}
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __contains__(self, index):
+        with self._lock:
+            return index in self._entries
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def keys(self):
+        """ Return the list of cached indexes, least recently used first. """
+        with self._lock:
+            return list(self._entries.keys())
+
+    def get_size(self):
+        """ Return the total size in bytes of the cached pixel data. """
+        with self._lock:
+            return self._size
+
+    def get_max_size(self):
+        """ Return the cache budget in bytes (negative if unbounded). """
+        return self._max_size
+
+    def set_max_size(self, max_size):
+        """ Change the cache budget to <max_size> bytes, evicting
+        entries if necessary. """
+        with self._lock:
+            self._max_size = max_size
+            self._evict()
+
+    def set_wanted(self, wanted):
+        """ Set the list of page indexes that should preferably be kept,
+        by decreasing priority (i.e. the read-ahead order). """
+        with self._lock:
+            self._priorities = dict((index, priority)
+                                    for priority, index in enumerate(wanted))
+
+    def get(self, index, default=None, key=None):
+        """ Return the pixbuf cached for <index> and <key>, or <default>
+        if it is not in cache. """
+        with self._lock:
+            entry = self._entries.get(index)
+            if entry is None or entry[2] != key:
+                self.misses += 1
+                return default
+            del self._entries[index]
+            # Move to the most recently used position.
+            self._entries[index] = entry
+            self.hits += 1
+            return entry[0]
+
+    def add(self, index, pixbuf, key=None):
+        """ Store <pixbuf> for <index> and <key>, replacing any pixbuf
+        stored for <index>, whatever its key. Return True if the pixbuf
+        was cached, or False if doing so would have meant evicting
+        entries with a higher priority. """
+        size = get_pixbuf_byte_size(pixbuf)
+        with self._lock:
+            old = self._entries.pop(index, None)
+            if old is not None:
+                self._size -= old[1]
+            self._entries[index] = (pixbuf, size, key)
+            self._size += size
+            return self._evict(new_index=index)
+
+    def remove(self, index):
+        """ Remove <index> from the cache. """
+        with self._lock:
+            entry = self._entries.pop(index, None)
+            if entry is not None:
+                self._size -= entry[1]
+
+    def clear(self):
+        """ Remove all entries from the cache and reset statistics. """
+        with self._lock:
+            self._entries.clear()
+            self._priorities = {}
+            self._size = 0
+            self.hits = self.misses = self.evictions = 0
+
+    def get_stats(self):
+        """ Return a dictionary with the cache statistics. """
+        with self._lock:
+            return {
+                'count': len(self._entries),
+                'size': self._size,
+                'max size': self._max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+    def _eviction_candidates(self, new_index):
+        """ Return the list of indexes that can be evicted, in eviction
+        order. Must be called with the lock held. """
+        unwanted, wanted = [], []
+        for index in self._entries:
+            if index == new_index:
+                continue
+            if index in self._priorities:
+                wanted.append(index)
+            else:
+                unwanted.append(index)
+        wanted.sort(key=self._priorities.get, reverse=True)
+        return unwanted + wanted
+
+    def _evict(self, new_index=None):
+        """ Evict entries until the cache fits in its budget. Return False
+        if <new_index> itself had to be dropped. Must be called with the
+        lock held. """
+        if self._max_size < 0 or self._size <= self._max_size:
+            return True
+        new_priority = self._priorities.get(new_index)
+        for index in self._eviction_candidates(new_index):
+            if self._size <= self._max_size:
+                return True
+            priority = self._priorities.get(index)
+            if priority is not None and new_index is not None and \
+               (new_priority is None or priority < new_priority):
+                # Don't drop a more important page for this one.
+                break
+            pixbuf, size, key = self._entries.pop(index)
+            self._size -= size
+            self.evictions += 1
+            log.debug('Evicted page %u from cache (%u bytes)', index + 1, size)
+        if self._size <= self._max_size or new_index is None:
+            return True
+        if new_priority == 0:
+            # Always keep the current page, even if over budget.
+            return True
+        pixbuf, size, key = self._entries.pop(new_index)
+        self._size -= size
+        return False
+
+# vim: expandtab:sw=4:ts=4
@@ -29,6 +29,7 @@ prefs = {
     'cache': True,
     'stretch': False,
     'default double page': False,
+    'strip mode': False,
     'default fullscreen': False,
     'zoom mode': constants.ZOOM_MODE_BEST,
     'default manga mode': False,
@@ -40,6 +41,7 @@ prefs = {
     'show page numbers on thumbnails': True,
     'thumbnail size': 80,
     'create thumbnails': True,
+    'share thumbnails': False,
     'archive thumbnail as icon' : False,
     'number of pixels to scroll per key event': 50,
     'number of pixels to scroll per mouse wheel event': 50,
@@ -76,6 +78,8 @@ prefs = {
     'sharpness': 1.0,
     'auto contrast': False,
     'max pages to cache': 7,
+    'max cache size': 512,  # in MiB, -1 for unlimited
+    'decode at display size': True,
     'window x': 0,
     'window y': 0,
     'window height': 600,
@@ -93,6 +97,9 @@ prefs = {
                         constants.STATUS_PATH | constants.STATUS_FILENAME | constants.STATUS_FILESIZE,
     'max threads': 3,
     'max extract threads': 1,
+    'max extraction memory': 256,  # in MiB, 0 to always extract to disk
+    'page cache size': 1024,  # in MiB, 0 to disable
+    'page cache path': '',  # empty for the default location
     'wrap mouse scroll': False,
     'scaling quality': 2,  # gtk.gdk.INTERP_BILINEAR
     'escape quits': False,
@@ -12,6 +12,7 @@ from mcomix import preferences_page
 from mcomix import image_tools
 from mcomix import constants
 from mcomix import message_dialog
+from mcomix import page_cache
 from mcomix import keybindings
 from mcomix import keybindings_editor
 
@@ -250,6 +251,11 @@ class _PreferencesDialog(Gtk.Dialog):
         page.add_row(Gtk.Label(('Scaling mode')),
             self._create_scaling_quality_combobox())
 
+        page.add_row(self._create_pref_check_button(
+            ('Decode large images at display size'),
+            'decode at display size',
+            ('When images are fitted to the screen, decode them at the size they are displayed at, which is faster and uses less memory. Images are decoded again at full size when zooming in, or when using the magnifying lens.')))
+
         return page
 
     def _init_advanced_tab(self):
@@ -274,16 +280,36 @@ class _PreferencesDialog(Gtk.Dialog):
             1, 1, 16, 1, 4, 0,
             ('Set the maximum number of concurrent threads for formats that support it.')))
 
+        page.add_row(Gtk.Label(('Maximum memory used for extracted pages (in MiB):')),
+            self._create_pref_spinner('max extraction memory',
+            1, 0, 65536, 16, 128, 0,
+            ('Set the maximum amount of memory used to keep pages extracted from ZIP, TAR and 7z archives, instead of writing them to a temporary directory. A value of 0 always extracts pages to disk.')))
+
+        page.add_row(Gtk.Label(('Maximum size of the extracted pages cache (in MiB):')),
+            self._create_pref_spinner('page cache size',
+            1, 0, 1048576, 64, 1024, 0,
+            ('Keep pages extracted from archives on disk, so that they do not need to be extracted again when a book is opened again. A value of 0 disables the cache.')))
+
         page.add_row(self._create_pref_check_button(
             ('Store thumbnails for opened files'),
             'create thumbnails',
-            ('Store thumbnails for opened files according to the freedesktop.org specification. These thumbnails are shared by many other applications, such as most file managers.')))
+            ('Store thumbnails for opened files, so that they do not need to be created again.')))
+
+        page.add_row(self._create_pref_check_button(
+            ('Share thumbnails with other applications'),
+            'share thumbnails',
+            ('Also write stored thumbnails according to the freedesktop.org specification. These thumbnails are shared by many other applications, such as most file managers.')))
 
         page.add_row(Gtk.Label(('Maximum number of pages to store in the cache:')),
             self._create_pref_spinner('max pages to cache',
             1, -1, 500, 1, 3, 0,
             ('Set the max number of pages to cache. A value of -1 will cache the entire archive.')))
 
+        page.add_row(Gtk.Label(('Maximum memory used by the page cache (in MiB):')),
+            self._create_pref_spinner('max cache size',
+            1, -1, 65536, 16, 128, 0,
+            ('Set the maximum amount of memory used to store decoded pages. Least recently viewed pages are dropped first. A value of -1 means no limit.')))
+
         page.new_section(('Magnifying Lens'))
 
         page.add_row(Gtk.Label(('Magnifying lens size (in pixels):')),
@@ -786,7 +812,8 @@ class _PreferencesDialog(Gtk.Dialog):
                 self._window.draw_image()
 
         elif preference in ('checkered bg for transparent images',
-          'no double page for wide images', 'auto rotate from exif'):
+          'no double page for wide images', 'auto rotate from exif',
+          'decode at display size'):
             self._window.draw_image()
 
         elif (preference == 'hide all in fullscreen' and
@@ -858,9 +885,9 @@ class _PreferencesDialog(Gtk.Dialog):
             self._window.thumbnailsidebar.resize()
             self._window.draw_image()
 
-        elif preference == 'max pages to cache':
+        elif preference in ('max pages to cache', 'max cache size'):
             prefs[preference] = int(value)
-            self._window.imagehandler.do_cacheing()
+            self._window.imagehandler.update_cache_size()
 
         elif preference == 'number of key presses before page turn':
             prefs['number of key presses before page turn'] = int(value)
@@ -870,8 +897,13 @@ class _PreferencesDialog(Gtk.Dialog):
             prefs[preference] = int(value)
             self._window.change_zoom_mode()
 
-        elif preference == 'max extract threads':
+        elif preference in ('max extract threads', 'max extraction memory'):
+            prefs[preference] = int(value)
+
+        elif preference == 'page cache size':
             prefs[preference] = int(value)
+            # Apply the new size (evicting pages if necessary).
+            page_cache.get_page_cache()
 
 
     def _entry_cb(self, entry, event=None):
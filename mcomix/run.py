@@ -17,6 +17,7 @@ from mcomix import (
     log,
     portability,
     preferences,
+    tracing,
 )
 
 
@@ -89,6 +90,10 @@ def parse_arguments(argv):
                          choices=('all', 'debug', 'info', 'warn', 'error'), default='warn',
                          metavar='[ all | debug | info | warn | error ]',
                          help=('Sets the desired output log level.'))
+    debugopts.add_option('--trace', dest='trace', action='store',
+                         metavar='FILE', default=None,
+                         help=('Record the time spent loading and displaying pages, '
+                               'and write it to FILE on exit (Chrome trace format).'))
     # This supresses an error when MComix is used with cProfile
     debugopts.add_option('-o', dest='output', action='store',
                          default='', help=optparse.SUPPRESS_HELP)
@@ -138,6 +143,10 @@ def run():
     # First things first: set the log level.
     log.setLevel(opts.loglevel)
 
+    # Tracing must be enabled before the traced modules are imported.
+    if opts.trace is not None:
+        tracing.enable(os.path.abspath(opts.trace))
+
     # On Windows, update the fontconfig cache manually, before MComix starts
     # using Gtk, since the process may take several minutes, during which the
     # main window will just be frozen if the work is left to Gtk itself...
@@ -0,0 +1,321 @@
+"""strip_view.py - Continuous vertical strip reading mode."""
+
+import gi
+gi.require_version("Gtk", "3.0")
+from gi.repository import Gtk, GObject
+
+from mcomix.preferences import prefs
+from mcomix import constants
+from mcomix import image_tools
+from mcomix import layout
+
+
+class StripView(object):
+
+    """ Displays all the pages of a book one below the other, scaled to
+    the width of the window, on a single canvas scrolled continuously
+    (e.g. for long strip comics split in many tall slices).
+
+    Pages are laid out from their geometry (see
+    ImageHandler.get_page_geometry), or from the size of their rendering
+    when their geometry cannot be read. The size of other pages is
+    estimated, and the layout is updated as their size becomes known,
+    keeping the page at the top of the viewport in place.
+
+    Only the pages intersecting the viewport, or within MARGIN of it, are
+    displayed: they are decoded and scaled in the background by the
+    caching threads (see ImageHandler.set_renderer), and their image
+    widgets are released and reused as they are scrolled out.
+    """
+
+    #: Pages within that many viewport heights above or below the
+    #: viewport are displayed too.
+    MARGIN = 1.0
+    #: Height to width ratio assumed for pages of unknown geometry.
+    DEFAULT_ASPECT = 1.5
+
+    def __init__(self, window):
+        self._window = window
+        self._layout = None
+        #: Settings the layout and renderings depend on (see _get_settings).
+        self._settings = None
+        #: Pages laid out with an estimated size.
+        self._estimated = set()
+        #: Size of the renderings of pages of unknown geometry: page > size.
+        self._rendered_sizes = {}
+        #: Displayed pages: page > Gtk.Image.
+        self._images = {}
+        #: Image widgets not in use.
+        self._free_images = []
+        self._update_pending = False
+        self._relayout_pending = False
+
+        window.imagehandler.pages_rendered += self._pages_rendered
+        window.imagehandler.geometry_available += self._geometry_available
+        window._vadjust.connect('value-changed', self._scrolled)
+
+    def draw(self, scroll_to=None):
+        """ Lay out the pages for the current viewport size, zoom and
+        preferences. If <scroll_to> is SCROLL_TO_START (or SCROLL_TO_END),
+        scroll to the top (or bottom) of the current page, otherwise keep
+        the current scroll position. """
+        window = self._window
+        if 0 == window.imagehandler.get_number_of_pages():
+            self.clear()
+            return
+        anchor = self._get_anchor()
+        # The strip is almost always higher than the viewport.
+        window._show_scrollbars([False, True])
+        viewport_size = window.get_visible_area_size()
+        settings = self._get_settings(viewport_size[0])
+        if settings != self._settings:
+            # Displayed renderings are outdated.
+            self._release_all()
+            self._rendered_sizes.clear()
+            self._settings = settings
+        self._relayout(viewport_size)
+        if self._layout.get_union_box().get_size()[0] > viewport_size[0]:
+            window._show_scrollbars([True, True])
+        window.imagehandler.set_renderer(settings, self._get_rendering)
+        page = window.imagehandler.get_current_page()
+        if constants.SCROLL_TO_START == scroll_to:
+            self.scroll_to_page(page)
+        elif constants.SCROLL_TO_END == scroll_to:
+            self.scroll_to_page(page, at_bottom=True)
+        elif anchor is not None:
+            self._restore_anchor(anchor)
+        self._update()
+
+    def clear(self):
+        """ Remove all pages, e.g. when leaving strip mode. """
+        self._release_all()
+        self._layout = None
+        self._settings = None
+        self._estimated.clear()
+        self._rendered_sizes.clear()
+        self._window.imagehandler.set_displayed_pages(None)
+
+    def scroll_to_page(self, page, at_bottom=False):
+        """ Scroll to the top of <page>, or to its bottom if <at_bottom>
+        is True. """
+        if self._layout is None:
+            return
+        box = self._layout.get_content_box(page - 1)
+        y = box.get_position()[1]
+        if at_bottom:
+            y += box.get_size()[1] - self._window._vadjust.get_page_size()
+        # The adjustment keeps the value in range.
+        self._window._vadjust.set_value(max(0, y))
+
+    def _get_settings(self, viewport_width):
+        """ Return the settings the layout and renderings depend on. """
+        window = self._window
+        return (viewport_width, window.zoom.get_scale_up(),
+                window.zoom.get_user_zoom(),
+                prefs['auto rotate from exif'],
+                window._get_transform_settings(),
+                window.enhancer.get_parameters())
+
+    @staticmethod
+    def _get_scaled_size(settings, width, height, rotation):
+        """ Return the size a page of <width>x<height> with an implied
+        <rotation> is displayed at with <settings>. """
+        viewport_width, scale_up, user_zoom = settings[:3]
+        if rotation in (90, 270):
+            width, height = height, width
+        size = layout.StripLayout.scale_to_width((width, height),
+                                                  viewport_width, scale_up)
+        return tuple(max(1, int(round(x * user_zoom))) for x in size)
+
+    def _relayout(self, viewport_size):
+        """ Lay out the pages again, and move the displayed pages. """
+        window = self._window
+        imagehandler = window.imagehandler
+        sizes = []
+        estimated = set()
+        previous_size = None
+        for page in range(1, imagehandler.get_number_of_pages() + 1):
+            geometry = imagehandler.get_page_geometry(page)
+            if geometry is not None:
+                rotation = geometry.rotation if self._settings[3] else 0
+                size = self._get_scaled_size(self._settings, geometry.width,
+                                             geometry.height, rotation)
+                previous_size = size
+            elif page in self._rendered_sizes:
+                size = previous_size = self._rendered_sizes[page]
+            else:
+                # Assume the same size as the previous page.
+                if previous_size is None:
+                    width = viewport_size[0]
+                    previous_size = self._get_scaled_size(
+                        self._settings, width,
+                        int(width * StripView.DEFAULT_ASPECT), 0)
+                size = previous_size
+                estimated.add(page)
+            sizes.append(size)
+        self._layout = layout.StripLayout(sizes, viewport_size[0], 0)
+        self._estimated = estimated
+        union_size = self._layout.get_union_box().get_size()
+        # A single box for the whole strip, for smart scrolling.
+        window.layout = layout.FiniteLayout([union_size], viewport_size,
+                                            constants.WESTERN_ORIENTATION, 0,
+                                            False, constants.DISTRIBUTION_AXIS,
+                                            constants.ALIGNMENT_AXIS)
+        window._main_layout.set_size(*union_size)
+        for page, image in self._images.items():
+            window._main_layout.move(image, *self._get_image_position(
+                page, image.get_pixbuf().get_width()))
+
+    def _get_image_position(self, page, width):
+        # Center the rendering, whose width may differ from an estimated one.
+        union_width = self._layout.get_union_box().get_size()[0]
+        y = self._layout.get_content_box(page - 1).get_position()[1]
+        return ((union_width - width) // 2, y)
+
+    def _get_anchor(self):
+        """ Return the page at the top of the viewport, and the fraction of
+        it above the viewport, or None if not laid out. """
+        if self._layout is None:
+            return None
+        top = self._window._vadjust.get_value()
+        index = self._layout.get_index_at(top)
+        box = self._layout.get_content_box(index)
+        return index, (top - box.get_position()[1]) / float(box.get_size()[1])
+
+    def _restore_anchor(self, anchor):
+        index, fraction = anchor
+        if index >= self._window.imagehandler.get_number_of_pages():
+            return
+        box = self._layout.get_content_box(index)
+        self._window._vadjust.set_value(box.get_position()[1] +
+                                        int(round(fraction * box.get_size()[1])))
+
+    def _get_rendering(self, page, pixbuf):
+        """ Renderer for ImageHandler.set_renderer, called from the caching
+        threads: scale <pixbuf> to the width of the strip. """
+        settings = self._settings
+        if settings is None:
+            return None
+        # Animations are displayed as still images.
+        pixbuf = image_tools.static_image(pixbuf)
+        if settings[3]:
+            rotation = image_tools.get_implied_rotation(pixbuf)
+        else:
+            rotation = 0
+        size = self._get_scaled_size(settings, pixbuf.get_width(),
+                                     pixbuf.get_height(), rotation)
+        render = lambda: self._window._render_pixbuf(pixbuf, size, rotation,
+                                                     settings[4], settings[5])
+        return ('strip',) + settings, render
+
+    def _scrolled(self, adjustment):
+        if self._layout is not None:
+            self._schedule_update()
+
+    def _pages_rendered(self, pages):
+        if self._layout is None:
+            return
+        key = ('strip',) + self._settings
+        for page in self._estimated.intersection(pages):
+            pixbuf = self._window.imagehandler.get_rendered_pixbuf(page, key)
+            if pixbuf is not None:
+                self._set_rendered_size(page, pixbuf)
+        self._schedule_update()
+
+    def _geometry_available(self, pages):
+        if self._layout is not None and self._estimated.intersection(pages):
+            self._schedule_relayout()
+
+    def _set_rendered_size(self, page, pixbuf):
+        """ Lay out <page>, whose size was estimated, with the size of its
+        rendering <pixbuf>. """
+        self._rendered_sizes[page] = (pixbuf.get_width(), pixbuf.get_height())
+        self._schedule_relayout()
+
+    def _schedule_relayout(self):
+        if self._relayout_pending:
+            return
+        self._relayout_pending = True
+        GObject.idle_add(self._relayout_later,
+                         priority=GObject.PRIORITY_HIGH_IDLE)
+
+    def _relayout_later(self):
+        # All the geometries read in the meantime are taken into account.
+        self._relayout_pending = False
+        if self._layout is not None:
+            self.draw()
+        return False
+
+    def _schedule_update(self):
+        # Updated at most once per frame, before it is drawn.
+        if self._update_pending:
+            return
+        self._update_pending = True
+        GObject.idle_add(self._update, priority=GObject.PRIORITY_HIGH_IDLE)
+
+    def _update(self):
+        """ Display the pages in the viewport (and its margin), release the
+        others, and update the current page. """
+        self._update_pending = False
+        if self._layout is None:
+            return False
+        window = self._window
+        imagehandler = window.imagehandler
+        key = ('strip',) + self._settings
+        top = window._vadjust.get_value()
+        height = window._vadjust.get_page_size()
+        margin = height * StripView.MARGIN
+        first, last = self._layout.get_index_range(max(0, top - margin),
+                                                   top + height + margin)
+        first, last = first + 1, last + 1
+        for page in list(self._images.keys()):
+            if not first <= page <= last:
+                self._release(page)
+        for page in range(first, last + 1):
+            if page in self._images:
+                continue
+            pixbuf = imagehandler.get_rendered_pixbuf(page, key)
+            if pixbuf is not None:
+                self._show(page, pixbuf)
+
+        # The current page is the page at the top of the viewport,
+        # or the last page once scrolled to the end.
+        number_of_pages = imagehandler.get_number_of_pages()
+        if top + height >= window._vadjust.get_upper() - 1:
+            current_page = number_of_pages
+        else:
+            current_page = self._layout.get_index_at(top) + 1
+        # Ask for the pages below the current page to be cached first.
+        imagehandler.set_displayed_pages(max(1, last - current_page + 1))
+        if current_page != imagehandler.get_current_page():
+            imagehandler.set_page(current_page)
+            window.page_changed()
+        return False
+
+    def _show(self, page, pixbuf):
+        """ Display the rendered <pixbuf> of <page>. """
+        if page in self._estimated and page not in self._rendered_sizes:
+            self._set_rendered_size(page, pixbuf)
+        if self._free_images:
+            image = self._free_images.pop()
+        else:
+            image = Gtk.Image()
+            self._window._main_layout.put(image, 0, 0)
+        image_tools.set_from_pixbuf(image, pixbuf)
+        self._window._main_layout.move(image, *self._get_image_position(
+            page, pixbuf.get_width()))
+        image.show()
+        self._images[page] = image
+
+    def _release(self, page):
+        """ Stop displaying <page>, so its pixbuf can be freed. """
+        image = self._images.pop(page)
+        image.hide()
+        image.clear()
+        self._free_images.append(image)
+
+    def _release_all(self):
+        for page in list(self._images.keys()):
+            self._release(page)
+
+# vim: expandtab:sw=4:ts=4
@@ -0,0 +1,169 @@
+"""thumbnail_store.py - Packed thumbnail storage using sqlite."""
+from __future__ import with_statement
+
+import os
+import threading
+from hashlib import md5
+from urllib.request import pathname2url
+
+from mcomix import constants
+from mcomix import i18n
+from mcomix import log
+from mcomix import portability
+
+try:
+    from sqlite3 import dbapi2
+except ImportError:
+    log.warning( ('! Could neither find sqlite3.') )
+    dbapi2 = None
+
+
+def path_to_uri(path):
+    """ Return the file URI for <path>, as used by the freedesktop.org
+    thumbnail specification. """
+    return portability.uri_prefix() + pathname2url(i18n.to_utf8(os.path.normpath(path)))
+
+def uri_to_freedesktop_name(uri):
+    """ Return the thumbnail filename for <uri> in a freedesktop.org
+    thumbnail directory. """
+    if isinstance(uri, str):
+        uri = uri.encode('utf-8')
+    return md5(uri).hexdigest() + '.png'
+
+
+class ThumbnailStore(object):
+
+    """ Store thumbnails as PNG blobs in a single sqlite database,
+    instead of one file per thumbnail.
+
+    Thumbnails are indexed by (path, thumbnail size), and are only returned
+    if the modification time and size of the source file still match. Since
+    the stored PNG data include the freedesktop.org tEXt fields, thumbnails
+    can be imported from, and exported to, a freedesktop.org thumbnail
+    directory without being decoded.
+
+    All methods are thread safe.
+    """
+
+    #: Maximum number of SQL variables per query.
+    BATCH_SIZE = 500
+
+    def __init__(self, path):
+        """ Open (and create if necessary) the thumbnail database at <path>. """
+        self._lock = threading.Lock()
+        self._con = None
+        if dbapi2 is None:
+            return
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._con = dbapi2.connect(path, check_same_thread=False,
+                                   isolation_level=None)
+        self._con.execute('''create table if not exists Thumbnail (
+            path text not null,
+            thumb_size integer not null,
+            mtime integer not null,
+            size integer not null,
+            data blob not null,
+            primary key (path, thumb_size))''')
+
+    @property
+    def enabled(self):
+        return self._con is not None
+
+    def get(self, path, thumb_size, mtime=None, size=None):
+        """ Return the PNG data of the thumbnail for <path> at <thumb_size>,
+        or None if not stored, or if it was created from a file with
+        a different <mtime> or <size>. If <mtime> is None (e.g. the file
+        does not exist anymore), the stored thumbnail is always returned. """
+        if not self.enabled:
+            return None
+        with self._lock:
+            row = self._con.execute('''select mtime, size, data from Thumbnail
+                where path = ? and thumb_size = ?''', (path, thumb_size)).fetchone()
+        if row is None:
+            return None
+        if mtime is not None and (row[0], row[1]) != (int(mtime), size):
+            return None
+        return bytes(row[2])
+
+    def get_many(self, files, thumb_size):
+        """ Batch version of get(): <files> is a sequence of (path, mtime,
+        size) tuples. Return a dictionary mapping each path with a valid
+        thumbnail to its PNG data. """
+        result = {}
+        if not self.enabled:
+            return result
+        files = list(files)
+        for start in range(0, len(files), ThumbnailStore.BATCH_SIZE):
+            batch = files[start:start + ThumbnailStore.BATCH_SIZE]
+            wanted = dict((path, (int(mtime), size)) for path, mtime, size in batch)
+            with self._lock:
+                rows = self._con.execute('''select path, mtime, size, data
+                    from Thumbnail where thumb_size = ? and path in (%s)''' %
+                    ','.join('?' * len(wanted)),
+                    [thumb_size] + list(wanted.keys())).fetchall()
+            for path, mtime, size, data in rows:
+                if wanted[path] == (mtime, size):
+                    result[path] = bytes(data)
+        return result
+
+    def put(self, path, thumb_size, mtime, size, data):
+        """ Store the PNG <data> as thumbnail for <path> at <thumb_size>,
+        replacing any existing one. """
+        if not self.enabled:
+            return
+        with self._lock:
+            self._con.execute('''insert or replace into Thumbnail
+                (path, thumb_size, mtime, size, data) values (?, ?, ?, ?, ?)''',
+                (path, thumb_size, int(mtime), size, dbapi2.Binary(data)))
+
+    def delete(self, path):
+        """ Delete all thumbnails stored for <path>. """
+        if not self.enabled:
+            return
+        with self._lock:
+            self._con.execute('delete from Thumbnail where path = ?', (path,))
+
+    def count(self):
+        """ Return the number of stored thumbnails. """
+        if not self.enabled:
+            return 0
+        with self._lock:
+            return self._con.execute('select count(*) from Thumbnail').fetchone()[0]
+
+    def export_file(self, directory, path, data):
+        """ Write the thumbnail PNG <data> for <path> to the freedesktop.org
+        thumbnail <directory>. """
+        thumbpath = os.path.join(directory, uri_to_freedesktop_name(path_to_uri(path)))
+        if not os.path.isdir(directory):
+            os.makedirs(directory, 0o700)
+        # Write to a temporary file first, so other applications
+        # never see a partially written thumbnail.
+        tmppath = thumbpath + '.mcomix-%u' % os.getpid()
+        with open(tmppath, 'wb') as fp:
+            fp.write(data)
+        os.chmod(tmppath, 0o600)
+        os.rename(tmppath, thumbpath)
+        return thumbpath
+
+    def close(self):
+        """ Close the database. """
+        with self._lock:
+            if self._con is not None:
+                self._con.close()
+                self._con = None
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+def get_thumbnail_store(path=constants.THUMBNAIL_STORE_PATH):
+    """ Return the shared ThumbnailStore instance for the database at <path>. """
+    with _stores_lock:
+        store = _stores.get(path)
+        if store is None:
+            store = _stores[path] = ThumbnailStore(path)
+        return store
+
+# vim: expandtab:sw=4:ts=4
@@ -3,41 +3,43 @@ freedesktop.org "standard" at http://jens.triq.net/thumbnail-spec/
 """
 
 import os
-import re
 import shutil
 import tempfile
 import mimetypes
 import threading
 import itertools
 import traceback
-import asyncio
 import PIL.Image as Image
-from urllib.request import pathname2url
-
-from hashlib import md5 # The md5 module is deprecated as of Python 2.5, replaced by hashlib.
 
 from mcomix.preferences import prefs
 from mcomix import archive_extractor
 from mcomix import constants
 from mcomix import archive_tools
-from mcomix import tools
+from mcomix import tracing
 from mcomix import image_tools
-from mcomix import portability
-from mcomix import i18n
+from mcomix import thumbnail_store
 from mcomix import callback
 from mcomix import log
+from mcomix.worker_thread import WorkerThread
 
 
 class Thumbnailer(object):
     """ The Thumbnailer class is responsible for managing MComix
     internal thumbnail creation. Depending on its settings,
     it either stores thumbnails on disk and retrieves them later,
-    or simply creates new thumbnails each time it is called. """
+    or simply creates new thumbnails each time it is called.
+
+    Thumbnails are stored in the shared L{thumbnail_store.ThumbnailStore}.
+    Thumbnails found in <dst_dir> (freedesktop.org layout) are imported
+    into the store on first use. """
 
     def __init__(self, dst_dir=constants.THUMBNAIL_PATH, store_on_disk=None,
                  size=None, force_recreation=False, archive_support=False):
         """
-        <dst_dir> set the thumbnailer's storage directory.
+        <dst_dir> set the thumbnailer's freedesktop.org thumbnail directory,
+        used to import existing thumbnails, and to export new ones if the
+        'share thumbnails' preference is set (only for the default
+        thumbnail directory).
 
         If <store_on_disk> on disk is True, it changes the thumbnailer's
         behaviour to store files on disk, or just create new thumbnails each
@@ -67,12 +69,17 @@ class Thumbnailer(object):
             self.default_sizes = False
         self.force_recreation = force_recreation
         self.archive_support = archive_support
+        self._store = thumbnail_store.get_thumbnail_store()
 
-    async def thumbnail (self, filepath):
+    def thumbnail(self, filepath, mt=False, priority=0):
         """ Returns a thumbnail pixbuf for <filepath>, transparently handling
         both normal image files and archives. If a thumbnail file already exists,
         it is re-used. Otherwise, a new thumbnail is created from <filepath>.
 
+        If <mt> is True, a missing thumbnail is created in the background
+        by the shared thumbnail pool, lower <priority> first, and
+        thumbnail_finished is called once it is done.
+
         Returns None if thumbnail creation failed, or if the thumbnail creation
         is run asynchrounosly. """
 
@@ -81,21 +88,23 @@ class Thumbnailer(object):
             self.width = prefs['thumbnail size']
             self.height = prefs['thumbnail size']
 
-        if self._thumbnail_exists(filepath):
-            thumbpath = self._path_to_thumbpath(filepath)
-            pixbuf = image_tools.load_pixbuf(thumbpath)
+        pixbuf = self._load_stored_thumbnail(filepath)
+        if pixbuf is not None:
             self.thumbnail_finished(filepath, pixbuf)
             return pixbuf
 
+        if mt:
+            _pool.submit(self, filepath, priority)
+            return None
         else:
-            if not self._thumbnail_exists(filepath):
-                thread = threading.Thread(target=self._create_thumbnail, args=(filepath,))
-                thread.name += '-thumbnailer'
-                thread.setDaemon(True)
-                thread.start()
-                return None
-            else:
-                return self._create_thumbnail(filepath)
+            return _pool.run(self, filepath)
+
+    def cancel(self, filepath=None):
+        """ Cancels the background creation of the thumbnail for
+        <filepath>, or of all thumbnails requested by this thumbnailer if
+        <filepath> is None. Thumbnails already being created will still
+        complete, but thumbnail_finished will not be called for them. """
+        _pool.cancel(self, filepath)
 
     @callback.Callback
     def thumbnail_finished(self, filepath, pixbuf):
@@ -105,14 +114,45 @@ class Thumbnailer(object):
 
         pass
 
+    def get_stored_thumbnails(self, filepaths):
+        """ Returns a dictionary mapping each of <filepaths> with an up to
+        date stored thumbnail to its pixbuf, using a single lookup for
+        all files (e.g. the whole visible range of a view). Thumbnails
+        that are missing are not created. """
+
+        if self.default_sizes:
+            self.width = prefs['thumbnail size']
+            self.height = prefs['thumbnail size']
+
+        if self.force_recreation:
+            return {}
+
+        files = []
+        for filepath in filepaths:
+            try:
+                stat = os.stat(filepath)
+            except OSError:
+                continue
+            files.append((filepath, stat.st_mtime, stat.st_size))
+
+        pixbufs = {}
+        stored = self._store.get_many(files, self._get_thumb_size())
+        for filepath, data in stored.items():
+            try:
+                pixbufs[filepath] = image_tools.load_pixbuf_data(data)
+            except Exception:
+                log.debug("Failed to load stored thumbnail for `%s':\n%s",
+                          filepath, traceback.format_exc())
+        return pixbufs
+
     def delete(self, filepath):
         """ Deletes the thumbnail for <filepath> (if it exists) """
+        self._store.delete(filepath)
         thumbpath = self._path_to_thumbpath(filepath)
         if os.path.isfile(thumbpath):
-            error = ""
             try:
                 os.remove(thumbpath)
-            except IOError(error):
+            except (IOError, OSError) as error:
                 log.error(("! Could not remove file \"%s\""), thumbpath)
                 log.error(error)
 
@@ -125,6 +165,10 @@ class Thumbnailer(object):
         else:
             mime = None
         if mime is not None:
+            pixbuf, tEXt_data = self._create_cover_pixbuf(filepath, mime)
+            if pixbuf is not None:
+                return pixbuf, tEXt_data
+            # Slow path, handling archives within archives.
             cleanup = []
             try:
                 tmpdir = tempfile.mkdtemp(prefix=u'mcomix_archive_thumb.')
@@ -136,7 +180,7 @@ class Thumbnailer(object):
                     return None, None
                 cleanup.append(archive.close)
                 files = archive.list_contents()
-                wanted = self._guess_cover(files)
+                wanted = archive_tools.guess_cover(files)
                 if wanted is None:
                     return None, None
 
@@ -170,28 +214,89 @@ class Thumbnailer(object):
         else:
             return None, None
 
+    def _create_cover_pixbuf(self, filepath, mime):
+        """ Fast path for archive thumbnails: list the archive member names,
+        and decode the cover to the thumbnail size directly from memory,
+        without any temporary file. Returns (pixbuf, tEXt_data), or
+        (None, None) if the archive format does not support it, or if the
+        cover could not be found (e.g. it is within a sub-archive). """
+
+        archive = archive_tools.get_archive_handler(filepath, type=mime)
+        if archive is None or not archive.support_in_memory_extraction:
+            return None, None
+        try:
+            cover, data = archive.read_cover()
+        finally:
+            archive.close()
+        if not data:
+            return None, None
+
+        pixbuf = image_tools.load_pixbuf_size_data(data, self.width, self.height)
+        if self.store_on_disk:
+            format, image_size, providers = image_tools.get_image_info_data(data)
+            tEXt_data = self._get_text_data(filepath, image_size=image_size)
+        else:
+            tEXt_data = None
+
+        return pixbuf, tEXt_data
+
+    @tracing.traced('create thumbnail', 'thumbnail')
     def _create_thumbnail(self, filepath):
         """ Creates the thumbnail pixbuf for <filepath>, and saves the pixbuf
         to disk if necessary. Returns the created pixbuf, or None, if creation failed. """
 
         pixbuf, tEXt_data = self._create_thumbnail_pixbuf(filepath)
-        self.thumbnail_finished(filepath, pixbuf)
 
         if pixbuf and self.store_on_disk:
-            thumbpath = self._path_to_thumbpath(filepath)
-            self._save_thumbnail(pixbuf, thumbpath, tEXt_data)
+            self._save_thumbnail(pixbuf, filepath, tEXt_data)
 
         return pixbuf
 
-    def _get_text_data(self, filepath):
-        """ Creates a tEXt dictionary for <filepath>. """
+    def _get_thumb_size(self):
+        """ Returns the size thumbnails are stored for. """
+        return max(self.width, self.height)
+
+    def _load_stored_thumbnail(self, filepath):
+        """ Returns the stored thumbnail pixbuf for <filepath>, or None
+        if there is none, it is out of date, or <force_recreation> is True. """
+
+        if self.force_recreation:
+            return None
+
+        try:
+            stat = os.stat(filepath)
+            mtime, size = stat.st_mtime, stat.st_size
+        except OSError:
+            # The source file might no longer exist.
+            mtime = size = None
+
+        thumb_size = self._get_thumb_size()
+        data = self._store.get(filepath, thumb_size, mtime, size)
+        if data is None and mtime is not None:
+            data = self._import_thumbnail(filepath, thumb_size, mtime, size)
+        if data is None:
+            return None
+
+        try:
+            return image_tools.load_pixbuf_data(data)
+        except Exception:
+            log.debug("Failed to load stored thumbnail for `%s':\n%s",
+                      filepath, traceback.format_exc())
+            return None
+
+    def _get_text_data(self, filepath, image_size=None):
+        """ Creates a tEXt dictionary for <filepath>. If <filepath> is not
+        an image (e.g. an archive), <image_size> must be the size of the
+        image the thumbnail was created from. """
         mime = mimetypes.guess_type(filepath)[0] or "unknown/mime"
-        uri = portability.uri_prefix() + pathname2url(i18n.to_utf8(os.path.normpath(filepath)))
+        uri = thumbnail_store.path_to_uri(filepath)
         stat = os.stat(filepath)
         # MTime could be floating point number, so convert to long first to have a fixed point number
         mtime = str(int(stat.st_mtime))
         size = str(stat.st_size)
-        format, (width, height), providers = image_tools.get_image_info(filepath)
+        if image_size is None:
+            format, image_size, providers = image_tools.get_image_info(filepath)
+        width, height = image_size
         return {
             'tEXt::Thumb::URI':           uri,
             'tEXt::Thumb::MTime':         mtime,
@@ -202,91 +307,189 @@ class Thumbnailer(object):
             'tEXt::Software':             'MComix %s' % constants.VERSION
         }
 
-    def _save_thumbnail(self, pixbuf, thumbpath, tEXt_data):
-        """ Saves <pixbuf> as <thumbpath>, with additional metadata
-        from <tEXt_data>. If <thumbpath> already exists, it is overwritten. """
+    def _save_thumbnail(self, pixbuf, filepath, tEXt_data):
+        """ Stores <pixbuf> as thumbnail for <filepath>, with additional
+        metadata from <tEXt_data>. An existing thumbnail is overwritten. """
 
-        ex = ""
         try:
-            directory = os.path.dirname(thumbpath)
-            if not os.path.isdir(directory):
-                os.makedirs(directory)
-            if os.path.isfile(thumbpath):
-                os.remove(thumbpath)
+            stat = os.stat(filepath)
+            keys = list(tEXt_data.keys())
+            values = [tEXt_data[key] for key in keys]
+            success, data = pixbuf.save_to_bufferv('png', keys, values)
+            data = bytes(data)
+            self._store.put(filepath, self._get_thumb_size(),
+                            stat.st_mtime, stat.st_size, data)
+            if prefs['share thumbnails'] and \
+               self.dst_dir == constants.THUMBNAIL_PATH:
+                self._store.export_file(self.dst_dir, filepath, data)
+
+        except Exception as ex:
+            log.warning( ('! Could not save thumbnail for "%(filepath)s": %(error)s'),
+                { 'filepath' : filepath, 'error' : ex } )
+
+    def _import_thumbnail(self, filepath, thumb_size, mtime, size):
+        """ Imports the thumbnail for <filepath> from <dst_dir> into the
+        store if it exists, is up to date, and has the right size. Returns
+        the thumbnail PNG data, or None. """
 
-            pixbuf.save(thumbpath, 'png', tEXt_data)
-            os.chmod(thumbpath)
-
-        except Exception(ex):
-            log.warning( ('! Could not save thumbnail "%(thumbpath)s": %(error)s'),
-                { 'thumbpath' : thumbpath, 'error' : ex } )
-
-    def _thumbnail_exists(self, filepath):
-        """ Checks if the thumbnail for <filepath> already exists.
-        This function will return False if the thumbnail exists
-        and it's mTime doesn't match the mTime of <filepath>,
-        it's size is different from the one specified in the thumbnailer,
-        or if <force_recreation> is True. """
-
-        if not self.force_recreation:
-            thumbpath = self._path_to_thumbpath(filepath)
-
-            if os.path.isfile(thumbpath):
-                # Check the thumbnail's stored mTime
-                try:
-                    img = Image.open(thumbpath)
-                except IOError:
-                    return False
-
-                info = img.info
-                stored_mtime = int(info['Thumb::MTime'])
-                # The source file might no longer exist
-                file_mtime = os.path.isfile(filepath) and int(os.stat(filepath).st_mtime) or stored_mtime
-                return stored_mtime == file_mtime and \
-                    max(*img.size) == max(self.width, self.height)
-            else:
-                return False
-        else:
-            return False
+        thumbpath = self._path_to_thumbpath(filepath)
+        if not os.path.isfile(thumbpath):
+            return None
+
+        # Check the thumbnail's stored mTime and size
+        try:
+            img = Image.open(thumbpath)
+            info = img.info
+            img_size = img.size
+            img.close()
+            stored_mtime = int(info['Thumb::MTime'])
+        except (IOError, KeyError, ValueError):
+            return None
+        if stored_mtime != int(mtime) or max(*img_size) != thumb_size:
+            return None
+
+        with open(thumbpath, 'rb') as fp:
+            data = fp.read()
+        self._store.put(filepath, thumb_size, mtime, size, data)
+        return data
 
     def _path_to_thumbpath(self, filepath):
         """ Converts <path> to an URI for the thumbnail in <dst_dir>. """
-        uri = portability.uri_prefix() + pathname2url(i18n.to_utf8(os.path.normpath(filepath)))
+        uri = thumbnail_store.path_to_uri(filepath)
         return self._uri_to_thumbpath(uri)
 
     def _uri_to_thumbpath(self, uri):
         """ Return the full path to the thumbnail for <uri> with <dst_dir>
         being the base thumbnail directory. """
-        md5hash = md5(uri).hexdigest()
-        thumbpath = os.path.join(self.dst_dir, md5hash + '.png')
-        return thumbpath
-
-    def _guess_cover(self, files):
-        """Return the filename within <files> that is the most likely to be the
-        cover of an archive using some simple heuristics.
-        """
-        # Ignore MacOSX meta files.
-        files = itertools.ifilter(lambda filename:
-                u'__MACOSX' not in os.path.normpath(filename).split(os.sep),
-                files)
-        # Ignore credit files if possible.
-        files = itertools.ifilter(lambda filename:
-                u'credit' not in os.path.split(filename)[1].lower(), files)
-
-        images = list(itertools.ifilter(image_tools.is_image_file, files))
-
-        tools.alphanumeric_sort(images)
-
-        front_re = re.compile('(cover|front)', re.I)
-        candidates = filter(front_re.search, images)
-        candidates = [c for c in candidates if 'back' not in c.lower()]
-
-        if candidates:
-            return candidates[0]
-
-        if images:
-            return images[0]
-
-        return None
+        return os.path.join(self.dst_dir, thumbnail_store.uri_to_freedesktop_name(uri))
+
+
+class _ThumbnailRequest(object):
+
+    """ A thumbnail being created by the L{_ThumbnailPool}. """
+
+    def __init__(self, thumbnailer, filepath, seq):
+        #: Thumbnailer whose settings are used to create the thumbnail.
+        self.thumbnailer = thumbnailer
+        self.filepath = filepath
+        #: Sequence number of the pool order for this request.
+        self.seq = seq
+        #: Thumbnailers to notify once the thumbnail is created.
+        self.listeners = [thumbnailer]
+        self.started = False
+        self.event = threading.Event()
+        self.pixbuf = None
+
+
+class _ThumbnailPool(object):
+
+    """ Pool of threads shared by all thumbnailers, so the number of
+    thumbnails created at the same time (and of temporary directories used
+    to extract covers) stays bounded, whatever the number of requests.
+
+    Requests are processed by increasing priority, then in submission
+    order. Requests for the same file and thumbnail settings are coalesced:
+    the thumbnail is only created once, and all requesters are notified.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        #: Pending requests: request key > L{_ThumbnailRequest}.
+        self._requests = {}
+        self._counter = itertools.count()
+        self._thread = None
+
+    def _get_key(self, thumbnailer, filepath):
+        return (filepath, thumbnailer.width, thumbnailer.height,
+                thumbnailer.dst_dir, thumbnailer.archive_support)
+
+    def _get_thread(self):
+        # Must be called with the lock held.
+        if self._thread is None:
+            self._thread = WorkerThread(self._process_order,
+                                        name='thumbnail',
+                                        max_threads=prefs['max threads'],
+                                        sort_orders=True)
+        return self._thread
+
+    def submit(self, thumbnailer, filepath, priority):
+        """ Queue the creation of the thumbnail for <filepath>. """
+        key = self._get_key(thumbnailer, filepath)
+        with self._lock:
+            request = self._requests.get(key)
+            if request is None:
+                request = _ThumbnailRequest(thumbnailer, filepath, next(self._counter))
+                self._requests[key] = request
+            else:
+                if thumbnailer not in request.listeners:
+                    request.listeners.append(thumbnailer)
+                if request.started:
+                    return
+                # Queue it again, in case the new priority is higher:
+                # the first order processed wins, the other is ignored.
+                request.seq = next(self._counter)
+            self._get_thread().append_order((priority, request.seq, key))
+
+    def run(self, thumbnailer, filepath):
+        """ Create the thumbnail for <filepath> in the calling thread, or
+        wait for it if it is already being created. Return the pixbuf. """
+        key = self._get_key(thumbnailer, filepath)
+        with self._lock:
+            request = self._requests.get(key)
+            if request is None:
+                request = _ThumbnailRequest(thumbnailer, filepath, None)
+                self._requests[key] = request
+            elif thumbnailer not in request.listeners:
+                request.listeners.append(thumbnailer)
+            owner = not request.started
+            request.started = True
+        if owner:
+            self._create(key, request)
+        else:
+            request.event.wait()
+        return request.pixbuf
+
+    def cancel(self, thumbnailer, filepath=None):
+        """ Remove <thumbnailer> from the listeners of the request for
+        <filepath> (or of all requests if None). Requests nobody is
+        waiting for anymore are dropped if not started yet. """
+        with self._lock:
+            for key, request in list(self._requests.items()):
+                if filepath is not None and request.filepath != filepath:
+                    continue
+                if thumbnailer not in request.listeners:
+                    continue
+                request.listeners.remove(thumbnailer)
+                if not request.listeners and not request.started:
+                    del self._requests[key]
+
+    def _process_order(self, order):
+        priority, seq, key = order
+        with self._lock:
+            request = self._requests.get(key)
+            if request is None or request.started or request.seq != seq:
+                # Cancelled, or outdated order.
+                return
+            request.started = True
+        self._create(key, request)
+
+    def _create(self, key, request):
+        pixbuf = None
+        try:
+            pixbuf = request.thumbnailer._create_thumbnail(request.filepath)
+        except Exception:
+            log.debug("Failed to create thumbnail for `%s':\n%s",
+                      request.filepath, traceback.format_exc())
+        finally:
+            with self._lock:
+                del self._requests[key]
+                listeners = request.listeners[:]
+            request.pixbuf = pixbuf
+            request.event.set()
+        for thumbnailer in listeners:
+            thumbnailer.thumbnail_finished(request.filepath, pixbuf)
+
+
+_pool = _ThumbnailPool()
 
 # vim: expandtab:sw=4:ts=4
@@ -39,6 +39,12 @@ class ThumbnailViewBase(object):
         """ This function must return the thumbnail for C{uid}. """
         raise NotImplementedError()
 
+    #: Optional function returning a dictionary mapping each of the given
+    #: uids with an already stored thumbnail to its pixbuf, with a single
+    #: lookup for all of them. Run by a worker thread before generating the
+    #: missing thumbnails one by one.
+    get_stored_thumbnails = None
+
     def get_visible_range(self):
         """ See L{gtk.IconView.get_visible_range}. """
         raise NotImplementedError()
@@ -82,15 +88,38 @@ class ThumbnailViewBase(object):
                     pixbufs_needed.append((uid, iter))
             if len(pixbufs_needed) > 0:
                 self._updates_stopped = False
-                self._thread.extend_orders(pixbufs_needed)
+                if self.get_stored_thumbnails is None:
+                    self._thread.extend_orders(pixbufs_needed)
+                else:
+                    # Look up the stored thumbnails of the whole range first.
+                    uids = tuple(uid for uid, iter in pixbufs_needed)
+                    self._thread.append_order((uids, pixbufs_needed))
 
     def _pixbuf_worker(self, order):
-        """ Run by a worker thread to generate the thumbnail for a path."""
+        """ Run by a worker thread to generate the thumbnail for a path,
+        or to look up the stored thumbnails of a range of paths."""
         uid, iter = order
+        if isinstance(uid, tuple):
+            self._stored_pixbufs_worker(iter)
+            return
         pixbuf = self.generate_thumbnail(uid)
         if pixbuf is not None:
             GObject.idle_add(self._pixbuf_finished, iter, pixbuf)
 
+    def _stored_pixbufs_worker(self, pixbufs_needed):
+        """ Display the stored thumbnails of <pixbufs_needed>, a list
+        of (uid, iter) tuples, and queue the generation of the others."""
+        pixbufs = self.get_stored_thumbnails([uid for uid, iter in pixbufs_needed])
+        missing = []
+        for uid, iter in pixbufs_needed:
+            pixbuf = pixbufs.get(uid)
+            if pixbuf is None:
+                missing.append((uid, iter))
+            else:
+                GObject.idle_add(self._pixbuf_finished, iter, pixbuf)
+        if len(missing) > 0 and not self._thread.must_stop():
+            self._thread.extend_orders(missing)
+
     def _pixbuf_finished(self, iter, pixbuf):
         """ Executed when a pixbuf was created, to actually insert the pixbuf
         into the view store. C{pixbuf_info} is a tuple containing
@@ -0,0 +1,335 @@
+"""tiled_image.py - Display of very large pages, one tile at a time."""
+from __future__ import with_statement
+
+import collections
+import itertools
+import threading
+
+import gi
+gi.require_version("Gtk", "3.0")
+from gi.repository import Gtk, GObject, GdkPixbuf
+
+from mcomix import callback
+from mcomix import image_tools
+from mcomix import log
+from mcomix import pixbuf_cache
+from mcomix import tools
+from mcomix.worker_thread import WorkerThread
+
+#: Width and height of the tiles, in pixels.
+TILE_SIZE = 512
+#: Pages whose scaled area is larger than that many viewports are tiled.
+MIN_VIEWPORTS = 4
+#: Number of rows and columns of tiles around the viewport rendered in
+#: advance, so that panning does not reveal missing tiles.
+PREFETCH_TILES = 1
+#: Size of the previews used to compute the histogram of a page.
+HISTOGRAM_PREVIEW_SIZE = 512
+
+
+def should_tile(size, viewport_size):
+    """ Return True if a page scaled to <size> should be displayed tile
+    by tile in a viewport of <viewport_size>. """
+    viewport_area = max(1, viewport_size[0]) * max(1, viewport_size[1])
+    return size[0] * size[1] > MIN_VIEWPORTS * viewport_area
+
+
+#: What a page is rendered from: see TiledImage.set_page.
+_Source = collections.namedtuple('_Source', 'generation key pixbuf size '
+                                 'rotation transform parameters')
+
+
+class TiledImage(object):
+
+    """ Displays a page scaled to a size much larger than the viewport
+    (a very large image, or a page zoomed in a lot) without scaling the
+    whole page: the scaled page is split in tiles of TILE_SIZE, and only
+    the tiles intersecting the viewport, and the ones around them, are
+    scaled.
+
+    Tiles are rendered (scaled, rotated, flipped and enhanced) by
+    background threads, visible tiles first, then the tiles in the
+    direction the viewport is moving. They are cached for each size the
+    page is displayed at, in a cache bounded by a few times the viewport
+    size, so that memory use depends on the size of the screen, not on the
+    size of the page.
+    """
+
+    def __init__(self, window):
+        self._window = window
+        self._lock = threading.Lock()
+        self._source = None
+        #: Position of the page in the main layout.
+        self._position = (0, 0)
+        #: Source pixbuf and its histogram, for enhancement.
+        self._histogram = (None, None)
+        #: Incremented for each new source pixbuf, so that tiles of a page
+        #: are never mistaken for tiles of another page rendered the same way.
+        self._generations = itertools.count()
+        #: Rendered tiles: (generation, key, column, row) > pixbuf.
+        self._cache = pixbuf_cache.PixbufCache(0)
+        #: Queued tiles: (generation, key, column, row) > order token.
+        self._orders = {}
+        #: Displayed tiles: (column, row) > Gtk.Image.
+        self._images = {}
+        #: Image widgets not in use.
+        self._free_images = []
+        #: Last viewport position, and direction the viewport moved in.
+        self._viewport_position = None
+        self._direction = (0, 0)
+        self._update_pending = False
+        self._thread = WorkerThread(self._render_tile, name='tiles',
+                                    max_threads=tools.cpu_count(),
+                                    unique_orders=True)
+        self.tiles_rendered += self._tiles_rendered
+        window._hadjust.connect('value-changed', self._scrolled)
+        window._vadjust.connect('value-changed', self._scrolled)
+
+    def set_page(self, pixbuf, size, rotation, transform, parameters,
+                 key, position):
+        """ Display <pixbuf> scaled to <size>, rotated by <rotation>,
+        flipped and scaled according to the transform settings <transform>
+        (see MainWindow._get_transform_settings), and enhanced with the
+        enhancement values <parameters>. <key> identifies this rendering
+        of the page (see MainWindow._get_render_key), and <position> is the
+        position of the page in the main layout. """
+        source = self._source
+        if source is None or source.key != key or source.pixbuf is not pixbuf:
+            if source is None or source.pixbuf is not pixbuf:
+                # Another page: the cached tiles are useless.
+                self._cache.clear()
+                generation = next(self._generations)
+            else:
+                generation = source.generation
+            self._cancel_orders()
+            self._release_all()
+            self._source = _Source(generation, key, pixbuf, tuple(size),
+                                   rotation, transform, parameters)
+        if position != self._position:
+            self._position = position
+            for (column, row), image in self._images.items():
+                self._move(image, column, row)
+        self._schedule_update()
+
+    def clear(self):
+        """ Stop displaying the page, and free its tiles. """
+        if self._source is None:
+            return
+        self._source = None
+        self._cancel_orders()
+        self._release_all()
+        self._cache.clear()
+        with self._lock:
+            self._histogram = (None, None)
+        self._viewport_position = None
+
+    def stop(self):
+        """ Stop rendering tiles in the background. """
+        self._thread.stop()
+
+    def get_stats(self):
+        """ Return a dictionary with the tile cache statistics. """
+        stats = self._cache.get_stats()
+        stats['displayed'] = len(self._images)
+        return stats
+
+    @callback.coalesced
+    def tiles_rendered(self, tiles):
+        """ Called when <tiles> were rendered in the background. """
+        pass
+
+    def _get_grid_size(self, size):
+        return ((size[0] + TILE_SIZE - 1) // TILE_SIZE,
+                (size[1] + TILE_SIZE - 1) // TILE_SIZE)
+
+    def _get_tile_region(self, size, column, row):
+        """ Return the (x, y, width, height) region of the scaled page
+        covered by the tile at <column> and <row>. """
+        x, y = column * TILE_SIZE, row * TILE_SIZE
+        return (x, y, min(TILE_SIZE, size[0] - x), min(TILE_SIZE, size[1] - y))
+
+    def _get_histogram(self, source):
+        """ Return the histogram of the page, computed on a preview. Must
+        be called with the lock held. """
+        pixbuf, histogram = self._histogram
+        if pixbuf is not source.pixbuf:
+            preview = image_tools.fit_in_rectangle(
+                source.pixbuf, HISTOGRAM_PREVIEW_SIZE, HISTOGRAM_PREVIEW_SIZE,
+                scaling_quality=GdkPixbuf.InterpType.BILINEAR)
+            histogram = image_tools.pixbuf_to_pil(preview).histogram()
+            self._histogram = (source.pixbuf, histogram)
+        return histogram
+
+    def _render_tile(self, order):
+        """ Render a tile in the background. """
+        (generation, key, column, row), source = order
+        log.debug('Rendering tile %u,%u', column, row)
+        size = source.size
+        hflip, vflip, scaling_quality, checkered_bg = source.transform
+        x, y, width, height = self._get_tile_region(size, column, row)
+        # Flipping is done last: find the region before flipping.
+        if hflip:
+            x = size[0] - x - width
+        if vflip:
+            y = size[1] - y - height
+        tile = image_tools.fit_pixbuf_region(source.pixbuf, size,
+                                             source.rotation,
+                                             (x, y, width, height),
+                                             scaling_quality, checkered_bg)
+        if hflip:
+            tile = tile.flip(horizontal=True)
+        if vflip:
+            tile = tile.flip(horizontal=False)
+        brightness, contrast, saturation, sharpness, autocontrast = \
+                source.parameters
+        histogram = None
+        if brightness != 1.0 or contrast != 1.0 or autocontrast:
+            # Use the statistics of the whole page, so that all the tiles
+            # are enhanced the same way.
+            with self._lock:
+                histogram = self._get_histogram(source)
+        tile = self._window.enhancer.enhance(tile, source.parameters,
+                                             histogram=histogram)
+        if self._thread.must_stop():
+            # Scrolled away, or another page is displayed.
+            return
+        self._cache.add((generation, key, column, row), tile)
+        self.tiles_rendered([(column, row)])
+
+    def _cancel_orders(self):
+        for token in self._orders.values():
+            token.cancel()
+        self._orders.clear()
+
+    def _tiles_rendered(self, tiles):
+        if self._source is not None:
+            self._schedule_update()
+
+    def _scrolled(self, adjustment):
+        if self._source is not None:
+            self._schedule_update()
+
+    def _schedule_update(self):
+        # Updated at most once per frame, before it is drawn.
+        if self._update_pending:
+            return
+        self._update_pending = True
+        GObject.idle_add(self._update, priority=GObject.PRIORITY_HIGH_IDLE)
+
+    def _get_visible_range(self, viewport_box):
+        """ Return the (first column, first row, last column, last row)
+        of the tiles intersecting <viewport_box>, which may be out of the
+        page. """
+        viewport_position = viewport_box.get_position()
+        viewport_size = viewport_box.get_size()
+        first = [(viewport_position[axis] - self._position[axis]) // TILE_SIZE
+                 for axis in range(2)]
+        last = [(viewport_position[axis] + max(1, viewport_size[axis]) - 1 -
+                 self._position[axis]) // TILE_SIZE for axis in range(2)]
+        return first[0], first[1], last[0], last[1]
+
+    def _update(self):
+        """ Display the rendered tiles around the viewport, queue the
+        missing ones, and release the others. """
+        self._update_pending = False
+        source = self._source
+        if source is None:
+            return False
+        window = self._window
+        window.update_layout_position()
+        viewport_box = window.layout.get_viewport_box()
+        viewport_position = viewport_box.get_position()
+        if self._viewport_position is not None:
+            self._direction = tuple((new > old) - (new < old) for new, old in
+                                    zip(viewport_position,
+                                        self._viewport_position))
+        self._viewport_position = viewport_position
+        columns, rows = self._get_grid_size(source.size)
+        first_column, first_row, last_column, last_row = \
+                self._get_visible_range(viewport_box)
+        center = [viewport_position[axis] - self._position[axis] +
+                  viewport_box.get_size()[axis] // 2 for axis in range(2)]
+
+        def get_priority(column, row):
+            visible = first_column <= column <= last_column and \
+                    first_row <= row <= last_row
+            offset = ((column + 0.5) * TILE_SIZE - center[0],
+                      (row + 0.5) * TILE_SIZE - center[1])
+            # Prefetch the tiles ahead of the viewport first.
+            ahead = offset[0] * self._direction[0] + \
+                    offset[1] * self._direction[1] > 0
+            return (0 if visible else 1, 0 if visible or ahead else 1,
+                    offset[0] ** 2 + offset[1] ** 2)
+
+        wanted = []
+        for row in range(max(0, first_row - PREFETCH_TILES),
+                         min(rows, last_row + PREFETCH_TILES + 1)):
+            for column in range(max(0, first_column - PREFETCH_TILES),
+                                min(columns, last_column + PREFETCH_TILES + 1)):
+                wanted.append((get_priority(column, row), column, row))
+        wanted.sort()
+
+        # Keep twice the wanted tiles, so that panning back and forth or
+        # zooming back does not render them again.
+        visible_size = [(viewport_box.get_size()[axis] + TILE_SIZE - 1)
+                        // TILE_SIZE + 1 + 2 * PREFETCH_TILES for axis in range(2)]
+        self._cache.set_max_size(2 * visible_size[0] * visible_size[1] *
+                                 TILE_SIZE * TILE_SIZE * 4)
+        self._cache.set_wanted([(source.generation, source.key, column, row)
+                                for priority, column, row in wanted])
+
+        orders = {}
+        tiles = set()
+        for priority, column, row in wanted:
+            tiles.add((column, row))
+            uid = (source.generation, source.key, column, row)
+            pixbuf = self._cache.get(uid)
+            if pixbuf is not None:
+                if (column, row) not in self._images:
+                    self._show(column, row, pixbuf)
+                continue
+            token = self._orders.pop(uid, None)
+            if token is not None and not token.is_done():
+                self._thread.reprioritize_order(uid, priority)
+            else:
+                token = self._thread.append_order((uid, source), priority)
+            if token is not None:
+                orders[uid] = token
+        # Tiles scrolled away are not rendered anymore.
+        self._cancel_orders()
+        self._orders = orders
+        for tile in list(self._images.keys()):
+            if tile not in tiles:
+                self._release(*tile)
+        return False
+
+    def _move(self, image, column, row):
+        self._window._main_layout.move(image,
+                                       self._position[0] + column * TILE_SIZE,
+                                       self._position[1] + row * TILE_SIZE)
+
+    def _show(self, column, row, pixbuf):
+        """ Display the rendered <pixbuf> of the tile at <column> and
+        <row>. """
+        if self._free_images:
+            image = self._free_images.pop()
+        else:
+            image = Gtk.Image()
+            self._window._main_layout.put(image, 0, 0)
+        image_tools.set_from_pixbuf(image, pixbuf)
+        self._move(image, column, row)
+        image.show()
+        self._images[(column, row)] = image
+
+    def _release(self, column, row):
+        """ Stop displaying the tile at <column> and <row>. """
+        image = self._images.pop((column, row))
+        image.hide()
+        image.clear()
+        self._free_images.append(image)
+
+    def _release_all(self):
+        for tile in list(self._images.keys()):
+            self._release(*tile)
+
+# vim: expandtab:sw=4:ts=4
@@ -8,6 +8,7 @@ import bisect
 import operator
 import math
 import itertools
+import multiprocessing
 
 
 NUMERIC_REGEXP = re.compile(r"\d+|\D+")  # Split into numerics and characters
@@ -104,6 +105,22 @@ def get_data_directory():
         return os.path.join(base_path, 'mcomix')
 
 
+def get_cache_directory():
+    """Return the path to the MComix cache directory. On UNIX, this will
+    be $XDG_CACHE_HOME/mcomix, on Windows it will be the same directory as
+    get_home_directory().
+
+    See http://standards.freedesktop.org/basedir-spec/latest/ for more
+    information on the $XDG_CACHE_HOME environmental variable.
+    """
+    if sys.platform == 'win32':
+        return get_home_directory()
+    else:
+        base_path = os.getenv('XDG_CACHE_HOME',
+            os.path.join(get_home_directory(), '.cache'))
+        return os.path.join(base_path, 'mcomix')
+
+
 def number_of_digits(n):
     if 0 == n:
         return 1
@@ -131,6 +148,13 @@ def garbage_collect():
     else:
         gc.collect()
 
+def cpu_count():
+    """ Returns the number of available processors (at least 1). """
+    try:
+        return max(1, multiprocessing.cpu_count())
+    except NotImplementedError:
+        return 1
+
 
 def div(a, b):
     return float(a) / float(b)
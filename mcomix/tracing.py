@@ -0,0 +1,135 @@
+""" tracing.py - Record timed spans of the page pipeline (archive listing,
+extraction, decoding, drawing, worker threads...), and save them in the
+Chrome trace event format, which can be loaded in chrome://tracing or
+Perfetto (https://ui.perfetto.dev).
+
+Tracing is enabled with the --trace command line option. When disabled,
+it costs nothing: traced() returns the decorated function unchanged, and
+span() returns a shared context manager doing nothing. Since traced() is
+evaluated when the decorated function is defined, enable() must be called
+before the traced modules are imported (see run.py).
+"""
+from __future__ import with_statement
+
+import atexit
+import functools
+import json
+import os
+import threading
+import time
+
+from mcomix import log
+
+#: True if tracing is enabled.
+enabled = False
+
+_path = None
+_events = []
+_events_lock = threading.Lock()
+_thread_names = {}
+_start_time = time.time()
+
+
+def timestamp(t=None):
+    """ Return the trace timestamp, in microseconds, for the time <t> (as
+    returned by time.time()), or for the current time if None. """
+    if t is None:
+        t = time.time()
+    return (t - _start_time) * 1000000.0
+
+def enable(path):
+    """ Start tracing, the trace will be written to <path> on exit. """
+    global enabled, _path
+    enabled = True
+    _path = path
+    atexit.register(save)
+
+def add_span(name, category, start, end, args=None):
+    """ Record a span <name> from <start> to <end> (as returned by
+    timestamp()) for the current thread. """
+    if not enabled:
+        return
+    thread = threading.current_thread()
+    event = {
+        'name': name,
+        'cat': category,
+        'ph': 'X',
+        'ts': start,
+        'dur': end - start,
+        'pid': os.getpid(),
+        'tid': thread.ident,
+    }
+    if args:
+        event['args'] = args
+    with _events_lock:
+        _thread_names[thread.ident] = thread.name
+        _events.append(event)
+
+
+class _Span(object):
+
+    def __init__(self, name, category, args):
+        self._name = name
+        self._category = category
+        self._args = args
+        self._start = None
+
+    def __enter__(self):
+        self._start = timestamp()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        add_span(self._name, self._category, self._start, timestamp(), self._args)
+        return False
+
+
+class _NullSpan(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+_NULL_SPAN = _NullSpan()
+
+def span(name, category, **args):
+    """ Return a context manager recording its duration as a span <name>
+    in <category>, with optional <args> shown in the trace viewer. """
+    if not enabled:
+        return _NULL_SPAN
+    return _Span(name, category, args)
+
+def traced(name, category):
+    """ Decorator recording each call of the decorated function as
+    a span <name> in <category>. """
+    def decorator(function):
+        if not enabled:
+            return function
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with _Span(name, category, None):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def save():
+    """ Write the recorded trace to the file given to enable(). """
+    if _path is None:
+        return
+    with _events_lock:
+        events = list(_events)
+        thread_names = dict(_thread_names)
+    pid = os.getpid()
+    for tid, name in thread_names.items():
+        events.append({'name': 'thread_name', 'ph': 'M', 'pid': pid,
+                       'tid': tid, 'args': {'name': name}})
+    try:
+        with open(_path, 'w') as fp:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, fp)
+    except (IOError, OSError) as e:
+        log.error('! Could not write trace to "%s": %s', _path, e)
+        return
+    log.info('Trace written to "%s" (%u events)', _path, len(events))
+
+# vim: expandtab:sw=4:ts=4
@@ -114,6 +114,8 @@ class MainUI(Gtk.UIManager):
                 None, ('Fullscreen mode'), window.change_fullscreen),
             ('double_page', 'mcomix-double-page', ('_Double page mode'),
                 None, ('Double page mode'), window.change_double_page),
+            ('strip_mode', None, ('_Strip mode'),
+                None, ('Continuous vertical strip of pages'), window.change_strip_mode),
             ('toolbar', None, ('_Toolbar'),
                 None, None, window.change_toolbar_visibility),
             ('menubar', None, ('_Menubar'),
@@ -259,6 +261,7 @@ class MainUI(Gtk.UIManager):
                 <menu action="menu_view">
                     <menuitem action="fullscreen" />
                     <menuitem action="double_page" />
+                    <menuitem action="strip_mode" />
                     <menuitem action="manga_mode" />
                     <separator />
                     <menuitem action="best_fit_mode" />
@@ -352,6 +355,7 @@ class MainUI(Gtk.UIManager):
                 <menu action="menu_view_popup">
                     <menuitem action="fullscreen" />
                     <menuitem action="double_page" />
+                    <menuitem action="strip_mode" />
                     <menuitem action="manga_mode" />
                     <separator />
                     <menuitem action="best_fit_mode" />
@@ -1,13 +1,53 @@
 """ Worker thread class. """
 from __future__ import with_statement
 
+import heapq
+import itertools
 import threading
+import time
 import traceback
 
 from mcomix import log
+from mcomix import tracing
+
+
+class OrderToken(object):
+
+    """ Handle on a work order queued in a WorkerThread, used to cancel
+    it. A running order can check if it was cancelled with
+    WorkerThread.must_stop(). """
+
+    QUEUED, RUNNING, DONE, CANCELLED = range(4)
+
+    def __init__(self, worker, order, uid):
+        self.order = order
+        self._worker = worker
+        self._uid = uid
+        self._state = OrderToken.QUEUED
+        #: Current sort key and sequence number in the queue.
+        self._key = None
+        self._seq = None
+        #: Time the order was queued at.
+        self._queued_time = time.time()
+
+    def cancel(self):
+        """ Cancel the order: it will not be processed if still queued,
+        and must_stop() will return True if it is running. """
+        self._worker._cancel(self)
+
+    def is_cancelled(self):
+        return self._state == OrderToken.CANCELLED
+
+    def is_done(self):
+        return self._state in (OrderToken.DONE, OrderToken.CANCELLED)
+
 
 class WorkerThread(object):
 
+    #: Worker threads idle for that many seconds are stopped (new ones
+    #: are started when orders are added).
+    IDLE_TIMEOUT = 30.0
+
     def __init__(self, process_order, name=None, max_threads=1,
                  sort_orders=False, unique_orders=False):
         """Create a new pool of worker threads.
@@ -15,9 +55,14 @@ class WorkerThread(object):
         Optional <name> will be added to spawned thread names.
         <process_order> will be called to process each work order.
         At most <max_threads> will be started for processing.
-        If <sort_orders> is True, the orders queue will be sorted
-        after each addition. If <unique_orders> is True, duplicate
-        orders will not be added to the queue. """
+        If <sort_orders> is True, orders are processed in increasing
+        order (unless queued with an explicit priority, see append_order).
+        Otherwise, they are processed in the order they were added.
+        If <unique_orders> is True, duplicate orders (queued or running)
+        will not be added to the queue.
+
+        Orders are identified by their uid: the first element of a tuple
+        or list order, or the order itself. """
         self._name = name
         self._process_order = process_order
         self._max_threads = max_threads
@@ -25,12 +70,23 @@ class WorkerThread(object):
         self._unique_orders = unique_orders
         self._stop = False
         self._threads = []
-        # Queue of orders waiting for processing.
+        # Priority queue of (key, sequence number, token). Entries of
+        # cancelled or re-prioritized orders are left in place and
+        # skipped when popped.
         self._orders_queue = []
-        if self._unique_orders:
-            # Track orders.
-            self._orders_set = set()
+        self._sequence = itertools.count()
+        # Queued and running orders: uid > token.
+        self._tokens = {}
+        # Token of the order being processed by the current thread.
+        self._local = threading.local()
         self._condition = threading.Condition()
+        # Statistics.
+        self._queued = 0
+        self._running = 0
+        self._completed = 0
+        self._cancelled = 0
+        self._started = 0
+        self._total_wait = 0.0
 
     def __enter__(self):
         return self._condition.__enter__()
@@ -38,110 +94,231 @@ class WorkerThread(object):
     def __exit__(self, exc_type, exc_value, traceback):
         return self._condition.__exit__(exc_type, exc_value, traceback)
 
-    def _start(self, nb_threads=1):
+    def _start(self):
+        # Must be called with the condition held. Start enough threads
+        # for the running and queued orders (idle threads pick up queued
+        # orders first).
+        nb_threads = min(self._max_threads, self._running + self._queued) - \
+                len(self._threads)
         for n in range(nb_threads):
-            if len(self._threads) == self._max_threads:
-                break
             thread = threading.Thread(target=self._run)
             if self._name is not None:
                 thread.name += '-' + self._name
             thread.setDaemon(False)
-            thread.start()
             self._threads.append(thread)
+            thread.start()
 
     def _order_uid(self, order):
         if isinstance(order, tuple) or isinstance(order, list):
             return order[0]
         return order
 
+    def _next_token(self):
+        """Pop the next order to process from the queue, or return None if
+        the thread should exit. Must be called with the condition held."""
+        while True:
+            while not self._stop and 0 == self._queued:
+                if not self._condition.wait(WorkerThread.IDLE_TIMEOUT) and \
+                   0 == self._queued:
+                    # Idle for too long.
+                    return None
+            if self._stop:
+                return None
+            key, seq, token = heapq.heappop(self._orders_queue)
+            if token._seq == seq and token._state == OrderToken.QUEUED:
+                return token
+
     def _run(self):
-        order_uid = None
         while True:
             with self._condition:
-                if order_uid is not None:
-                    self._orders_set.remove(order_uid)
-                while not self._stop and 0 == len(self._orders_queue):
-                    self._condition.wait()
-                if self._stop:
+                token = self._next_token()
+                if token is None:
+                    self._threads.remove(threading.current_thread())
                     return
-                order = self._orders_queue.pop(0)
-                if self._unique_orders:
-                    order_uid = self._order_uid(order)
-            e = ""
+                token._state = OrderToken.RUNNING
+                self._queued -= 1
+                self._running += 1
+                self._started += 1
+                start = time.time()
+                self._total_wait += start - token._queued_time
+            self._local.token = token
             try:
-                self._process_order(order)
-            except Exception(e):
+                self._process_order(token.order)
+            except Exception as e:
                 log.error(('! Worker thread processing %(function)r failed: %(error)s'),
                           { 'function' : self._process_order, 'error' : e })
                 log.debug('Traceback:\n%s', traceback.format_exc())
+            self._local.token = None
+            with self._condition:
+                self._running -= 1
+                if token._state == OrderToken.RUNNING:
+                    token._state = OrderToken.DONE
+                    self._completed += 1
+                if self._tokens.get(token._uid) is token:
+                    del self._tokens[token._uid]
+            if tracing.enabled:
+                self._trace_order(token._queued_time, start)
+
+    def _trace_order(self, queued, start):
+        """Record the time an order waited in the queue since <queued>,
+        and the time it took to process since <start>."""
+        name = getattr(self._process_order, '__name__', 'order')
+        queued, start = tracing.timestamp(queued), tracing.timestamp(start)
+        tracing.add_span('queued', 'worker', queued, start, {'function': name})
+        tracing.add_span(name, 'worker', start, tracing.timestamp())
+
+    def _push(self, token, priority):
+        # Must be called with the condition held.
+        if priority is not None:
+            key = priority
+        elif self._sort_orders:
+            key = token.order
+        else:
+            key = 0
+        token._key = key
+        token._seq = next(self._sequence)
+        heapq.heappush(self._orders_queue, (key, token._seq, token))
+
+    def _queue_order(self, order, priority):
+        """Queue <order>, and return its token, or None if it is
+        a duplicate. Must be called with the condition held."""
+        uid = self._order_uid(order)
+        if self._unique_orders and uid in self._tokens:
+            # Duplicate order.
+            return None
+        token = OrderToken(self, order, uid)
+        self._tokens[uid] = token
+        self._push(token, priority)
+        self._queued += 1
+        return token
+
+    def _cancel(self, token):
+        with self._condition:
+            if token.is_done():
+                return
+            if token._state == OrderToken.QUEUED:
+                self._queued -= 1
+            token._state = OrderToken.CANCELLED
+            self._cancelled += 1
+            if self._tokens.get(token._uid) is token:
+                del self._tokens[token._uid]
 
     def must_stop(self):
-        """Return true if we've been asked to stop processing.
+        """Return true if we've been asked to stop processing, or if the
+        order being processed by the calling thread was cancelled.
 
         Can be used by the processing function to check if it must abort early.
         """
-        return self._stop
+        if self._stop:
+            return True
+        token = getattr(self._local, 'token', None)
+        return token is not None and token.is_cancelled()
 
     def clear_orders(self):
-        """Clear the current orders queue."""
+        """Clear the current orders queue. Orders already being processed
+        are not cancelled."""
         with self._condition:
-            if self._unique_orders:
-                # We can't just clear the set, as some orders
-                # can be in the process of being processed.
-                for order in self._orders_queue:
-                    order_uid = self._order_uid(order)
-                    self._orders_set.remove(order_uid)
+            for key, seq, token in self._orders_queue:
+                if token._seq == seq and token._state == OrderToken.QUEUED:
+                    self._cancel(token)
             self._orders_queue = []
 
-    def append_order(self, order):
-        """Append work order to the thread orders queue."""
+    def cancel_order(self, order_uid):
+        """Cancel the queued or running order identified by <order_uid>.
+        Return False if there is no such order."""
         with self._condition:
-            if self._unique_orders:
-                order_uid = self._order_uid(order)
-                if order_uid in self._orders_set:
-                    # Duplicate order.
-                    return
-                self._orders_set.add(order_uid)
-            self._orders_queue.append(order)
-            if self._sort_orders:
-                self._orders_queue.sort()
-            self._condition.notifyAll()
+            token = self._tokens.get(order_uid)
+            if token is None:
+                return False
+            self._cancel(token)
+            return True
+
+    def reprioritize_order(self, order_uid, priority):
+        """Change the <priority> of the queued order identified by
+        <order_uid>. Return False if there is no such queued order."""
+        with self._condition:
+            token = self._tokens.get(order_uid)
+            if token is None or token._state != OrderToken.QUEUED:
+                return False
+            # The previous queue entry is now outdated, and will be skipped.
+            self._push(token, priority)
+            return True
+
+    def reprioritize_orders(self, get_priority):
+        """Change the priority of all queued orders to the value returned
+        by <get_priority>(order)."""
+        with self._condition:
+            queue = []
+            for key, seq, token in self._orders_queue:
+                if token._seq != seq or token._state != OrderToken.QUEUED:
+                    continue
+                token._key = get_priority(token.order)
+                queue.append((token._key, seq, token))
+            heapq.heapify(queue)
+            self._orders_queue = queue
+
+    def append_order(self, order, priority=None):
+        """Append work order to the thread orders queue. If <priority> is
+        not None, orders are processed by increasing priority instead.
+        Return the order token, or None if it is a duplicate."""
+        with self._condition:
+            token = self._queue_order(order, priority)
+            if token is None:
+                return None
+            self._condition.notify()
             self._start()
+            return token
 
-    def extend_orders(self, orders_list):
-        """Append work orders to the thread orders queue."""
+    def extend_orders(self, orders_list, get_priority=None):
+        """Append work orders to the thread orders queue, with the priority
+        returned by <get_priority>(order) if not None (see append_order).
+        Return the list of tokens of the queued orders (duplicates are
+        not queued)."""
         with self._condition:
-            if self._unique_orders:
-                nb_added = 0
-                for order in orders_list:
-                    order_uid = self._order_uid(order)
-                    if order_uid in self._orders_set:
-                        # Duplicate order.
-                        continue
-                    self._orders_set.add(order_uid)
-                    self._orders_queue.append(order)
-                    nb_added += 1
-            else:
-                self._orders_queue.extend(orders_list)
-                nb_added = len(orders_list)
-            if 0 == nb_added:
-                return
-            if self._sort_orders:
-                self._orders_queue.sort()
-            self._condition.notifyAll()
-            self._start(nb_threads=nb_added)
+            tokens = []
+            for order in orders_list:
+                if get_priority is None:
+                    priority = None
+                else:
+                    priority = get_priority(order)
+                token = self._queue_order(order, priority)
+                if token is not None:
+                    tokens.append(token)
+            if 0 == len(tokens):
+                return tokens
+            self._condition.notify(len(tokens))
+            self._start()
+            return tokens
+
+    def get_stats(self):
+        """Return a dictionary with the number of queued, running,
+        completed and cancelled orders, the number of threads, and the
+        mean time (in seconds) orders waited in the queue."""
+        with self._condition:
+            started = self._started
+            return {
+                'queued': self._queued,
+                'running': self._running,
+                'completed': self._completed,
+                'cancelled': self._cancelled,
+                'threads': len(self._threads),
+                'mean wait': self._total_wait / started if started else 0.0,
+            }
 
     def stop(self):
         """Stop the worker threads and flush the orders queue."""
         self._stop = True
         with self._condition:
             self._condition.notifyAll()
-        for thread in self._threads:
+            threads = self._threads[:]
+        for thread in threads:
             thread.join()
-        self._threads = []
-        self._stop = False
-        self._orders_queue = []
-        if self._unique_orders:
-            self._orders_set.clear()
+        with self._condition:
+            self._stop = False
+            for key, seq, token in self._orders_queue:
+                if token._seq == seq and token._state == OrderToken.QUEUED:
+                    self._cancel(token)
+            self._orders_queue = []
+            self._tokens.clear()
 
 # vim: expandtab:sw=4:ts=4
@@ -1,5 +1,7 @@
 """ Handles zoom and fit of images in the main display area. """
 
+import copy
+
 from mcomix import constants
 from mcomix.preferences import prefs
 from mcomix import tools
@@ -21,6 +23,17 @@ class ZoomModel(object):
         #: calculating its maximum size.
         self._fitmode = constants.ZOOM_MODE_MANUAL
         self._scale_up = False
+        #: Fit to size mode and size, or None to use the preferences.
+        self._fit_to_size = None
+
+    def snapshot(self):
+        """ Return a copy of the model, with the current fit to size
+        preferences, unaffected by later changes (e.g. to zoom from another
+        thread with the settings of the displayed page). """
+        zoom = copy.copy(self)
+        zoom._fit_to_size = (prefs['fit to size mode'],
+                             prefs['fit to size px'])
+        return zoom
 
     def set_fit_mode(self, fitmode):
         if fitmode < constants.ZOOM_MODE_BEST or \
@@ -28,6 +41,21 @@ class ZoomModel(object):
             raise ValueError("No fit mode for id %d." % fitmode)
         self._fitmode = fitmode
 
+    def get_fit_mode(self):
+        return self._fitmode
+
+    def has_user_zoom(self):
+        """ Return True if the user zoomed in or out of the fitted size. """
+        return self._user_zoom_log != IDENTITY_ZOOM_LOG
+
+    def get_user_zoom_log(self):
+        return self._user_zoom_log
+
+    def get_user_zoom(self):
+        """ Returns the scale applied on top of the fit mode by the user
+        zoom (1.0 when not zoomed). """
+        return 2 ** (self._user_zoom_log / USER_ZOOM_LOG_SCALE1)
+
     def get_scale_up(self):
         return self._scale_up
 
@@ -66,7 +94,7 @@ class ZoomModel(object):
             image_sizes = new_image_sizes2
         union_size = _union_size(image_sizes, distribution_axis)
         limits = ZoomModel._calc_limits(union_size, screen_size, self._fitmode,
-            scale_up)
+            scale_up, self._fit_to_size)
         prefscale = ZoomModel._preferred_scale(union_size, limits, distribution_axis)
         preferred_scales = tuple([prefscale if not dnt else IDENTITY_ZOOM for dnt in do_not_transform])
         prescaled = map(lambda size, scale, dnt: tuple(_scale_image_size(size, scale)),
@@ -91,7 +119,7 @@ class ZoomModel(object):
                 preferred_scales = distributed_scales
         if not scale_up:
             preferred_scales = map(lambda x: min(x, IDENTITY_ZOOM), preferred_scales)
-        user_scale = 2 ** (self._user_zoom_log / USER_ZOOM_LOG_SCALE1)
+        user_scale = self.get_user_zoom()
         res_scales = [preferred_scales[i] * (user_scale if not do_not_transform[i] else IDENTITY_ZOOM)
             for i in range(len(preferred_scales))]
         return tuple(map(lambda size, scale: tuple(_scale_image_size(size, scale)),
@@ -117,10 +145,12 @@ class ZoomModel(object):
         return min_scale
 
     @staticmethod
-    def _calc_limits(union_size, screen_size, fitmode, allow_upscaling):
+    def _calc_limits(union_size, screen_size, fitmode, allow_upscaling,
+                     fit_to_size=None):
         """ Returns a list or a tuple with the i-th element set to int x if
         fitmode limits the size at the i-th axis to x, or None if fitmode has no
-        preference for this axis. """
+        preference for this axis. <fit_to_size> is the (mode, size) used by
+        ZOOM_MODE_SIZE, or None to use the preferences. """
         manual = fitmode == constants.ZOOM_MODE_MANUAL
         if fitmode == constants.ZOOM_MODE_BEST or \
             (manual and allow_upscaling and all(tools.smaller(union_size, screen_size))):
@@ -129,8 +159,11 @@ class ZoomModel(object):
         if not manual:
             fixed_size = None
             if fitmode == constants.ZOOM_MODE_SIZE:
-                fitmode = prefs['fit to size mode'] # reassigning fitmode
-                fixed_size = int(prefs['fit to size px'])
+                if fit_to_size is None:
+                    fit_to_size = (prefs['fit to size mode'],
+                                   prefs['fit to size px'])
+                fitmode = fit_to_size[0] # reassigning fitmode
+                fixed_size = int(fit_to_size[1])
             if fitmode == constants.ZOOM_MODE_WIDTH:
                 axis = constants.WIDTH_AXIS
             elif fitmode == constants.ZOOM_MODE_HEIGHT:
@@ -19,4 +19,7 @@
 # -------------------------------------------------------------------------
 
 import mcomix.run
-mcomix.run.run()
+
+# Guarded, since the PDF render processes import the main module.
+if __name__ == '__main__':
+    mcomix.run.run()
@@ -17,10 +17,10 @@ locale.setlocale(locale.LC_ALL, '')
 # Since some of MComix' modules depend on gettext being installed for _(),
 # add such a function here that simply returns the string passed into it.
 
-import __builtin__
+import builtins
 
-if '_' not in __builtin__.__dict__:
-    __builtin__.__dict__['_'] = unicode
+if '_' not in builtins.__dict__:
+    builtins.__dict__['_'] = str
 
 # Enable debug logging to make post-mortem analysis easier.
 
@@ -75,25 +75,31 @@ class MComixTest(unittest.TestCase):
             self.__class__.__name__,
             self._testMethodName))
         failed = False
-        if hasattr(self._resultForDoCleanups, '_excinfo'):
-            # When running under py.test2
-            exclist = self._resultForDoCleanups._excinfo
-            if exclist is not None:
-                for exc in exclist:
+        outcome = getattr(self, '_outcome', None)
+        if outcome is not None:
+            if hasattr(outcome, 'errors'):
+                # Python < 3.11
+                errors = outcome.errors
+            else:
+                result = outcome.result
+                errors = getattr(result, 'errors', []) + \
+                        getattr(result, 'failures', [])
+            for test, exc_info in errors:
+                if test is self and exc_info:
+                    failed = True
+                    break
+            excinfo = getattr(outcome.result, '_excinfo', None)
+            if excinfo:
+                # When running under py.test
+                for exc in excinfo:
                     if 'XFailed' != exc.typename:
                         failed = True
                         break
-        if hasattr(self._resultForDoCleanups, 'failures'):
-            # When running under nosetest2
-            for failure, traceback in self._resultForDoCleanups.failures:
-                if failure.id() == self.id():
-                    failed = True
-                    break
         if not failed:
             shutil.rmtree(self.tmp_dir)
 
 # Helper to get path to testsuite sample files.
 
 def get_testfile_path(*components):
-    return unicode(os.path.join(os.path.dirname(__file__), 'files', *components))
+    return str(os.path.join(os.path.dirname(__file__), 'files', *components))
 
@@ -0,0 +1,405 @@
+#!/usr/bin/env python3
+"""benchmark.py - Headless page-turn latency benchmark.
+
+Generate books of each supported format, open them with the file and
+image handlers (no window is shown: a minimal stand-in for the main window
+is used), and measure:
+
+- the time to first page: from opening the book to the first page being
+  ready to display (decoded and scaled to the viewport)
+- the latency of sequential page turns, with a configurable reading delay
+  between turns (so read-ahead gets a chance to run)
+- the latency of random jumps
+- the peak resident memory
+
+Each book is benchmarked in its own process, so memory usage and caches
+do not leak from one book to the next. Results are written as JSON, and
+can be compared with the results of a previous run (e.g. another commit):
+
+    python3 test/benchmark.py -o new.json --compare old.json
+
+Formats requiring an external tool that is not installed (7z, rar) are
+skipped. GTK needs a display: use xvfb-run on a headless box.
+"""
+
+import json
+import optparse
+import os
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+#: Generated book formats: format > (file extension, archiver command).
+FORMATS = {
+    'cbz': ('.cbz', None),
+    'cbr': ('.cbr', 'rar'),
+    '7z': ('.cb7', '7z'),
+    'tar': ('.cbt', None),
+    'pdf': ('.pdf', None),
+}
+
+
+def _generate_pages(directory, pages, width, height, seed):
+    """ Write <pages> JPEG images of <width> x <height> to <directory>,
+    and return their paths. """
+    from PIL import Image, ImageDraw
+    rng = random.Random(seed)
+    paths = []
+    for n in range(pages):
+        im = Image.new('RGB', (width, height), (255, 255, 255))
+        draw = ImageDraw.Draw(im)
+        # Panels of flat colours and lines, roughly like a comic page.
+        for panel in range(rng.randint(4, 8)):
+            x0, y0 = rng.randrange(width), rng.randrange(height)
+            x1, y1 = rng.randrange(x0, width + 1), rng.randrange(y0, height + 1)
+            colour = tuple(rng.randrange(256) for c in range(3))
+            draw.rectangle((x0, y0, x1, y1), fill=colour, outline=(0, 0, 0))
+        for line in range(200):
+            draw.line([(rng.randrange(width), rng.randrange(height))
+                       for point in range(2)], fill=(0, 0, 0), width=2)
+        path = os.path.join(directory, 'page%04u.jpg' % (n + 1))
+        im.save(path, quality=90)
+        paths.append(path)
+    return paths
+
+def _generate_book(fmt, path, pages):
+    """ Create the book <path> in format <fmt> from the images <pages>.
+    Return False if the format is not available. """
+    extension, command = FORMATS[fmt]
+    if command is not None and shutil.which(command) is None:
+        return False
+    names = [os.path.basename(page) for page in pages]
+    directory = os.path.dirname(pages[0])
+    if 'cbz' == fmt:
+        import zipfile
+        with zipfile.ZipFile(path, 'w', zipfile.ZIP_STORED) as archive:
+            for page, name in zip(pages, names):
+                archive.write(page, name)
+    elif 'tar' == fmt:
+        import tarfile
+        with tarfile.open(path, 'w') as archive:
+            for page, name in zip(pages, names):
+                archive.add(page, name)
+    elif 'cbr' == fmt:
+        subprocess.check_call(['rar', 'a', '-inul', '-ep', path] + pages)
+    elif '7z' == fmt:
+        subprocess.check_call(['7z', 'a', '-bd', '-t7z', path] + names,
+                              cwd=directory, stdout=subprocess.DEVNULL)
+    elif 'pdf' == fmt:
+        from PIL import Image
+        images = [Image.open(page) for page in pages]
+        images[0].save(path, save_all=True, append_images=images[1:],
+                       resolution=150.0)
+    return True
+
+def _summarize(samples):
+    """ Return statistics (in milliseconds) for the durations <samples>
+    (in seconds). """
+    if not samples:
+        return None
+    samples = sorted(1000.0 * s for s in samples)
+    def percentile(p):
+        return samples[min(len(samples) - 1, int(p * len(samples)))]
+    return {
+        'count': len(samples),
+        'min': samples[0],
+        'median': percentile(0.5),
+        'mean': sum(samples) / len(samples),
+        'p90': percentile(0.9),
+        'max': samples[-1],
+    }
+
+
+class _Stub(object):
+
+    """ Stand-in for the main window widgets used by the handlers. """
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: None
+
+
+class _BenchmarkWindow(object):
+
+    """ Minimal main window: just enough for FileHandler and ImageHandler,
+    with the current page "displayed" the same way MainWindow does (pages
+    are scaled to the viewport, using the rendered pages cache). """
+
+    def __init__(self, viewport):
+        from mcomix import constants
+        from mcomix import file_handler
+        from mcomix import image_handler
+        from mcomix import zoom
+        self._viewport = tuple(viewport)
+        self.is_manga_mode = False
+        self.statusbar = _Stub()
+        self.osd = _Stub()
+        self.uimanager = _Stub()
+        self.uimanager.recent = _Stub()
+        self.zoom = zoom.ZoomModel()
+        self.zoom.set_fit_mode(constants.ZOOM_MODE_BEST)
+        self.filehandler = file_handler.FileHandler(self)
+        self.imagehandler = image_handler.ImageHandler(self)
+        self.imagehandler.set_renderer(self._viewport, self._get_rendering)
+
+    def displayed_double(self):
+        return False
+
+    def get_visible_area_size(self):
+        return self._viewport
+
+    def set_page(self, num, at_bottom=False):
+        if num != self.imagehandler.get_current_page():
+            self.imagehandler.set_page(num)
+
+    def _get_rendering(self, page, pixbuf):
+        from mcomix import constants
+        from mcomix import image_tools
+        if image_tools.is_animation(pixbuf):
+            return None
+        size = self.zoom.get_zoomed_size(
+            [(pixbuf.get_width(), pixbuf.get_height())], self._viewport,
+            constants.DISTRIBUTION_AXIS, [False], False)[0]
+        key = (pixbuf.get_width(), pixbuf.get_height(), tuple(size))
+        return key, lambda: image_tools.fit_pixbuf_to_rectangle(pixbuf, size, 0)
+
+    def display_page(self, timeout):
+        """ Wait for the current page to be available, and prepare it for
+        display. Return False on timeout. """
+        if not _run_until(self.imagehandler.page_is_available, timeout):
+            return False
+        page = self.imagehandler.get_current_page()
+        pixbuf = self.imagehandler.get_pixbufs(1)[0]
+        rendering = self._get_rendering(page, pixbuf)
+        if rendering is None:
+            # Animations are displayed as is.
+            return True
+        key, render = rendering
+        if self.imagehandler.get_rendered_pixbuf(page, key) is None:
+            self.imagehandler.add_rendered_pixbuf(page, key, render())
+        return True
+
+
+def _run_until(condition, timeout):
+    """ Run the main loop until <condition>() is true, or <timeout>
+    seconds elapsed. """
+    from gi.repository import GLib
+    context = GLib.MainContext.default()
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            return False
+        if not context.iteration(False):
+            time.sleep(0.001)
+    return True
+
+def _idle(delay):
+    """ Run the main loop for <delay> seconds. """
+    end = time.time() + delay
+    _run_until(lambda: time.time() >= end, delay + 1)
+
+def benchmark_book(path, options):
+    """ Benchmark the book at <path>, return the results dictionary. """
+    from mcomix import i18n
+    from mcomix import log
+    i18n.install_gettext()
+    log.setLevel('WARNING')
+    window = _BenchmarkWindow((options.width, options.height))
+    result = {}
+
+    start = time.time()
+    if not window.filehandler.open_file(path) or \
+       not _run_until(lambda: window.filehandler.file_loaded, options.timeout) or \
+       not window.display_page(options.timeout):
+        result['error'] = 'could not open book'
+        return result
+    result['time_to_first_page'] = 1000.0 * (time.time() - start)
+    number_of_pages = window.imagehandler.get_number_of_pages()
+    result['pages'] = number_of_pages
+
+    turns = []
+    for page in range(2, min(number_of_pages, options.turns + 1) + 1):
+        _idle(options.read_delay)
+        start = time.time()
+        window.set_page(page)
+        if not window.display_page(options.timeout):
+            result['error'] = 'timeout on page %u' % page
+            break
+        turns.append(time.time() - start)
+    result['page_turn'] = _summarize(turns)
+
+    jumps = []
+    rng = random.Random(options.seed)
+    for n in range(options.jumps):
+        page = rng.randint(1, number_of_pages)
+        _idle(options.read_delay)
+        start = time.time()
+        window.set_page(page)
+        if not window.display_page(options.timeout):
+            result['error'] = 'timeout on page %u' % page
+            break
+        jumps.append(time.time() - start)
+    result['random_jump'] = _summarize(jumps)
+    result['cache'] = window.imagehandler.get_cache_stats()
+    result['caching_threads'] = window.imagehandler.get_thread_stats()
+
+    window.filehandler.close_file()
+    # ru_maxrss is in kilobytes on Linux.
+    result['peak_rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    result['peak_children_rss_kb'] = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return result
+
+def _get_git_commit(directory):
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=directory,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def _compare(baseline, results):
+    """ Print the change of each measure of <results> relative to
+    <baseline>. """
+    baseline_books = dict((book['format'], book) for book in baseline['books'])
+    for book in results['books']:
+        old = baseline_books.get(book['format'])
+        if old is None or 'error' in book or 'error' in old:
+            continue
+        measures = [('time_to_first_page', old.get('time_to_first_page'),
+                     book.get('time_to_first_page'))]
+        for name in ('page_turn', 'random_jump'):
+            if old.get(name) and book.get(name):
+                for stat in ('median', 'p90'):
+                    measures.append(('%s %s' % (name, stat),
+                                     old[name][stat], book[name][stat]))
+        measures.append(('peak_rss_kb', old.get('peak_rss_kb'), book.get('peak_rss_kb')))
+        for name, before, after in measures:
+            if not before or after is None:
+                continue
+            print('%-5s %-20s %10.1f -> %10.1f (%+.1f%%)' % (
+                book['format'], name, before, after, 100.0 * (after - before) / before))
+
+def _get_child_args(options):
+    """ Return the command line options passed to the per book process. """
+    return ['--width', str(options.width), '--height', str(options.height),
+            '--turns', str(options.turns), '--jumps', str(options.jumps),
+            '--read-delay', str(options.read_delay), '--seed', str(options.seed),
+            '--timeout', str(options.timeout)]
+
+def main(args):
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('-f', '--formats', default=','.join(sorted(FORMATS)),
+                      help='comma separated list of book formats (default: %default)')
+    parser.add_option('-p', '--pages', type='int', default=40,
+                      help='number of pages per book (default: %default)')
+    parser.add_option('--page-size', default='1600x2400',
+                      help='page resolution (default: %default)')
+    parser.add_option('--width', type='int', default=1280,
+                      help='viewport width (default: %default)')
+    parser.add_option('--height', type='int', default=1024,
+                      help='viewport height (default: %default)')
+    parser.add_option('--turns', type='int', default=20,
+                      help='number of sequential page turns (default: %default)')
+    parser.add_option('--jumps', type='int', default=10,
+                      help='number of random jumps (default: %default)')
+    parser.add_option('--read-delay', type='float', default=0.2,
+                      help='seconds spent on a page before turning it (default: %default)')
+    parser.add_option('--seed', type='int', default=42,
+                      help='random seed (default: %default)')
+    parser.add_option('--timeout', type='float', default=60.0,
+                      help='seconds to wait for a page (default: %default)')
+    parser.add_option('-o', '--output', default='-',
+                      help='JSON output file (default: standard output)')
+    parser.add_option('--compare', metavar='FILE',
+                      help='compare with the results in FILE')
+    parser.add_option('--book', help=optparse.SUPPRESS_HELP)
+    parser.add_option('--book-result', help=optparse.SUPPRESS_HELP)
+    options, args = parser.parse_args(args)
+
+    if options.book is not None:
+        # Child process: benchmark a single book.
+        result = benchmark_book(options.book, options)
+        with open(options.book_result, 'w') as fp:
+            json.dump(result, fp)
+        return 0
+
+    page_width, page_height = [int(n) for n in options.page_size.split('x')]
+    source_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    results = {
+        'version': None,
+        'commit': _get_git_commit(source_dir),
+        'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'settings': {
+            'pages': options.pages,
+            'page_size': [page_width, page_height],
+            'viewport': [options.width, options.height],
+            'turns': options.turns,
+            'jumps': options.jumps,
+            'read_delay': options.read_delay,
+            'seed': options.seed,
+        },
+        'books': [],
+    }
+    work_dir = tempfile.mkdtemp(prefix='mcomix-benchmark.')
+    try:
+        page_dir = os.path.join(work_dir, 'pages')
+        os.mkdir(page_dir)
+        pages = _generate_pages(page_dir, options.pages, page_width,
+                                page_height, options.seed)
+        for fmt in options.formats.split(','):
+            book = os.path.join(work_dir, 'book' + FORMATS[fmt][0])
+            if not _generate_book(fmt, book, pages):
+                results['books'].append({'format': fmt, 'error': 'not available'})
+                continue
+            # Isolate each run: no preferences, library, or caches
+            # from the user or from a previous book.
+            home_dir = tempfile.mkdtemp(prefix='home.', dir=work_dir)
+            env = dict(os.environ)
+            env['HOME'] = home_dir
+            for name in ('XDG_DATA_HOME', 'XDG_CONFIG_HOME', 'XDG_CACHE_HOME'):
+                env[name] = os.path.join(home_dir, name.lower())
+            env['TMPDIR'] = home_dir
+            env['PYTHONPATH'] = os.pathsep.join(
+                [source_dir] + [p for p in (env.get('PYTHONPATH'),) if p])
+            result_path = os.path.join(home_dir, 'result.json')
+            returncode = subprocess.call([sys.executable, os.path.abspath(__file__),
+                                          '--book', book, '--book-result', result_path] +
+                                         _get_child_args(options),
+                                         env=env, stdout=subprocess.DEVNULL)
+            try:
+                with open(result_path) as fp:
+                    result = json.load(fp)
+            except (IOError, ValueError):
+                result = {'error': 'benchmark process failed (%d)' % returncode}
+            result['format'] = fmt
+            result['file_size'] = os.path.getsize(book)
+            results['books'].append(result)
+            print('%s: %s' % (fmt, result.get('error', 'done')), file=sys.stderr)
+    finally:
+        shutil.rmtree(work_dir)
+
+    sys.path.insert(0, source_dir)
+    from mcomix import constants
+    results['version'] = constants.VERSION
+
+    if '-' == options.output:
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        print()
+    else:
+        with open(options.output, 'w') as fp:
+            json.dump(results, fp, indent=2, sort_keys=True)
+    if options.compare is not None:
+        with open(options.compare) as fp:
+            _compare(json.load(fp), results)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
+
+# vim: expandtab:sw=4:ts=4
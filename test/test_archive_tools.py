@@ -1,4 +1,6 @@
 
+import bz2
+import gzip
 import os
 
 from . import MComixTest, get_testfile_path
@@ -54,3 +56,19 @@ class ArchiveToolsTest(MComixTest):
            )
            self.assertEqual(archive_type, expected_type, msg=msg)
 
+    def test_archive_mime_type_compressed_non_tar(self):
+
+       # Compressed files that are not tar archives are not archives.
+       data = open(get_testfile_path('images', 'pattern.jpg'), 'rb').read()
+       for ext, compress in (
+           ('gz' , gzip.compress),
+           ('bz2', bz2.compress),
+       ):
+           path = os.path.join(self.tmp_dir, 'pattern.jpg.' + ext)
+           with open(path, 'wb') as fp:
+               fp.write(compress(data))
+           archive_type = archive_tools.archive_mime_type(path)
+           self.assertIsNone(archive_type,
+                             msg='archive_mime_type("%s") failed; '
+                             'result differs: %s instead of None'
+                             % (path, archive_type))
@@ -7,10 +7,12 @@ import re
 import shutil
 import sys
 import tempfile
+import threading
 import unittest
 
 from . import MComixTest, get_testfile_path
 
+from mcomix import archive_tools
 from mcomix import process
 from mcomix.archive import (
     archive_recursive,
@@ -249,6 +251,68 @@ class ArchiveFormatTest(object):
         # (necessary to prevent bad performances on solid archives)
         self.assertEqual(extracted, contents)
 
+    def test_read(self):
+        self.archive = self.handler(self.archive_path)
+        contents = self.archive.list_contents()
+        if not self.archive.support_in_memory_extraction:
+            raise unittest.SkipTest('in-memory extraction not supported')
+        # Use out-of-order reads to try to trip implementation.
+        for name in reversed(contents):
+            data = self.archive.read(name)
+            original = open(get_testfile_path(self.archive_contents[name]), 'rb').read()
+            self.assertEqual((name, hashlib.md5(data).hexdigest()),
+                             (name, hashlib.md5(original).hexdigest()))
+
+    def test_concurrent_read(self):
+        self.archive = self.handler(self.archive_path)
+        contents = self.archive.list_contents()
+        if not self.archive.support_in_memory_extraction:
+            raise unittest.SkipTest('in-memory extraction not supported')
+        if not self.archive.support_concurrent_extractions \
+           or self.archive.is_solid():
+            raise unittest.SkipTest('concurrent extractions not supported')
+        result = {}
+        def read(names):
+            for name in names:
+                result[name] = self.archive.read(name)
+        threads = [threading.Thread(target=read, args=(contents[n::2],))
+                   for n in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertItemsEqual(result.keys(), contents)
+        for name, data in result.items():
+            original = open(get_testfile_path(self.archive_contents[name]), 'rb').read()
+            self.assertEqual((name, hashlib.md5(data).hexdigest()),
+                             (name, hashlib.md5(original).hexdigest()))
+
+    def test_iter_read(self):
+        self.archive = self.handler(self.archive_path)
+        contents = self.archive.list_contents()
+        if not self.archive.support_in_memory_extraction:
+            raise unittest.SkipTest('in-memory extraction not supported')
+        read = []
+        for name, data in self.archive.iter_read(reversed(contents)):
+            read.append(name)
+            original = open(get_testfile_path(self.archive_contents[name]), 'rb').read()
+            self.assertEqual((name, hashlib.md5(data).hexdigest()),
+                             (name, hashlib.md5(original).hexdigest()))
+        # Same as iter_extract: entries must be read in archive order.
+        self.assertEqual(read, contents)
+
+    def test_read_cover(self):
+        self.archive = self.handler(self.archive_path)
+        contents = self.archive.list_contents()
+        if not self.archive.support_in_memory_extraction:
+            raise unittest.SkipTest('in-memory extraction not supported')
+        cover, data = self.archive.read_cover()
+        self.assertEqual(cover, archive_tools.guess_cover(contents))
+        if cover is not None:
+            original = open(get_testfile_path(self.archive_contents[cover]), 'rb').read()
+            self.assertEqual(hashlib.md5(data).hexdigest(),
+                             hashlib.md5(original).hexdigest())
+
 
 class RecursiveArchiveFormatTest(ArchiveFormatTest):
 
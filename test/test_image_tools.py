@@ -4,12 +4,15 @@ import binascii
 import os
 import sys
 import tempfile
+import unittest
 
-import gtk, gobject
+import gi
+gi.require_version('GdkPixbuf', '2.0')
+from gi.repository import GdkPixbuf, GLib
 
 from collections import namedtuple
-from PIL import Image, ImageDraw
-from cStringIO import StringIO
+from PIL import Image, ImageChops, ImageDraw, ImageEnhance, ImageOps
+from io import BytesIO
 from difflib import unified_diff
 
 from . import MComixTest, get_testfile_path
@@ -81,8 +84,8 @@ def get_image_path(basename):
     return get_testfile_path('images', basename)
 
 def new_pixbuf(size, with_alpha, fill_colour):
-    pixbuf = gtk.gdk.Pixbuf(gtk.gdk.COLORSPACE_RGB,
-                            with_alpha, 8, size[0], size[1])
+    pixbuf = GdkPixbuf.Pixbuf.new(GdkPixbuf.Colorspace.RGB,
+                                  with_alpha, 8, size[0], size[1])
     pixbuf.fill(fill_colour)
     return pixbuf
 
@@ -99,7 +102,7 @@ def new_pixbuf(size, with_alpha, fill_colour):
 #
 def xhexdump(data, group_size=4):
     addr, size = 0, 0
-    io = StringIO(data)
+    io = BytesIO(data)
     chunk_size = group_size * 8
     prev_addr, prev_hex = (0, '')
     format_line = lambda addr, hex: '%07x: %s' % (addr, hex)
@@ -110,7 +113,7 @@ def xhexdump(data, group_size=4):
                 yield format_line(addr - prev_addr, '*')
             break
         size += len(chunk)
-        chunk = binascii.hexlify(chunk)
+        chunk = binascii.hexlify(chunk).decode('ascii')
         hex = []
         for s in range(0, chunk_size * 2, group_size * 2):
             hex.append(chunk[s:s+(group_size*2)])
@@ -128,9 +131,9 @@ def hexdump(data, group_size=4):
     return [line for line in xhexdump(data, group_size=group_size)]
 
 def composite_image(im1, im2):
-    if isinstance(im1, gtk.gdk.Pixbuf):
+    if isinstance(im1, GdkPixbuf.Pixbuf):
         im1 = image_tools.pixbuf_to_pil(im1)
-    if isinstance(im2, gtk.gdk.Pixbuf):
+    if isinstance(im2, GdkPixbuf.Pixbuf):
         im2 = image_tools.pixbuf_to_pil(im2)
     im = Image.new('RGBA',
                    (im1.size[0] + im2.size[0],
@@ -167,15 +170,15 @@ class ImageToolsTest(object):
                 'diff': diff_fmt % args,
             })
         def info(im):
-            if isinstance(im, gtk.gdk.Pixbuf):
+            if isinstance(im, GdkPixbuf.Pixbuf):
                 width, stride = im.get_width(), im.get_rowstride()
                 line_size = width * im.get_n_channels()
                 if stride == line_size:
                     pixels = im.get_pixels()
                 else:
                     assert stride > line_size
-                    io = StringIO(im.get_pixels())
-                    pixels = ''
+                    io = BytesIO(im.get_pixels())
+                    pixels = b''
                     while True:
                         line = io.read(line_size)
                         if not line:
@@ -250,7 +253,7 @@ class ImageToolsTest(object):
         if self.use_pil:
             exception = IOError
         else:
-            exception = gobject.GError
+            exception = GLib.GError
         self.assertRaises(exception, image_tools.load_pixbuf, os.devnull)
 
     def test_load_pixbuf_size_basic(self):
@@ -309,7 +312,7 @@ class ImageToolsTest(object):
             self.assertImagesEqual(result, expected, msg=msg)
             # Check image is scaled down if bigger than target dimensions,
             # and that aspect ratio is kept.
-            target_size = image.size[0], image.size[1] / 2
+            target_size = image.size[0], image.size[1] // 2
             result = image_tools.load_pixbuf_size(image_path,
                                                   *target_size)
             msg = (
@@ -318,13 +321,38 @@ class ImageToolsTest(object):
                 % ((name,) + target_size)
             )
             self.assertEqual((result.get_width(), result.get_height()),
-                             (image.size[0] / 2, image.size[1] / 2))
+                             (image.size[0] // 2, image.size[1] // 2))
+
+    def test_load_pixbuf_reduced(self):
+        for name in (
+            'pattern.jpg',
+            'pattern-opaque-rgba.png',
+        ):
+            image = get_test_image(name)
+            image_path = get_image_path(image.name)
+            # Never scaled up.
+            target_size = 2 * image.size[0], 2 * image.size[1]
+            result, original_size = image_tools.load_pixbuf_reduced(image_path,
+                                                                    *target_size)
+            self.assertEqual(original_size, image.size)
+            self.assertEqual((result.get_width(), result.get_height()), image.size)
+            # Scaled down, keeping the aspect ratio,
+            # from a file or from its contents.
+            target_size = image.size[0], image.size[1] // 2
+            with open(image_path, 'rb') as fp:
+                data = fp.read()
+            for imgdata in (None, data):
+                result, original_size = image_tools.load_pixbuf_reduced(
+                    image_path, *target_size, imgdata=imgdata)
+                self.assertEqual(original_size, image.size)
+                self.assertEqual((result.get_width(), result.get_height()),
+                                 (image.size[0] // 2, image.size[1] // 2))
 
     def test_load_pixbuf_size_invalid(self):
         if self.use_pil:
             exception = IOError
         else:
-            exception = gobject.GError
+            exception = GLib.GError
         self.assertRaises(exception, image_tools.load_pixbuf_size, os.devnull, 50, 50)
 
     # Expose a rounding error bug in load_pixbuf_size.
@@ -371,6 +399,67 @@ class ImageToolsTest(object):
             self.assertImagesEqual(pixbuf, expected_im, msg=msg)
         # TODO: test keep_orientation
 
+    def test_enhance(self):
+        base_im = Image.open(get_image_path('pattern-opaque-rgb.png')).convert('RGB')
+        pixbuf = image_tools.pil_to_pixbuf(base_im)
+        for brightness, contrast, autocontrast in (
+            (1.0, 1.0, False),
+            (1.5, 1.0, False),
+            (0.7, 1.0, True),
+            (1.2, 1.4, False),
+            (1.0, 0.5, False),
+        ):
+            expected_im = ImageEnhance.Brightness(base_im).enhance(brightness)
+            if autocontrast:
+                expected_im = ImageOps.autocontrast(expected_im, cutoff=0.1)
+            else:
+                expected_im = ImageEnhance.Contrast(expected_im).enhance(contrast)
+            im = image_tools.pixbuf_to_pil(image_tools.enhance(
+                pixbuf, brightness=brightness, contrast=contrast,
+                autocontrast=autocontrast))
+            # The mean used for contrast may be off by one.
+            diff = ImageChops.difference(im, expected_im)
+            self.assertLessEqual(max(band[1] for band in diff.getextrema()), 1,
+                                 msg='enhance(%s, %s, %s) failed'
+                                 % (brightness, contrast, autocontrast))
+
+    def test_pixbuf_to_array(self):
+        if image_tools.numpy is None:
+            raise unittest.SkipTest('NumPy is not available')
+        for image in (
+            'pattern.jpg',
+            'pattern-opaque-rgb.png',
+            'pattern-transparent-rgba.png',
+        ):
+            pixbuf = image_tools.load_pixbuf(get_image_path(image))
+            expected = image_tools.numpy.asarray(image_tools.pixbuf_to_pil(pixbuf))
+            result = image_tools.pixbuf_to_array(pixbuf)
+            self.assertEqual(result.shape, expected.shape,
+                             msg='pixbuf_to_array("%s") failed' % image)
+            self.assertTrue((result == expected).all(),
+                            msg='pixbuf_to_array("%s") failed' % image)
+
+    def test_get_most_common_edge_colour(self):
+        # The NumPy version must find the same colours.
+        if image_tools.numpy is None:
+            raise unittest.SkipTest('NumPy is not available')
+        pixbufs = [image_tools.load_pixbuf(get_image_path(image)) for image in (
+            'blue.png',
+            'red.png',
+            'pattern.jpg',
+            'pattern-opaque-rgb.png',
+            'landscape-no-exif.jpg',
+        )]
+        for arg in pixbufs + list(zip(pixbufs, reversed(pixbufs))):
+            result = image_tools.get_most_common_edge_colour(arg)
+            numpy = image_tools.numpy
+            image_tools.numpy = None
+            try:
+                expected = image_tools.get_most_common_edge_colour(arg)
+            finally:
+                image_tools.numpy = numpy
+            self.assertEqual(list(result), list(expected))
+
     def test_get_image_info(self):
         for image in _TEST_IMAGES:
             image_path = get_image_path(image.name)
@@ -413,6 +502,24 @@ class ImageToolsTest(object):
                              msg='get_implied_rotation(%s) failed: %u instead of %u'
                              % (image, rotation, image.rotation))
 
+    def test_get_image_geometry(self):
+        for image in _TEST_IMAGES:
+            image_path = get_image_path(image.name)
+            expected = image_tools.ImageGeometry(image.size[0], image.size[1],
+                                                 image.rotation, image.format,
+                                                 'animated.gif' == image.name)
+            with open(image_path, 'rb') as fp:
+                imgdata = fp.read()
+            for result in (image_tools.get_image_geometry(image_path),
+                           image_tools.get_image_geometry(image_path,
+                                                          imgdata=imgdata)):
+                self.assertEqual(result, expected,
+                                 msg='get_image_geometry("%s") failed: %s instead of %s'
+                                 % (image.name, result, expected))
+
+    def test_get_image_geometry_invalid(self):
+        self.assertIsNone(image_tools.get_image_geometry(os.devnull))
+
     def test_fit_in_rectangle_dimensions(self):
         # Test dimensions handling.
         for input_size, target_size, scale_up, keep_ratio, expected_size in (
@@ -477,7 +584,7 @@ class ImageToolsTest(object):
         ):
             for target_size in (
                 (image_size, image_size),
-                (image_size / 2, image_size / 2),
+                (image_size // 2, image_size // 2),
             ):
                 result = image_tools.fit_in_rectangle(pixbuf,
                                                       target_size[0],
@@ -495,7 +602,7 @@ class ImageToolsTest(object):
                 self.assertEqual(result_size, target_size, msg=msg)
                 # And then check corners.
                 expected_corners_colors = list(corners_colors)
-                for _ in range(1, 1 + (rotation % 360) / 90):
+                for _ in range(1, 1 + (rotation % 360) // 90):
                     expected_corners_colors.insert(0, expected_corners_colors.pop(-1))
                 result_corners_colors = []
                 corner = new_pixbuf((1, 1), False, 0x888888)
@@ -504,7 +611,7 @@ class ImageToolsTest(object):
                     x, y = corners_positions[0:2]
                     result.copy_area(x, y, 1, 1, corner, 0, 0)
                     color = corner.get_pixels()[0:3]
-                    color = binascii.hexlify(color)
+                    color = binascii.hexlify(color).decode('ascii')
                     if 'ffffff' == color:
                         color = 'white'
                     elif '000000' == color:
@@ -531,6 +638,41 @@ class ImageToolsTest(object):
                                  expected_corners_colors,
                                  msg=msg)
 
+    def test_fit_pixbuf_region(self):
+        # Regions must be the same as the matching part of the whole
+        # scaled pixbuf, whatever the rotation.
+        prefs['scaling quality'] = int(GdkPixbuf.InterpType.NEAREST)
+        tile_size = 64
+        for image in (
+            'pattern.jpg',
+            'pattern-transparent-rgba.png',
+        ):
+            pixbuf = image_tools.load_pixbuf(get_image_path(image))
+            for rotation in (0, 90, 180, 270):
+                for scale in (1, 2):
+                    rect = [pixbuf.get_width() * scale,
+                            pixbuf.get_height() * scale]
+                    if rotation in (90, 270):
+                        rect.reverse()
+                    expected = image_tools.fit_pixbuf_to_rectangle(pixbuf, rect,
+                                                                   rotation)
+                    for x in range(0, rect[0], tile_size):
+                        for y in range(0, rect[1], tile_size):
+                            region = (x, y, min(tile_size, rect[0] - x),
+                                      min(tile_size, rect[1] - y))
+                            result = image_tools.fit_pixbuf_region(pixbuf, rect,
+                                                                   rotation,
+                                                                   region)
+                            msg = (
+                                'fit_pixbuf_region("%s", %dx%d, rotation=%d, '
+                                'region=%s) failed; '
+                                'result %%(diff_type)s differs: %%(diff)s'
+                                % ((image,) + tuple(rect) + (rotation, region))
+                            )
+                            self.assertImagesEqual(result,
+                                                   expected.subpixbuf(*region),
+                                                   msg=msg)
+
     def test_fit_in_rectangle_opaque_no_resize(self):
         # Check opaque image is unchanged when not resizing.
         for image in (
@@ -0,0 +1,58 @@
+
+import os
+
+from . import MComixTest
+
+from mcomix import constants
+from mcomix.listing_cache import ListingCache
+
+
+class ListingCacheTest(MComixTest):
+
+    def setUp(self):
+        super(ListingCacheTest, self).setUp()
+        self.cache = ListingCache(os.path.join(self.tmp_dir, 'listings.db'))
+
+    def tearDown(self):
+        self.cache.close()
+        super(ListingCacheTest, self).tearDown()
+
+    def test_get(self):
+        contents = [u'01.jpg', u'sub/02.png', u'comment.txt']
+        self.cache.put(u'/a.cbr', 1000, 42, constants.RAR, contents, True)
+        self.assertEqual(self.cache.get(u'/a.cbr', 1000, 42),
+                         (constants.RAR, contents, True))
+        # Archive changed.
+        self.assertIsNone(self.cache.get(u'/a.cbr', 1001, 42))
+        self.assertIsNone(self.cache.get(u'/a.cbr', 1000, 43))
+        self.assertIsNone(self.cache.get(u'/b.cbr', 1000, 42))
+
+    def test_replace(self):
+        self.cache.put(u'/a.cbz', 1000, 42, constants.ZIP, [u'old.jpg'], False)
+        self.cache.put(u'/a.cbz', 2000, 42, constants.ZIP, [u'new.jpg'], False)
+        self.assertIsNone(self.cache.get(u'/a.cbz', 1000, 42))
+        self.assertEqual(self.cache.get(u'/a.cbz', 2000, 42),
+                         (constants.ZIP, [u'new.jpg'], False))
+
+    def test_delete(self):
+        self.cache.put(u'/a.cbz', 1000, 42, constants.ZIP, [u'01.jpg'], False)
+        self.cache.delete(u'/a.cbz')
+        self.assertIsNone(self.cache.get(u'/a.cbz', 1000, 42))
+
+
+    def test_render_dpi(self):
+        self.cache.put_render_dpi(u'/a.pdf', 1000, 42, {1: 288, 12: 150})
+        self.assertEqual(self.cache.get_render_dpi(u'/a.pdf', 1000, 42),
+                         {1: 288, 12: 150})
+        self.assertIsNone(self.cache.get_render_dpi(u'/a.pdf', 1001, 42))
+        self.cache.delete(u'/a.pdf')
+        self.assertIsNone(self.cache.get_render_dpi(u'/a.pdf', 1000, 42))
+
+    def test_geometry(self):
+        geometry = {u'01.jpg': [800, 1200, 0, u'JPEG', False],
+                    u'sub/02.gif': [600, 400, 90, u'GIF', True]}
+        self.cache.put_geometry(u'/a.cbz', 1000, 42, geometry)
+        self.assertEqual(self.cache.get_geometry(u'/a.cbz', 1000, 42), geometry)
+        self.assertIsNone(self.cache.get_geometry(u'/a.cbz', 1000, 43))
+        self.cache.delete(u'/a.cbz')
+        self.assertIsNone(self.cache.get_geometry(u'/a.cbz', 1000, 42))
@@ -0,0 +1,67 @@
+
+import os
+
+from . import MComixTest
+
+from mcomix.page_cache import PageCache
+
+
+class PageCacheTest(MComixTest):
+
+    def setUp(self):
+        super(PageCacheTest, self).setUp()
+        self.cache_dir = os.path.join(self.tmp_dir, 'cache')
+        self.archive = os.path.join(self.tmp_dir, 'book.cbz')
+        with open(self.archive, 'wb') as fp:
+            fp.write(b'archive')
+        self.key = PageCache.get_archive_key(self.archive)
+
+    def test_read_write(self):
+        cache = PageCache(self.cache_dir, 1000)
+        self.assertIsNone(cache.read(self.key, u'01.jpg'))
+        cache.write(self.key, u'01.jpg', b'page 1')
+        self.assertTrue(cache.contains(self.key, u'01.jpg'))
+        self.assertFalse(cache.contains(self.key, u'02.jpg'))
+        self.assertEqual(cache.read(self.key, u'01.jpg'), b'page 1')
+        self.assertEqual(cache.get_size(), 6)
+
+    def test_archive_changed(self):
+        cache = PageCache(self.cache_dir, 1000)
+        cache.write(self.key, u'01.jpg', b'page 1')
+        with open(self.archive, 'ab') as fp:
+            fp.write(b'more')
+        key = PageCache.get_archive_key(self.archive)
+        self.assertNotEqual(key, self.key)
+        self.assertIsNone(cache.read(key, u'01.jpg'))
+
+    def test_persistent(self):
+        cache = PageCache(self.cache_dir, 1000)
+        cache.write(self.key, u'01.jpg', b'page 1')
+        # Crash leftover.
+        subdir = os.listdir(self.cache_dir)[0]
+        leftover = os.path.join(self.cache_dir, subdir, PageCache.TMP_PREFIX + 'x')
+        open(leftover, 'wb').close()
+        cache = PageCache(self.cache_dir, 1000)
+        self.assertEqual(cache.read(self.key, u'01.jpg'), b'page 1')
+        self.assertFalse(os.path.exists(leftover))
+
+    def test_lru_eviction(self):
+        cache = PageCache(self.cache_dir, 30)
+        for n in range(3):
+            cache.write(self.key, u'%02u.jpg' % n, b'0123456789')
+        # Use page 0, so page 1 is the least recently used.
+        self.assertIsNotNone(cache.read(self.key, u'00.jpg'))
+        cache.write(self.key, u'03.jpg', b'0123456789')
+        self.assertEqual([cache.contains(self.key, u'%02u.jpg' % n)
+                          for n in range(4)], [True, False, True, True])
+        self.assertEqual(cache.get_size(), 30)
+        self.assertEqual(cache.evictions, 1)
+        cache.set_max_size(10)
+        self.assertEqual(cache.get_size(), 10)
+        self.assertTrue(cache.contains(self.key, u'03.jpg'))
+
+    def test_too_big(self):
+        cache = PageCache(self.cache_dir, 5)
+        cache.write(self.key, u'01.jpg', b'page 1')
+        self.assertFalse(cache.contains(self.key, u'01.jpg'))
+
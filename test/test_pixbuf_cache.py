@@ -0,0 +1,106 @@
+
+from . import MComixTest
+
+from mcomix.pixbuf_cache import PixbufCache, get_pixbuf_byte_size
+
+
+class _FakePixbuf(object):
+
+    def __init__(self, width, height, has_alpha=False):
+        self._rowstride = width * (4 if has_alpha else 3)
+        self._height = height
+
+    def get_rowstride(self):
+        return self._rowstride
+
+    def get_height(self):
+        return self._height
+
+
+class PixbufCacheTest(MComixTest):
+
+    def test_byte_size(self):
+        self.assertEqual(get_pixbuf_byte_size(_FakePixbuf(10, 20)), 600)
+        self.assertEqual(get_pixbuf_byte_size(_FakePixbuf(10, 20, True)), 800)
+        self.assertEqual(get_pixbuf_byte_size(None), 0)
+
+    def test_unbounded(self):
+        cache = PixbufCache()
+        for index in range(10):
+            self.assertTrue(cache.add(index, _FakePixbuf(100, 100)))
+        self.assertEqual(len(cache), 10)
+        self.assertEqual(cache.get_size(), 10 * 30000)
+        self.assertEqual(cache.evictions, 0)
+
+    def test_lru_eviction(self):
+        cache = PixbufCache(3 * 300)
+        for index in range(3):
+            cache.add(index, _FakePixbuf(10, 10))
+        # Touch page 0 so page 1 becomes the least recently used.
+        self.assertIsNotNone(cache.get(0))
+        cache.add(3, _FakePixbuf(10, 10))
+        self.assertEqual(sorted(cache.keys()), [0, 2, 3])
+        self.assertEqual(cache.evictions, 1)
+        self.assertEqual(cache.get_size(), 900)
+
+    def test_counters(self):
+        cache = PixbufCache()
+        cache.add(0, _FakePixbuf(1, 1))
+        cache.get(0)
+        cache.get(0)
+        cache.get(1)
+        stats = cache.get_stats()
+        self.assertEqual(stats['hits'], 2)
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['count'], 1)
+
+    def test_unwanted_evicted_first(self):
+        cache = PixbufCache(3 * 300)
+        cache.set_wanted([5, 6, 4])
+        for index in (0, 5, 6):
+            cache.add(index, _FakePixbuf(10, 10))
+        cache.add(4, _FakePixbuf(10, 10))
+        self.assertEqual(sorted(cache.keys()), [4, 5, 6])
+
+    def test_priority_respected(self):
+        cache = PixbufCache(2 * 300)
+        cache.set_wanted([5, 6, 4])
+        cache.add(5, _FakePixbuf(10, 10))
+        cache.add(6, _FakePixbuf(10, 10))
+        # Lower priority than everything in cache: not cached.
+        self.assertFalse(cache.add(4, _FakePixbuf(10, 10)))
+        self.assertEqual(sorted(cache.keys()), [5, 6])
+        # Page change: page 4 is now the most important.
+        cache.set_wanted([4, 5, 6])
+        self.assertTrue(cache.add(4, _FakePixbuf(10, 10)))
+        self.assertEqual(sorted(cache.keys()), [4, 5])
+
+    def test_current_page_always_kept(self):
+        cache = PixbufCache(100)
+        cache.set_wanted([0, 1])
+        self.assertTrue(cache.add(0, _FakePixbuf(100, 100)))
+        self.assertIn(0, cache)
+        self.assertFalse(cache.add(1, _FakePixbuf(100, 100)))
+        self.assertNotIn(1, cache)
+
+    def test_shrink(self):
+        cache = PixbufCache()
+        for index in range(4):
+            cache.add(index, _FakePixbuf(10, 10))
+        cache.set_max_size(600)
+        self.assertEqual(sorted(cache.keys()), [2, 3])
+
+
+    def test_key(self):
+        cache = PixbufCache()
+        pixbuf = _FakePixbuf(10, 10)
+        cache.add(0, pixbuf, key=(100, 100, 0))
+        self.assertIs(cache.get(0, key=(100, 100, 0)), pixbuf)
+        self.assertIsNone(cache.get(0, key=(200, 200, 0)))
+        self.assertIsNone(cache.get(0))
+        self.assertEqual(cache.misses, 2)
+        # A new key replaces the previous entry.
+        cache.add(0, _FakePixbuf(20, 20), key=(200, 200, 0))
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(cache.get_size(), 1200)
+        self.assertIsNone(cache.get(0, key=(100, 100, 0)))
@@ -0,0 +1,29 @@
+
+from . import MComixTest
+
+from mcomix.layout import StripLayout
+
+
+class StripLayoutTest(MComixTest):
+
+    def test_layout(self):
+        layout = StripLayout([(800, 1000), (600, 500), (800, 2000)], 1000, 10)
+        self.assertEqual(layout.get_union_box().get_size(), (1000, 3520))
+        self.assertEqual(layout.get_content_box(0).get_position(), (100, 0))
+        self.assertEqual(layout.get_content_box(1).get_position(), (200, 1010))
+        self.assertEqual(layout.get_content_box(2).get_position(), (100, 1520))
+
+    def test_index_at(self):
+        layout = StripLayout([(800, 1000)] * 1000, 800, 0)
+        self.assertEqual(layout.get_index_at(0), 0)
+        self.assertEqual(layout.get_index_at(999), 0)
+        self.assertEqual(layout.get_index_at(1000), 1)
+        self.assertEqual(layout.get_index_at(-10), 0)
+        self.assertEqual(layout.get_index_at(10 ** 7), 999)
+        self.assertEqual(layout.get_index_range(1500, 4000), (1, 4))
+        self.assertEqual(StripLayout([], 800, 0).get_index_at(0), -1)
+
+    def test_scale_to_width(self):
+        self.assertEqual(StripLayout.scale_to_width((1600, 3000), 800, False), (800, 1500))
+        self.assertEqual(StripLayout.scale_to_width((400, 3000), 800, False), (400, 3000))
+        self.assertEqual(StripLayout.scale_to_width((400, 3000), 800, True), (800, 6000))
@@ -0,0 +1,75 @@
+
+import os
+
+from . import MComixTest
+
+from mcomix import thumbnail_store
+from mcomix.thumbnail_store import ThumbnailStore
+
+
+class ThumbnailStoreTest(MComixTest):
+
+    def setUp(self):
+        super(ThumbnailStoreTest, self).setUp()
+        self.store_dir = os.path.join(self.tmp_dir, 'thumbnail_store')
+        self.store = ThumbnailStore(os.path.join(self.store_dir, 'thumbnails.db'))
+
+    def tearDown(self):
+        self.store.close()
+        super(ThumbnailStoreTest, self).tearDown()
+
+    def test_get(self):
+        self.store.put(u'/a.cbz', 128, 1000, 42, b'data')
+        self.assertEqual(self.store.get(u'/a.cbz', 128, 1000, 42), b'data')
+        # Source file changed.
+        self.assertIsNone(self.store.get(u'/a.cbz', 128, 1001, 42))
+        self.assertIsNone(self.store.get(u'/a.cbz', 128, 1000, 43))
+        # Other thumbnail size.
+        self.assertIsNone(self.store.get(u'/a.cbz', 256, 1000, 42))
+        # Source file missing: no validation.
+        self.assertEqual(self.store.get(u'/a.cbz', 128), b'data')
+
+    def test_replace(self):
+        self.store.put(u'/a.cbz', 128, 1000, 42, b'old')
+        self.store.put(u'/a.cbz', 128, 2000, 42, b'new')
+        self.assertEqual(self.store.count(), 1)
+        self.assertEqual(self.store.get(u'/a.cbz', 128, 2000, 42), b'new')
+
+    def test_get_many(self):
+        files = []
+        for n in range(ThumbnailStore.BATCH_SIZE + 10):
+            path = u'/book%u.cbz' % n
+            self.store.put(path, 128, n, n, b'%u' % n)
+            files.append((path, n, n))
+        # Out of date entry.
+        files[3] = (files[3][0], 1, 1)
+        # Unknown entry.
+        files.append((u'/unknown.cbz', 0, 0))
+        result = self.store.get_many(files, 128)
+        self.assertEqual(len(result), ThumbnailStore.BATCH_SIZE + 9)
+        self.assertNotIn(u'/book3.cbz', result)
+        self.assertEqual(result[u'/book42.cbz'], b'42')
+
+    def test_delete(self):
+        self.store.put(u'/a.cbz', 128, 1000, 42, b'data')
+        self.store.put(u'/a.cbz', 256, 1000, 42, b'data')
+        self.store.put(u'/b.cbz', 128, 1000, 42, b'data')
+        self.store.delete(u'/a.cbz')
+        self.assertEqual(self.store.count(), 1)
+        self.assertIsNone(self.store.get(u'/a.cbz', 128))
+
+    def test_export_file(self):
+        directory = os.path.join(self.store_dir, 'normal')
+        thumbpath = self.store.export_file(directory, u'/a.cbz', b'data')
+        self.assertEqual(os.path.dirname(thumbpath), directory)
+        self.assertEqual(os.path.basename(thumbpath),
+                         thumbnail_store.uri_to_freedesktop_name(
+                             thumbnail_store.path_to_uri(u'/a.cbz')))
+        self.assertEqual(open(thumbpath, 'rb').read(), b'data')
+        self.assertEqual(os.listdir(directory), [os.path.basename(thumbpath)])
+
+    def test_uri(self):
+        path = os.path.abspath(u'some dir/book #1.cbz')
+        uri = thumbnail_store.path_to_uri(path)
+        self.assertNotIn(u' ', uri)
+
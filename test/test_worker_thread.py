@@ -0,0 +1,150 @@
+
+import threading
+
+from . import MComixTest
+
+from mcomix.worker_thread import WorkerThread
+
+
+class WorkerThreadTest(MComixTest):
+
+    def setUp(self):
+        super(WorkerThreadTest, self).setUp()
+        self.processed = []
+        # Hold the worker until all orders are queued.
+        self.gate = threading.Event()
+        self.started = threading.Event()
+        self.worker = WorkerThread(self._process, name='test')
+
+    def tearDown(self):
+        self.gate.set()
+        self.worker.stop()
+        super(WorkerThreadTest, self).tearDown()
+
+    def _process(self, order):
+        self.started.set()
+        self.gate.wait()
+        self.processed.append(order)
+
+    def _wait(self, count):
+        for n in range(200):
+            if self.worker.get_stats()['completed'] + \
+               self.worker.get_stats()['cancelled'] >= count:
+                return
+            threading.Event().wait(0.01)
+        self.fail('orders not processed')
+
+    def test_priority(self):
+        self.worker.append_order('first', priority=-1)
+        self.started.wait()
+        for order, priority in (('c', 3), ('a', 1), ('b', 2)):
+            self.worker.append_order(order, priority=priority)
+        self.assertTrue(self.worker.reprioritize_order('c', 0))
+        self.assertFalse(self.worker.reprioritize_order('d', 0))
+        self.gate.set()
+        self._wait(4)
+        self.assertEqual(self.processed, ['first', 'c', 'a', 'b'])
+
+    def test_reprioritize_orders(self):
+        self.worker.append_order(-1, priority=-1)
+        self.started.wait()
+        for n in range(10):
+            self.worker.append_order(n, priority=n)
+        # Closest to 5 first.
+        self.worker.reprioritize_orders(lambda n: (abs(n - 5), n))
+        self.gate.set()
+        self._wait(11)
+        self.assertEqual(self.processed[1:], [5, 4, 6, 3, 7, 2, 8, 1, 9, 0])
+
+    def test_extend_orders_priority(self):
+        self.worker.append_order('first', priority=(-1,))
+        self.started.wait()
+        order = {'a': 2, 'b': 0, 'c': 1}
+        self.worker.extend_orders(['a', 'b', 'c'],
+                                  get_priority=lambda name: (1, order[name]))
+        self.worker.reprioritize_order('a', (0,))
+        self.gate.set()
+        self._wait(4)
+        self.assertEqual(self.processed, ['first', 'a', 'b', 'c'])
+
+    def test_sort_orders(self):
+        worker = WorkerThread(self._process, name='test', sort_orders=True)
+        worker.append_order((-1, 'first'))
+        self.started.wait()
+        worker.extend_orders([(2, 'b'), (1, 'a'), (3, 'c')])
+        self.gate.set()
+        for n in range(200):
+            if worker.get_stats()['completed'] == 4:
+                break
+            threading.Event().wait(0.01)
+        worker.stop()
+        self.assertEqual(self.processed, [(-1, 'first'), (1, 'a'), (2, 'b'), (3, 'c')])
+
+    def test_cancel(self):
+        self.worker.append_order('first')
+        self.started.wait()
+        token = self.worker.append_order('b')
+        self.worker.extend_orders(['c', 'd'])
+        token.cancel()
+        self.assertTrue(token.is_cancelled())
+        self.assertTrue(self.worker.cancel_order('c'))
+        self.assertFalse(self.worker.cancel_order('e'))
+        self.gate.set()
+        self._wait(4)
+        self.assertEqual(self.processed, ['first', 'd'])
+        stats = self.worker.get_stats()
+        self.assertEqual(stats['completed'], 2)
+        self.assertEqual(stats['cancelled'], 2)
+        self.assertEqual(stats['queued'], 0)
+
+    def test_cancel_running(self):
+        stopped = []
+        def process(order):
+            self.started.set()
+            self.gate.wait()
+            stopped.append(worker.must_stop())
+        worker = WorkerThread(process, name='test')
+        token = worker.append_order('a')
+        self.started.wait()
+        token.cancel()
+        self.gate.set()
+        worker.stop()
+        self.assertEqual(stopped, [True])
+        self.assertEqual(worker.get_stats()['cancelled'], 1)
+
+    def test_clear_orders(self):
+        self.worker.append_order('first')
+        self.started.wait()
+        self.worker.extend_orders(['b', 'c'])
+        self.worker.clear_orders()
+        self.worker.append_order('d')
+        self.gate.set()
+        self._wait(4)
+        self.assertEqual(self.processed, ['first', 'd'])
+
+    def test_unique_orders(self):
+        worker = WorkerThread(self._process, name='test', unique_orders=True)
+        self.assertIsNotNone(worker.append_order(('a', 1)))
+        self.assertIsNone(worker.append_order(('a', 2)))
+        self.assertEqual(len(worker.extend_orders([('a', 3), ('b', 1)])), 1)
+        self.gate.set()
+        worker.stop()
+
+    def test_idle_threads(self):
+        idle_timeout = WorkerThread.IDLE_TIMEOUT
+        WorkerThread.IDLE_TIMEOUT = 0.05
+        try:
+            self.gate.set()
+            self.worker.append_order('a')
+            self._wait(1)
+            for n in range(200):
+                if 0 == self.worker.get_stats()['threads']:
+                    break
+                threading.Event().wait(0.01)
+            self.assertEqual(self.worker.get_stats()['threads'], 0)
+            # A new thread is started for new orders.
+            self.worker.append_order('b')
+            self._wait(2)
+            self.assertEqual(self.processed, ['a', 'b'])
+        finally:
+            WorkerThread.IDLE_TIMEOUT = idle_timeout